@@ -0,0 +1,234 @@
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Type, Union
+
+from django.db import close_old_connections, models, transaction
+
+import oai.models as oai_models
+import vai.models as vai_models
+from config.conductor import conductor_config
+
+# The models in the order they are created, as the later ones refer to the
+# earlier ones
+MODELS: List[Type[models.Model]] = [
+    oai_models.Usage,
+    oai_models.Chatcmpl,
+    oai_models.ChatcmplRequest,
+    oai_models.FunctionCall,
+    oai_models.Message,
+    oai_models.Choice,
+    vai_models.GeminiProRequest,
+]
+
+# The records of a call, or a function building them
+Call = Union[List[models.Model], Callable[[], List[models.Model]]]
+
+
+class AuditWriter:
+    """Writer saving the records of the LLM calls in the background.
+
+    The records of each call are unsaved models, which are buffered and
+    saved in batches by a thread of the process, with one bulk insert per
+    model in one transaction. If too many records are pending, the records
+    are saved by the caller instead. The pending records are saved when the
+    process exits.
+
+    The records may also be built by the thread, to take work such as
+    counting tokens off the request path.
+    """
+
+    logger: logging.Logger
+    condition: threading.Condition
+    pending: Deque[Call]
+    thread: Optional[threading.Thread]
+    pid: Optional[int]
+    stopping: bool
+    written: int
+    failed: int
+
+    def __init__(self):
+        """Initialize the writer"""
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+        self.written = 0
+        self.failed = 0
+
+        atexit.register(self.stop)
+
+    def write(self, records: List[models.Model]):
+        """Write the records of a call
+
+        The records are saved together, in the order of `MODELS`, so they
+        may refer to each other.
+        """
+        self.check(records)
+        self.enqueue(records)
+
+    def defer(self, build: Callable[[], List[models.Model]]):
+        """Write the records of a call built later by the thread
+
+        The function is called without the context of the caller, so it
+        must not depend on it, e.g. on the current component.
+        """
+        self.enqueue(build)
+
+    @staticmethod
+    def check(records: List[models.Model]):
+        """Check that the records are of the models written"""
+        for record in records:
+            if type(record) not in MODELS:
+                raise ValueError(f"Unknown audit record: {record!r}")
+
+    def enqueue(self, call: Call):
+        """Enqueue the records of a call to be saved"""
+        with self.condition:
+            if (
+                not self.stopping
+                and len(self.pending) < conductor_config.audit_max_pending
+            ):
+                self.pending.append(call)
+                self.start()
+
+                if len(self.pending) >= conductor_config.audit_batch_size:
+                    self.condition.notify()
+
+                return
+
+        # Too many records are pending or the process is exiting
+        self.save([call])
+
+    def start(self):
+        """Start the thread of the process if it is not running
+
+        Call with the condition acquired.
+        """
+        if self.thread is not None and self.pid == os.getpid():
+            return
+
+        # The thread is not inherited by forked processes
+        self.thread = threading.Thread(
+            target=self.loop, name="audit-writer", daemon=True
+        )
+        self.pid = os.getpid()
+        self.thread.start()
+
+    def loop(self):
+        """Save the pending records in batches until stopped"""
+        while True:
+            with self.condition:
+                if (
+                    not self.stopping
+                    and len(self.pending) < conductor_config.audit_batch_size
+                ):
+                    self.condition.wait(conductor_config.audit_flush_interval)
+
+                batch = self.take()
+                if not batch and self.stopping:
+                    return
+
+            if batch:
+                self.save(batch)
+                close_old_connections()
+
+    def take(self) -> List[Call]:
+        """Take a batch of the pending records
+
+        Call with the condition acquired.
+        """
+        size = min(len(self.pending), conductor_config.audit_batch_size)
+
+        return [self.pending.popleft() for _ in range(size)]
+
+    def flush(self):
+        """Save all pending records in the caller"""
+        while True:
+            with self.condition:
+                batch = self.take()
+
+            if not batch:
+                return
+
+            self.save(batch)
+
+    def stop(self):
+        """Stop the thread, saving the pending records"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+            thread = self.thread if self.pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join(conductor_config.audit_flush_interval * 10)
+
+        self.flush()
+
+    def build(self, batch: List[Call]) -> List[List[models.Model]]:
+        """Build the records of the calls, dropping those failing"""
+        calls = []
+
+        for call in batch:
+            try:
+                if callable(call):
+                    call = call()
+                    self.check(call)
+
+                calls.append(call)
+            except Exception as e:
+                self.logger.error(f"Unable to build audit records: {e}")
+                with self.condition:
+                    self.failed += 1
+
+        return calls
+
+    def save(self, batch: List[Call]):
+        """Save the records of the calls in one transaction
+
+        If the batch fails, the records of each call are saved on their own,
+        so only the failing calls are lost.
+        """
+        batch = self.build(batch)
+        if not batch:
+            return
+
+        records: Dict[Type[models.Model], List[models.Model]] = {}
+        for call in batch:
+            for record in call:
+                records.setdefault(type(record), []).append(record)
+
+        try:
+            with transaction.atomic():
+                for model in MODELS:
+                    if model in records:
+                        model.objects.bulk_create(records[model])
+        except Exception as e:
+            if len(batch) > 1:
+                for call in batch:
+                    self.save([call])
+                return
+
+            self.logger.error(f"Unable to save audit records: {e}")
+            with self.condition:
+                self.failed += 1
+            return
+
+        with self.condition:
+            self.written += len(batch)
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the writer"""
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "written": self.written,
+                "failed": self.failed,
+            }
+
+
+audit_writer = AuditWriter()
@@ -0,0 +1,347 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Model
+from django.utils import timezone
+
+from config.conductor import conductor_config
+from core import enums, models
+from utils.json_type import JsonType
+
+
+class DatabaseCache:
+    """Cache of JSON values stored in the database.
+
+    The entries are stored by their scope, e.g. the component or the user
+    and provider, and their key. The hits and misses are counted by scope
+    in the statistics model. The least recently used entries are evicted
+    once an owner, which may span many scopes, has too many, and the entries
+    expire after a time to live.
+
+    The access time of an entry is only updated once per touch interval, so
+    most hits do not write the entry.
+    """
+
+    entry_model: Type[Model]
+    stats_model: Type[Model]
+    max_entries: int
+    max_value_size: int
+    ttl: float
+
+    def __init__(
+        self,
+        entry_model: Type[Model],
+        stats_model: Type[Model],
+        max_entries: int,
+        max_value_size: int,
+        ttl: float,
+    ):
+        """Initialize the cache"""
+        self.entry_model = entry_model
+        self.stats_model = stats_model
+        self.max_entries = max_entries
+        self.max_value_size = max_value_size
+        self.ttl = ttl
+
+    def get_entry(self, scope: Dict[str, Any], key: str) -> Optional[Model]:
+        """Get the entry of the key in the scope, counting a hit or a miss
+
+        An expired entry is a miss, it is replaced when set again or evicted.
+        """
+        now = timezone.now()
+        entry = self.entry_model.objects.filter(**scope, key=key).first()
+
+        if entry is None or entry.created_at < self.expiry(now):
+            self.count(scope, {"misses": 1})
+            return None
+
+        if now - entry.accessed_at > timedelta(
+            seconds=conductor_config.cache_touch_interval
+        ):
+            self.entry_model.objects.filter(id=entry.id).update(
+                accessed_at=now
+            )
+
+        self.count(scope, self.hit_counts(entry))
+
+        return entry
+
+    def set_entry(
+        self,
+        scope: Dict[str, Any],
+        owner: Dict[str, Any],
+        key: str,
+        value: JsonType,
+        **fields: Any,
+    ):
+        """Set the entry of the key in the scope
+
+        Values larger than the maximum size are not cached. The entries of
+        the owner are evicted as needed.
+        """
+        size = len(json.dumps(value))
+        if size > self.max_value_size:
+            return
+
+        now = timezone.now()
+
+        try:
+            with transaction.atomic():
+                self.entry_model.objects.update_or_create(
+                    **scope,
+                    key=key,
+                    defaults={
+                        "value": value,
+                        "size": size,
+                        "created_at": now,
+                        "accessed_at": now,
+                        **fields,
+                    },
+                )
+        except IntegrityError:
+            # The same value was cached concurrently
+            return
+
+        self.evict(owner, now)
+
+    def evict(self, owner: Dict[str, Any], now: datetime):
+        """Evict the expired and least recently used entries of the owner"""
+        entries = self.entry_model.objects.filter(**owner)
+        entries.filter(created_at__lt=self.expiry(now)).delete()
+
+        evicted = entries.order_by("-accessed_at").values_list(
+            "id", flat=True
+        )[self.max_entries :]
+        if evicted:
+            entries.filter(id__in=list(evicted)).delete()
+
+    def clear_entries(self, **owners: Any):
+        """Clear the entries and statistics of the owners"""
+        self.entry_model.objects.filter(**owners).delete()
+        self.stats_model.objects.filter(**owners).delete()
+
+    @staticmethod
+    def hit_counts(entry: Model) -> Dict[str, int]:
+        """Get the counts of a hit of the entry"""
+        return {"hits": 1}
+
+    def count(self, scope: Dict[str, Any], counts: Dict[str, int]):
+        """Add the counts to the statistics of the scope
+
+        The counts are added in the database, so no concurrent count is lost.
+        """
+        updates = {name: F(name) + value for name, value in counts.items()}
+        if self.stats_model.objects.filter(**scope).update(**updates):
+            return
+
+        try:
+            with transaction.atomic():
+                self.stats_model.objects.create(**scope, **counts)
+        except IntegrityError:
+            # The statistics were created concurrently
+            self.stats_model.objects.filter(**scope).update(**updates)
+
+    def count_entries(self, field: str, **owners: Any) -> Dict[Any, int]:
+        """Count the entries of the owners by the given field"""
+        return dict(
+            self.entry_model.objects.filter(**owners)
+            .values(field)
+            .annotate(count=Count("id"))
+            .values_list(field, "count")
+        )
+
+    def expiry(self, now: datetime) -> datetime:
+        """Get the time before which the entries are expired"""
+        return now - timedelta(seconds=self.ttl)
+
+
+class ComponentResultCache(DatabaseCache):
+    """Cache of the results of the cacheable components.
+
+    The results are stored in the database by the keys computed by the
+    components, from their code and arguments. The least recently used
+    results are evicted once a component has too many, and the results
+    expire after a time to live.
+    """
+
+    def __init__(self):
+        """Initialize the cache"""
+        super().__init__(
+            models.ComponentCacheEntry,
+            models.ComponentCacheStats,
+            conductor_config.component_cache_max_entries,
+            conductor_config.component_cache_max_value_size,
+            conductor_config.component_cache_ttl,
+        )
+
+    def get(self, component: models.Component, key: str) -> Tuple[bool, Any]:
+        """Get the cached result of the component
+
+        Returns:
+            Tuple[bool, Any]: Whether the result is cached, and the result.
+        """
+        entry = self.get_entry({"component": component}, key)
+        if entry is None:
+            return False, None
+
+        return True, entry.value
+
+    def set(self, component: models.Component, key: str, value: JsonType):
+        """Set the cached result of the component
+
+        Results larger than the maximum size are not cached.
+        """
+        scope = {"component": component}
+        self.set_entry(scope, scope, key, value)
+
+    def clear(self, components: List[models.Component]):
+        """Clear the cached results and statistics of the components"""
+        self.clear_entries(component__in=components)
+
+    def stats(
+        self, components: List[models.Component]
+    ) -> List[Dict[str, Any]]:
+        """Get the statistics of the components"""
+        stats = {
+            stats.component_id: stats
+            for stats in models.ComponentCacheStats.objects.filter(
+                component__in=components
+            )
+        }
+        entries = self.count_entries(
+            "component_id", component__in=components
+        )
+
+        results = []
+        for component in components:
+            hits = stats[component.id].hits if component.id in stats else 0
+            misses = (
+                stats[component.id].misses if component.id in stats else 0
+            )
+            results.append(
+                {
+                    "id": component.id,
+                    "name": component.name,
+                    "is_cacheable": component.is_cacheable,
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0,
+                    "entries": entries.get(component.id, 0),
+                }
+            )
+
+        return results
+
+
+component_result_cache = ComponentResultCache()
+
+
+class LlmResponseCache(DatabaseCache):
+    """Cache of the responses of the LLM APIs.
+
+    The responses are stored in the database for each user by the hash of
+    the request and the model of the provider, so they are shared between
+    the server processes. The least recently used responses are evicted once
+    a user has too many, and the responses expire after a time to live.
+    """
+
+    def __init__(self):
+        """Initialize the cache"""
+        super().__init__(
+            models.LlmCacheEntry,
+            models.LlmCacheStats,
+            conductor_config.llm_cache_max_entries,
+            conductor_config.llm_cache_max_value_size,
+            conductor_config.llm_cache_ttl,
+        )
+
+    @staticmethod
+    def key(
+        provider: enums.LlmProvider, model: str, request: Dict[str, Any]
+    ) -> str:
+        """Get the key of the request to the model of the provider"""
+        content = json.dumps(
+            {"provider": provider, "model": model, "request": request},
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(
+        self, user: models.User, provider: enums.LlmProvider, key: str
+    ) -> Tuple[bool, JsonType]:
+        """Get the cached response of the request
+
+        Returns:
+            Tuple[bool, JsonType]: Whether the response is cached, and the
+                response.
+        """
+        entry = self.get_entry({"user": user, "provider": provider}, key)
+        if entry is None:
+            return False, None
+
+        return True, entry.value
+
+    def set(
+        self,
+        user: models.User,
+        provider: enums.LlmProvider,
+        key: str,
+        value: JsonType,
+        tokens: int,
+    ):
+        """Set the cached response of the request
+
+        The tokens are those used by the request, which are saved by each
+        hit. Responses larger than the maximum size are not cached.
+        """
+        self.set_entry(
+            {"user": user, "provider": provider},
+            {"user": user},
+            key,
+            value,
+            tokens=tokens,
+        )
+
+    def clear(self, user: models.User):
+        """Clear the cached responses and statistics of the user"""
+        self.clear_entries(user=user)
+
+    @staticmethod
+    def hit_counts(entry: Model) -> Dict[str, int]:
+        """Get the counts of a hit of the entry, saving its tokens"""
+        return {"hits": 1, "tokens_saved": entry.tokens}
+
+    def stats(self, user: models.User) -> List[Dict[str, Any]]:
+        """Get the statistics of the user for each provider"""
+        stats = {
+            stats.provider: stats
+            for stats in models.LlmCacheStats.objects.filter(user=user)
+        }
+        entries = self.count_entries("provider", user=user)
+
+        results = []
+        for provider in enums.LlmProvider:
+            hits = stats[provider].hits if provider in stats else 0
+            misses = stats[provider].misses if provider in stats else 0
+            results.append(
+                {
+                    "provider": provider.value,
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0,
+                    "tokens_saved": (
+                        stats[provider].tokens_saved
+                        if provider in stats
+                        else 0
+                    ),
+                    "entries": entries.get(provider, 0),
+                }
+            )
+
+        return results
+
+
+llm_response_cache = LlmResponseCache()
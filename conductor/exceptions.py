@@ -2,7 +2,7 @@ from typing import Optional
 
 from django.utils.translation import gettext_lazy as _
 from rest_framework import status
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, Throttled
 
 
 class IncorrectOldPasswordException(APIException):
@@ -25,3 +25,26 @@ class BadArgumentsException(APIException):
         if detail is not None:
             self.detail = detail
         super().__init__(detail)
+
+
+class ChatJobQueueFullException(APIException):
+    """Exception for too many pending chat jobs."""
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _("Too many pending chat jobs, try again later.")
+    default_code = "chat_job_queue_full"
+
+
+class ChatJobFailedException(APIException):
+    """Exception for chat job failed to run."""
+
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    default_detail = _("Chat job failed to run.")
+    default_code = "chat_job_failed"
+
+
+class LlmThrottledException(Throttled):
+    """Exception for LLM calls exceeding the rate limits."""
+
+    default_detail = _("Too many LLM calls, try again later.")
+    default_code = "llm_throttled"
@@ -0,0 +1,509 @@
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+from cachetools import LRUCache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from config.conductor import conductor_config
+from core import enums, models
+
+from . import exceptions
+
+T = TypeVar("T")
+
+USER_CACHE_SIZE = 1024
+
+
+class FairQueue:
+    """Queue of the calls waiting for the rate limits.
+
+    The users take turns, and the calls of each user are served in the
+    order they arrived, so a user making many calls does not hold back the
+    others. A call waiting for the budgets pauses, letting the calls of the
+    other users take their turns until it is ready again.
+    """
+
+    condition: threading.Condition
+    users: "OrderedDict[int, Deque[object]]"
+    ready: Set[object]
+
+    def __init__(self):
+        """Initialize the queue"""
+        self.condition = threading.Condition()
+        self.users = OrderedDict()
+        self.ready = set()
+
+    def join(self, user_id: int, ticket: object):
+        """Join the queue with the ticket of a call of the user"""
+        with self.condition:
+            self.users.setdefault(user_id, deque()).append(ticket)
+            self.ready.add(ticket)
+            self.condition.notify_all()
+
+    def wait(self, ticket: object, timeout: float) -> bool:
+        """Wait for the turn of the ticket, returning whether it is its turn"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.head() is ticket, max(timeout, 0)
+            )
+
+    def pause(self, user_id: int, ticket: object):
+        """Pause the ticket, giving the turn to the other users"""
+        with self.condition:
+            self.ready.discard(ticket)
+            self.users.move_to_end(user_id)
+            self.condition.notify_all()
+
+    def resume(self, ticket: object):
+        """Resume the paused ticket"""
+        with self.condition:
+            self.ready.add(ticket)
+            self.condition.notify_all()
+
+    def leave(self, user_id: int, ticket: object):
+        """Leave the queue, giving the turn to the next user"""
+        with self.condition:
+            tickets = self.users[user_id]
+            tickets.remove(ticket)
+            self.ready.discard(ticket)
+
+            if tickets:
+                self.users.move_to_end(user_id)
+            else:
+                del self.users[user_id]
+
+            self.condition.notify_all()
+
+    def head(self) -> Optional[object]:
+        """Get the ticket whose turn it is
+
+        Call with the condition acquired.
+        """
+        for tickets in self.users.values():
+            if tickets[0] in self.ready:
+                return tickets[0]
+
+        return None
+
+    def __len__(self) -> int:
+        """Get the number of calls in the queue"""
+        with self.condition:
+            return sum(len(tickets) for tickets in self.users.values())
+
+
+class LlmGateway:
+    """Gateway of the calls to the LLM providers.
+
+    The calls are limited by requests and tokens per minute, for each
+    provider and for each user of each provider. The budgets are token
+    buckets stored in the database, so they are shared between the server
+    processes. The calls waiting for the budgets are served fairly by a
+    queue in each process.
+
+    The tokens of a call are reserved before it is made and settled with the
+    tokens used once known. Calls failing with a rate limit or a transient
+    error are retried with jittered exponential backoff, waiting for at
+    least the time given by the provider, during which the other calls to
+    the provider wait as well.
+    """
+
+    logger: logging.Logger
+    lock: threading.Lock
+    queue: FairQueue
+    users: LRUCache
+    blocked_until: Dict[str, float]
+    throttled: int
+    rejected: int
+    retried: int
+    blocked: int
+
+    def __init__(self):
+        """Initialize the gateway"""
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.queue = FairQueue()
+        self.users = LRUCache(maxsize=USER_CACHE_SIZE)
+        self.blocked_until = {}
+        self.throttled = 0
+        self.rejected = 0
+        self.retried = 0
+        self.blocked = 0
+
+    def call(
+        self,
+        provider: enums.LlmProvider,
+        component_id: int,
+        tokens: int,
+        function: Callable[[], T],
+        retry_after: Callable[[Exception], Optional[float]],
+        usage: Callable[[T], Optional[int]],
+    ) -> T:
+        """Make the call to the provider within the budgets
+
+        Args:
+            provider (enums.LlmProvider): The provider.
+            component_id (int): The ID of the component making the call.
+            tokens (int): The tokens to reserve, e.g. the estimated prompt
+                tokens and the maximum completion tokens.
+            function (Callable[[], T]): The call.
+            retry_after (Callable[[Exception], Optional[float]]): Function
+                getting the seconds to wait given by the provider before
+                retrying the call failing with the exception, 0 if none, or
+                None if the call is not to be retried.
+            usage (Callable[[T], Optional[int]]): Function getting the
+                tokens used by the result, or None to settle them later.
+
+        Raises:
+            LlmThrottledException: If the call would wait for longer than
+                the maximum wait.
+        """
+        attempt = 0
+
+        while True:
+            self.acquire(provider, component_id, tokens)
+
+            try:
+                result = function()
+            except Exception as e:
+                # The tokens of a failed call are not used
+                self.settle(provider, component_id, tokens, 0)
+
+                wait = retry_after(e)
+                retries = conductor_config.llm_gateway_retries
+                if wait is None or attempt >= retries:
+                    raise
+
+                if wait > conductor_config.llm_gateway_max_wait:
+                    with self.lock:
+                        self.rejected += 1
+                    raise exceptions.LlmThrottledException(
+                        wait=math.ceil(wait)
+                    ) from e
+
+                if wait > 0:
+                    self.block(provider, wait)
+
+                delay = max(wait, self.backoff(attempt))
+                self.logger.warning(
+                    f"Retrying {provider} call in {delay:.2f}s: {e!r}"
+                )
+                with self.lock:
+                    self.retried += 1
+
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            used = usage(result)
+            if used is not None:
+                self.settle(provider, component_id, tokens, used)
+
+            return result
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """Get the jittered delay before the retry of the attempt"""
+        return random.uniform(
+            0,
+            min(
+                conductor_config.llm_gateway_backoff_max,
+                conductor_config.llm_gateway_backoff_base * 2**attempt,
+            ),
+        )
+
+    @staticmethod
+    def budgets(
+        provider: enums.LlmProvider, user_id: int
+    ) -> List[Tuple[str, int, bool]]:
+        """Get the budgets limiting the calls of the user to the provider
+
+        Returns:
+            List[Tuple[str, int, bool]]: The key of the bucket, the limit
+                per minute, and whether the limit is of the tokens or of the
+                requests, of each limited budget.
+        """
+        requests, tokens = {
+            enums.LlmProvider.OAI: (
+                conductor_config.llm_oai_requests_per_minute,
+                conductor_config.llm_oai_tokens_per_minute,
+            ),
+            enums.LlmProvider.VAI: (
+                conductor_config.llm_vai_requests_per_minute,
+                conductor_config.llm_vai_tokens_per_minute,
+            ),
+        }[provider]
+
+        budgets = [
+            (f"{provider}:requests", requests, False),
+            (f"{provider}:tokens", tokens, True),
+            (
+                f"{provider}:user:{user_id}:requests",
+                conductor_config.llm_user_requests_per_minute,
+                False,
+            ),
+            (
+                f"{provider}:user:{user_id}:tokens",
+                conductor_config.llm_user_tokens_per_minute,
+                True,
+            ),
+        ]
+
+        return [budget for budget in budgets if budget[1] > 0]
+
+    def user_id(self, component_id: int) -> int:
+        """Get the ID of the user of the component"""
+        with self.lock:
+            user_id = self.users.get(component_id)
+
+        if user_id is None:
+            user_id = (
+                models.Component.objects.filter(id=component_id)
+                .values_list("user_id", flat=True)
+                .first()
+            ) or 0
+
+            with self.lock:
+                self.users[component_id] = user_id
+
+        return user_id
+
+    def acquire(
+        self, provider: enums.LlmProvider, component_id: int, tokens: int
+    ):
+        """Wait for the budgets of the call, taking its request and tokens
+
+        The call waits in the thread of the caller, e.g. a request thread of
+        the server or the thread of a chat job. So the threads are not all
+        held by waiting calls, at most `llm_gateway_max_waiting` calls of a
+        process wait at once, each for up to `llm_gateway_max_wait` seconds,
+        which should be lowered for servers with few threads.
+
+        Raises:
+            LlmThrottledException: If too many calls are waiting, or if the
+                call would wait for longer than the maximum wait.
+        """
+        deadline = time.monotonic() + conductor_config.llm_gateway_max_wait
+        user_id = self.user_id(component_id)
+        budgets = self.budgets(provider, user_id)
+        ticket = object()
+
+        if len(self.queue) >= conductor_config.llm_gateway_max_waiting:
+            self.reject()
+
+        self.queue.join(user_id, ticket)
+
+        try:
+            while True:
+                if not self.queue.wait(ticket, deadline - time.monotonic()):
+                    self.reject()
+
+                wait = self.blocked_for(provider)
+                if wait <= 0 and budgets:
+                    wait = self.take(budgets, tokens)
+
+                if wait <= 0:
+                    return
+
+                if time.monotonic() + wait > deadline:
+                    self.reject(wait)
+
+                with self.lock:
+                    self.throttled += 1
+
+                self.queue.pause(user_id, ticket)
+                time.sleep(wait)
+                self.queue.resume(ticket)
+        finally:
+            self.queue.leave(user_id, ticket)
+
+    def reject(self, wait: Optional[float] = None):
+        """Reject the call waiting for too long or with too many waiting"""
+        with self.lock:
+            self.rejected += 1
+
+        raise exceptions.LlmThrottledException(
+            wait=None if wait is None else math.ceil(wait)
+        )
+
+    def take(self, budgets: List[Tuple[str, int, bool]], tokens: int) -> float:
+        """Take the request and tokens of a call from the buckets
+
+        Nothing is taken if any bucket does not have enough, in which case
+        the seconds to wait for the buckets to refill are returned. A call
+        with more tokens than the limit waits for a full bucket.
+
+        The buckets are first read without locking them, so only the calls
+        likely to take from the buckets lock and write them, and the calls
+        which have to wait neither lock nor write them.
+        """
+        now = timezone.now()
+        keys = [key for key, _, _ in budgets]
+
+        buckets = self.get_buckets(keys)
+        if len(buckets) == len(keys):
+            wait = self.refill_buckets(buckets, budgets, tokens, now)
+            if wait > 0:
+                return wait
+
+        with transaction.atomic():
+            buckets = self.get_buckets(keys, lock=True)
+            if len(buckets) < len(keys):
+                models.RateLimitBucket.objects.bulk_create(
+                    [
+                        models.RateLimitBucket(
+                            key=key, level=limit, updated_at=now
+                        )
+                        for key, limit, _ in budgets
+                        if key not in buckets
+                    ],
+                    ignore_conflicts=True,
+                )
+                buckets = self.get_buckets(keys, lock=True)
+
+            wait = self.refill_buckets(buckets, budgets, tokens, now)
+            if wait > 0:
+                return wait
+
+            for key, _, is_tokens in budgets:
+                buckets[key].level -= tokens if is_tokens else 1
+
+            models.RateLimitBucket.objects.bulk_update(
+                buckets.values(), ["level", "updated_at"]
+            )
+
+        return 0.0
+
+    @staticmethod
+    def get_buckets(
+        keys: List[str], lock: bool = False
+    ) -> Dict[str, models.RateLimitBucket]:
+        """Get the buckets of the keys
+
+        If locked, the buckets are locked in order, to avoid deadlocks.
+        """
+        buckets = models.RateLimitBucket.objects.filter(key__in=keys)
+        if lock:
+            buckets = buckets.select_for_update().order_by("key")
+
+        return {bucket.key: bucket for bucket in buckets}
+
+    def refill_buckets(
+        self,
+        buckets: Dict[str, models.RateLimitBucket],
+        budgets: List[Tuple[str, int, bool]],
+        tokens: int,
+        now: datetime,
+    ) -> float:
+        """Refill the buckets until now, without saving them
+
+        Returns:
+            float: The seconds to wait for the buckets to have enough for the
+                call, or to be no longer blocked, 0 if the call can be made.
+        """
+        wait = 0.0
+
+        for key, limit, is_tokens in budgets:
+            bucket = buckets[key]
+            bucket.level = self.refill(
+                bucket.level,
+                limit,
+                (now - bucket.updated_at).total_seconds(),
+            )
+            bucket.updated_at = now
+
+            wait = max(
+                wait,
+                self.refill_wait(
+                    bucket.level, limit, tokens if is_tokens else 1
+                ),
+            )
+
+            if bucket.blocked_until is not None:
+                wait = max(wait, (bucket.blocked_until - now).total_seconds())
+
+        return wait
+
+    @staticmethod
+    def refill(level: float, limit: int, elapsed: float) -> float:
+        """Get the level of a bucket refilled for the elapsed seconds
+
+        The bucket refills at the limit per minute, up to the limit.
+        """
+        return min(limit, level + max(elapsed, 0) * limit / 60)
+
+    @staticmethod
+    def refill_wait(level: float, limit: int, cost: int) -> float:
+        """Get the seconds for a bucket to refill to the cost
+
+        A cost larger than the limit waits for a full bucket.
+        """
+        return max(min(cost, limit) - level, 0) * 60 / limit
+
+    def settle(
+        self,
+        provider: enums.LlmProvider,
+        component_id: int,
+        reserved: int,
+        used: int,
+    ):
+        """Settle the tokens reserved by a call with the tokens used"""
+        if reserved == used:
+            return
+
+        keys = [
+            key
+            for key, _, is_tokens in self.budgets(
+                provider, self.user_id(component_id)
+            )
+            if is_tokens
+        ]
+        if not keys:
+            return
+
+        models.RateLimitBucket.objects.filter(key__in=keys).update(
+            level=F("level") + (reserved - used)
+        )
+
+    def block(self, provider: enums.LlmProvider, seconds: float):
+        """Block the calls to the provider for the given seconds"""
+        with self.lock:
+            self.blocked += 1
+            self.blocked_until[provider] = max(
+                self.blocked_until.get(provider, 0.0),
+                time.monotonic() + seconds,
+            )
+
+        until = timezone.now() + timedelta(seconds=seconds)
+        models.RateLimitBucket.objects.filter(
+            Q(blocked_until__isnull=True) | Q(blocked_until__lt=until),
+            key__startswith=f"{provider}:",
+        ).update(blocked_until=until)
+
+    def blocked_for(self, provider: enums.LlmProvider) -> float:
+        """Get the seconds the calls to the provider are blocked for"""
+        with self.lock:
+            return self.blocked_until.get(provider, 0.0) - time.monotonic()
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the gateway"""
+        waiting = len(self.queue)
+
+        with self.lock:
+            return {
+                "waiting": waiting,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+                "retried": self.retried,
+                "blocked": self.blocked,
+            }
+
+
+llm_gateway = LlmGateway()
@@ -0,0 +1,513 @@
+import functools
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from config.conductor import conductor_config
+from config.containment import containment_config
+from core import enums, models
+from engine.containment import containment
+
+from . import exceptions
+
+# The events of a run, see `Containment.run_pipeline_stream`, followed by a
+# `("finished", None)` event
+Send = Callable[[str, Any], None]
+
+# The number of heartbeats missed before a job is considered stale
+STALE_HEARTBEATS = 3
+
+
+class ChatJobQueue:
+    """Queue running the chat jobs in a bounded pool of workers.
+
+    The jobs are stored in the database, so they can be polled from any
+    server process, while they are run by the pool of the process they were
+    submitted to.
+
+    The pool has at least a worker for each run allowed by the scheduler of
+    the containers. The jobs take a worker in a round-robin order of the
+    users, and a user takes at most as many workers as the runs it is
+    allowed, so the jobs of a user with many jobs do not hold the workers
+    waiting for its own runs while the jobs of the other users are pending.
+
+    Each process keeps the heartbeat of its jobs. The jobs whose process
+    stopped, e.g. by a restart of the server, are recovered by the other
+    processes, or by the process when it starts again: the pending jobs are
+    run again and the running jobs are failed.
+    """
+
+    logger: logging.Logger
+    workers: int
+    executor: ThreadPoolExecutor
+    lock: threading.Lock
+    events: Dict[int, threading.Event]
+    queues: "OrderedDict[int, Deque[Callable[[], None]]]"
+    user_running: Dict[int, int]
+    dispatched: int
+    id: str
+    thread: Optional[threading.Thread]
+    pid: Optional[int]
+    pending: int
+    running: int
+    succeeded: int
+    failed: int
+
+    def __init__(self):
+        """Initialize the queue"""
+        self.logger = logging.getLogger(__name__)
+        self.workers = max(
+            conductor_config.chat_job_workers, containment_config.max_runs
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="chat-job",
+        )
+        self.lock = threading.Lock()
+        self.events = {}
+        self.queues = OrderedDict()
+        self.user_running = {}
+        self.dispatched = 0
+        self.id = uuid.uuid4().hex
+        self.thread = None
+        self.pid = None
+        self.pending = 0
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def runner(self) -> str:
+        """Get the runner of the jobs of this process"""
+        return f"{self.id}:{os.getpid()}"
+
+    def submit(
+        self,
+        pipeline: models.Pipeline,
+        user_message: str,
+        send: Optional[Send] = None,
+    ) -> models.ChatJob:
+        """Submit a chat job for the given pipeline
+
+        If send is given, the events of the run are sent to it as they are
+        produced, see `Send`.
+
+        Raises:
+            ChatJobQueueFullException: If too many jobs are pending.
+        """
+        self.start()
+        self.reserve()
+
+        try:
+            job = models.ChatJob.objects.create(
+                pipeline=pipeline,
+                user_message=user_message,
+                runner=self.runner(),
+                heartbeat_at=timezone.now(),
+            )
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        with self.lock:
+            self.events[job.id] = threading.Event()
+
+        self.dispatch(
+            pipeline.user_id, functools.partial(self.run, job.id, send)
+        )
+
+        return job
+
+    def submit_batch(
+        self,
+        pipeline: models.Pipeline,
+        user_messages: List[str],
+        parallel: int = 1,
+    ) -> List[models.ChatJob]:
+        """Submit a chat job for each message, run as one batch
+
+        The batch takes one worker and is counted as one job, see
+        `Containment.run_pipeline_batch`. The jobs finish together.
+
+        Raises:
+            ChatJobQueueFullException: If too many jobs are pending.
+        """
+        self.start()
+        self.reserve()
+
+        try:
+            now = timezone.now()
+            jobs = models.ChatJob.objects.bulk_create(
+                [
+                    models.ChatJob(
+                        pipeline=pipeline,
+                        user_message=user_message,
+                        runner=self.runner(),
+                        heartbeat_at=now,
+                    )
+                    for user_message in user_messages
+                ]
+            )
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+        job_ids = [job.id for job in jobs]
+
+        with self.lock:
+            for job_id in job_ids:
+                self.events[job_id] = threading.Event()
+
+        self.dispatch(
+            pipeline.user_id,
+            functools.partial(self.run_batch, job_ids, parallel),
+        )
+
+        return jobs
+
+    def dispatch(self, user_id: int, task: Callable[[], None]):
+        """Queue the task of the given user to take a worker"""
+        with self.lock:
+            self.queues.setdefault(user_id, deque()).append(task)
+
+        self.schedule()
+
+    def schedule(self):
+        """Give the free workers to the queued tasks
+
+        The first user in the round-robin order below its limit of runs
+        takes each free worker, and is moved to the back of the order.
+        """
+        with self.lock:
+            while self.dispatched < self.workers:
+                user_id = next(
+                    (
+                        user_id
+                        for user_id in self.queues
+                        if self.user_running.get(user_id, 0)
+                        < containment_config.max_user_runs
+                    ),
+                    None,
+                )
+                if user_id is None:
+                    return
+
+                queue = self.queues[user_id]
+                task = queue.popleft()
+                if queue:
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+
+                self.dispatched += 1
+                self.user_running[user_id] = (
+                    self.user_running.get(user_id, 0) + 1
+                )
+                self.executor.submit(self.work, user_id, task)
+
+    def work(self, user_id: int, task: Callable[[], None]):
+        """Run the task of the given user, then give its worker away"""
+        try:
+            task()
+        finally:
+            with self.lock:
+                self.dispatched -= 1
+                self.user_running[user_id] -= 1
+                if self.user_running[user_id] == 0:
+                    del self.user_running[user_id]
+
+            self.schedule()
+
+    def reserve(self):
+        """Reserve a pending job
+
+        Raises:
+            ChatJobQueueFullException: If too many jobs are pending.
+        """
+        with self.lock:
+            if self.pending >= conductor_config.chat_job_max_pending:
+                raise exceptions.ChatJobQueueFullException()
+
+            self.pending += 1
+
+    def finish(self, succeeded: bool):
+        """Count a finished job"""
+        with self.lock:
+            self.running -= 1
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def run(self, job_id: int, send: Optional[Send] = None):
+        """Run the chat job with the given ID"""
+        with self.lock:
+            self.pending -= 1
+            self.running += 1
+
+        succeeded = False
+
+        try:
+            job = models.ChatJob.objects.select_related("pipeline__user").get(
+                id=job_id
+            )
+            job.status = enums.ChatJobStatus.RUNNING
+            job.started_at = timezone.now()
+            job.save(update_fields=["status", "started_at"])
+
+            try:
+                refresh = RefreshToken.for_user(job.pipeline.user)
+                for event, data in containment.run_pipeline_stream(
+                    job.pipeline, job.user_message, refresh
+                ):
+                    if send is not None:
+                        send(event, data)
+
+                    if event == "chat":
+                        job.chat = data
+
+                job.status = enums.ChatJobStatus.SUCCEEDED
+                succeeded = True
+            except Exception as e:
+                self.logger.error(f"Chat job {job_id} failed: {e}")
+                job.status = enums.ChatJobStatus.FAILED
+                job.error = "".join(traceback.format_exception(e))
+
+            job.finished_at = timezone.now()
+            job.save(
+                update_fields=["status", "chat", "error", "finished_at"]
+            )
+        except Exception as e:
+            self.logger.error(f"Unable to run chat job {job_id}: {e}")
+        finally:
+            self.finish(succeeded)
+
+            with self.lock:
+                event = self.events.pop(job_id, None)
+
+            if event is not None:
+                event.set()
+
+            if send is not None:
+                send("finished", None)
+
+            close_old_connections()
+
+    def run_batch(self, job_ids: List[int], parallel: int):
+        """Run the chat jobs with the given IDs as one batch"""
+        with self.lock:
+            self.pending -= 1
+            self.running += 1
+
+        succeeded = False
+
+        try:
+            jobs = list(
+                models.ChatJob.objects.select_related(
+                    "pipeline__user"
+                ).filter(id__in=job_ids)
+            )
+            jobs.sort(key=lambda job: job_ids.index(job.id))
+            pipeline = jobs[0].pipeline
+
+            now = timezone.now()
+            models.ChatJob.objects.filter(id__in=job_ids).update(
+                status=enums.ChatJobStatus.RUNNING, started_at=now
+            )
+
+            try:
+                refresh = RefreshToken.for_user(pipeline.user)
+                chats = containment.run_pipeline_batch(
+                    pipeline,
+                    [job.user_message for job in jobs],
+                    refresh,
+                    parallel,
+                )
+
+                for job, chat in zip(jobs, chats):
+                    job.status = enums.ChatJobStatus.SUCCEEDED
+                    job.chat = chat
+                succeeded = True
+            except Exception as e:
+                self.logger.error(f"Chat batch {job_ids} failed: {e}")
+                error = "".join(traceback.format_exception(e))
+                for job in jobs:
+                    job.status = enums.ChatJobStatus.FAILED
+                    job.error = error
+
+            now = timezone.now()
+            for job in jobs:
+                job.finished_at = now
+
+            models.ChatJob.objects.bulk_update(
+                jobs, ["status", "chat", "error", "finished_at"]
+            )
+        except Exception as e:
+            self.logger.error(f"Unable to run chat batch {job_ids}: {e}")
+        finally:
+            self.finish(succeeded)
+
+            with self.lock:
+                events = [self.events.pop(job_id, None) for job_id in job_ids]
+
+            for event in events:
+                if event is not None:
+                    event.set()
+
+            close_old_connections()
+
+    def wait(
+        self, job: models.ChatJob, timeout: Optional[float] = None
+    ) -> models.ChatJob:
+        """Wait for the given job to finish
+
+        Jobs run by this process are waited for directly, jobs run by other
+        processes are polled from the database.
+
+        Args:
+            job (models.ChatJob): The job.
+            timeout (Optional[float]): The maximum time to wait in seconds,
+                or None to wait until the job is finished.
+
+        Returns:
+            models.ChatJob: The refreshed job.
+        """
+        with self.lock:
+            event = self.events.get(job.id)
+
+        if event is not None:
+            event.wait(timeout)
+            job.refresh_from_db()
+            return job
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = 0.05
+
+        while True:
+            job.refresh_from_db()
+            if job.is_finished():
+                return job
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+
+            time.sleep(interval)
+            interval = min(interval * 2, 1.0)
+
+    def wait_all(
+        self, jobs: List[models.ChatJob], timeout: float
+    ) -> List[models.ChatJob]:
+        """Wait for the given jobs to finish within one timeout
+
+        Returns:
+            List[models.ChatJob]: The refreshed jobs.
+        """
+        deadline = time.monotonic() + timeout
+
+        return [
+            self.wait(job, max(deadline - time.monotonic(), 0.0))
+            for job in jobs
+        ]
+
+    def start(self):
+        """Start the thread of the process if it is not running"""
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+
+            # The thread is not inherited by forked processes
+            self.thread = threading.Thread(
+                target=self.loop, name="chat-job-heartbeat", daemon=True
+            )
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def loop(self):
+        """Keep the heartbeat of the jobs and recover the stale jobs"""
+        while True:
+            try:
+                self.heartbeat()
+                self.recover()
+            except Exception as e:
+                self.logger.error(f"Unable to recover chat jobs: {e}")
+            finally:
+                close_old_connections()
+
+            time.sleep(conductor_config.chat_job_heartbeat_interval)
+
+    def heartbeat(self):
+        """Keep the heartbeat of the unfinished jobs of this process"""
+        models.ChatJob.objects.filter(
+            runner=self.runner(),
+            status__in=[
+                enums.ChatJobStatus.PENDING,
+                enums.ChatJobStatus.RUNNING,
+            ],
+        ).update(heartbeat_at=timezone.now())
+
+    def recover(self):
+        """Recover the jobs whose process stopped
+
+        The pending jobs are claimed by this process to be run again, and the
+        running jobs are failed, as they may have had side effects.
+        """
+        now = timezone.now()
+        stale = now - timedelta(
+            seconds=conductor_config.chat_job_heartbeat_interval
+            * STALE_HEARTBEATS
+        )
+        is_stale = Q(heartbeat_at__lt=stale) | Q(heartbeat_at__isnull=True)
+
+        failed = models.ChatJob.objects.filter(
+            is_stale, status=enums.ChatJobStatus.RUNNING
+        ).update(
+            status=enums.ChatJobStatus.FAILED,
+            error="The chat job was interrupted by a stop of the server.",
+            finished_at=now,
+        )
+        if failed:
+            self.logger.warning(f"Failed {failed} interrupted chat jobs")
+
+        for job_id, user_id in models.ChatJob.objects.filter(
+            is_stale, status=enums.ChatJobStatus.PENDING
+        ).values_list("id", "pipeline__user_id"):
+            # Only one process claims each job
+            if not models.ChatJob.objects.filter(
+                is_stale, id=job_id, status=enums.ChatJobStatus.PENDING
+            ).update(runner=self.runner(), heartbeat_at=now):
+                continue
+
+            self.logger.warning(f"Requeuing pending chat job {job_id}")
+
+            with self.lock:
+                self.pending += 1
+                self.events[job_id] = threading.Event()
+
+            self.dispatch(user_id, functools.partial(self.run, job_id))
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the queue"""
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "running": self.running,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+            }
+
+
+chat_job_queue = ChatJobQueue()
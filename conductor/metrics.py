@@ -0,0 +1,56 @@
+import math
+from typing import Any, Dict, List
+
+from core import models
+
+PERCENTILES = (50, 90, 99)
+FIELDS = ("wall_time", "cpu_time", "peak_memory", "calls", "call_latency")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Get the percentile of the sorted values by the nearest rank"""
+    if not values:
+        return 0.0
+
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Get the percentiles and the maximum of the values"""
+    values = sorted(values)
+
+    return {
+        **{f"p{q}": percentile(values, q) for q in PERCENTILES},
+        "max": values[-1] if values else 0.0,
+    }
+
+
+def component_metrics(
+    pipeline: models.Pipeline, window: int
+) -> List[Dict[str, Any]]:
+    """Get the percentiles of the metrics of the pipeline components
+
+    Only the latest `window` metrics of each component are summarized.
+    """
+    results = []
+
+    for component in pipeline.get_components():
+        metrics = list(
+            models.ComponentMetric.objects.filter(component=component)
+            .order_by("-created_at")
+            .values(*FIELDS)[:window]
+        )
+
+        results.append(
+            {
+                "id": component.id,
+                "name": component.name,
+                "count": len(metrics),
+                **{
+                    field: summarize([metric[field] for metric in metrics])
+                    for field in FIELDS
+                },
+            }
+        )
+
+    return results
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 
-from core import models
+from config.conductor import conductor_config
+from core import enums, models
+from utils import json_patch
 
 
 class ConductorPipelinesSerializer(serializers.ModelSerializer):
@@ -20,7 +22,13 @@ class ConductorPipelineAttributesSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.Pipeline
-        fields = ("response", "state", "description")
+        fields = (
+            "response",
+            "state",
+            "description",
+            "is_parallel",
+            "executor",
+        )
 
 
 class ConductorPipelineNewSerializer(serializers.ModelSerializer):
@@ -68,6 +76,7 @@ class ConductorComponentSerializer(serializers.ModelSerializer):
             "description",
             "code",
             "state",
+            "is_cacheable",
             "is_template",
             "created_at",
         )
@@ -176,6 +185,7 @@ class ConductorPipelineSaveComponentInstanceSerializer(serializers.Serializer):
     description = serializers.CharField(required=True, allow_blank=True)
     code = serializers.CharField(required=True, allow_blank=True)
     state = serializers.JSONField(required=True)
+    is_cacheable = serializers.BooleanField(required=False)
 
 
 class ConductorPipelineSaveSerializer(serializers.Serializer):
@@ -185,6 +195,10 @@ class ConductorPipelineSaveSerializer(serializers.Serializer):
     response = serializers.CharField(required=True, allow_blank=True)
     state = serializers.JSONField(required=True)
     description = serializers.CharField(required=True, allow_blank=True)
+    is_parallel = serializers.BooleanField(required=False)
+    executor = serializers.ChoiceField(
+        choices=enums.Executor.choices(), required=False
+    )
     components = ConductorPipelineSaveComponentInstanceSerializer(
         many=True, required=True
     )
@@ -248,6 +262,85 @@ class ConductorChatSendSerializer(serializers.Serializer):
     exit_code = serializers.IntegerField(read_only=True)
 
 
+class ConductorChatStreamSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStreamView"""
+
+    user_message = serializers.CharField(required=True)
+
+
+class ConductorChatBatchChatSerializer(serializers.ModelSerializer):
+    """Serializer for the ConductorChatBatchView"""
+
+    class Meta:
+        model = models.Chat
+        fields = (
+            "id",
+            "user_message",
+            "resp_message",
+            "exit_code",
+            "created_at",
+        )
+        read_only_fields = fields
+
+
+class ConductorChatBatchSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatBatchView"""
+
+    user_messages = serializers.ListField(
+        child=serializers.CharField(allow_blank=True),
+        allow_empty=False,
+        max_length=conductor_config.chat_batch_max_size,
+        write_only=True,
+    )
+    parallel = serializers.IntegerField(
+        min_value=1,
+        max_value=conductor_config.chat_batch_max_parallel,
+        default=1,
+        write_only=True,
+    )
+    chats = ConductorChatBatchChatSerializer(many=True, read_only=True)
+
+
+class ConductorChatSubmitSerializer(serializers.ModelSerializer):
+    """Serializer for the ConductorChatSubmitView"""
+
+    class Meta:
+        model = models.ChatJob
+        fields = (
+            "id",
+            "user_message",
+            "status",
+            "created_at",
+        )
+        read_only_fields = ("id", "status", "created_at")
+
+
+class ConductorChatJobSerializer(serializers.ModelSerializer):
+    """Serializer for the ConductorChatJobView"""
+
+    resp_message = serializers.CharField(
+        source="chat.resp_message", read_only=True, allow_null=True
+    )
+    exit_code = serializers.IntegerField(
+        source="chat.exit_code", read_only=True, allow_null=True
+    )
+
+    class Meta:
+        model = models.ChatJob
+        fields = (
+            "id",
+            "user_message",
+            "status",
+            "resp_message",
+            "exit_code",
+            "error",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+        read_only_fields = fields
+
+
 class ConductorChatHistorySerializer(serializers.ModelSerializer):
     """Serializer for the ConductorChatHistoryView"""
 
@@ -262,12 +355,26 @@ class ConductorChatHistorySerializer(serializers.ModelSerializer):
         )
 
 
+class ConductorChatComponentMetricSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatSaveChatView"""
+
+    id = serializers.IntegerField(required=True)
+    wall_time = serializers.FloatField(required=True, min_value=0)
+    cpu_time = serializers.FloatField(required=True, min_value=0)
+    peak_memory = serializers.IntegerField(required=True, min_value=0)
+    calls = serializers.IntegerField(required=True, min_value=0)
+    call_latency = serializers.FloatField(required=True, min_value=0)
+
+
 class ConductorChatSaveChatSerializer(serializers.Serializer):
     """Serializer for the ConductorChatSaveChatView"""
 
     user_message = serializers.CharField(required=True)
     resp_message = serializers.CharField(required=True)
     exit_code = serializers.IntegerField(required=True)
+    metrics = ConductorChatComponentMetricSerializer(
+        many=True, required=False
+    )
 
 
 class ConductorChatComponentStateSerializer(serializers.ModelSerializer):
@@ -290,20 +397,171 @@ class ConductorChatStatesSerializer(serializers.Serializer):
     pipeline_state = serializers.JSONField(required=True)
 
 
+class ConductorChatStatePatchOperationSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    op = serializers.ChoiceField(choices=json_patch.OPS, required=True)
+    path = serializers.CharField(
+        required=True, allow_blank=True, trim_whitespace=False
+    )
+    value = serializers.JSONField(required=False, allow_null=True)
+
+    def validate_path(self, value: str) -> str:
+        """Validate the path is a JSON pointer"""
+        if value and not value.startswith("/"):
+            raise serializers.ValidationError("path must be a JSON pointer")
+
+        return value
+
+    def validate(self, attrs):
+        """Validate the operation has a value unless it is a remove"""
+        if attrs["op"] != "remove" and "value" not in attrs:
+            raise serializers.ValidationError(
+                {"value": f"operation {attrs['op']} must have a value"}
+            )
+
+        return attrs
+
+
+class ConductorChatComponentStatePatchSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    id = serializers.IntegerField(required=True)
+    patch = ConductorChatStatePatchOperationSerializer(
+        many=True, required=True
+    )
+
+
+class ConductorChatStatesPatchesSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    component_states = ConductorChatComponentStatePatchSerializer(
+        many=True, required=True
+    )
+    pipeline_state = ConductorChatStatePatchOperationSerializer(
+        many=True, required=True
+    )
+
+
+class ConductorChatStateOpSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    op = serializers.ChoiceField(
+        choices=("set", "delete", "incr", "append"), required=True
+    )
+    key = serializers.CharField(
+        required=True, allow_blank=True, trim_whitespace=False
+    )
+    value = serializers.JSONField(required=False, allow_null=True)
+
+    def validate(self, attrs):
+        """Validate the operation has a value unless it is a delete"""
+        if attrs["op"] != "delete" and "value" not in attrs:
+            raise serializers.ValidationError(
+                {"value": f"operation {attrs['op']} must have a value"}
+            )
+
+        return attrs
+
+
+class ConductorChatComponentStateOpsSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    id = serializers.IntegerField(required=True)
+    ops = ConductorChatStateOpSerializer(many=True, required=True)
+
+
+class ConductorChatStatesOpsSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    component_states = ConductorChatComponentStateOpsSerializer(
+        many=True, required=True
+    )
+    pipeline_state = ConductorChatStateOpSerializer(many=True, required=True)
+
+
+class ConductorChatStatesPatchSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatStatesView"""
+
+    patches = ConductorChatStatesPatchesSerializer(allow_null=True)
+    ops = ConductorChatStatesOpsSerializer(allow_null=True)
+
+
+class ConductorComponentCacheSerializer(serializers.Serializer):
+    """Serializer for the ConductorComponentCacheView"""
+
+    key = serializers.CharField(required=True, max_length=64)
+    value = serializers.JSONField(required=False, allow_null=True)
+    hit = serializers.BooleanField(read_only=True)
+
+
+class ConductorPipelineCacheSerializer(serializers.Serializer):
+    """Serializer for the ConductorPipelineCacheView"""
+
+    id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(read_only=True)
+    is_cacheable = serializers.BooleanField(read_only=True)
+    hits = serializers.IntegerField(read_only=True)
+    misses = serializers.IntegerField(read_only=True)
+    hit_rate = serializers.FloatField(read_only=True)
+    entries = serializers.IntegerField(read_only=True)
+
+
+class ConductorPipelineMetricsSummarySerializer(serializers.Serializer):
+    """Serializer for the ConductorPipelineMetricsSerializer"""
+
+    p50 = serializers.FloatField(read_only=True)
+    p90 = serializers.FloatField(read_only=True)
+    p99 = serializers.FloatField(read_only=True)
+    max = serializers.FloatField(read_only=True)
+
+
+class ConductorPipelineMetricsSerializer(serializers.Serializer):
+    """Serializer for the ConductorPipelineMetricsView"""
+
+    id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(read_only=True)
+    count = serializers.IntegerField(read_only=True)
+    wall_time = ConductorPipelineMetricsSummarySerializer(read_only=True)
+    cpu_time = ConductorPipelineMetricsSummarySerializer(read_only=True)
+    peak_memory = ConductorPipelineMetricsSummarySerializer(read_only=True)
+    calls = ConductorPipelineMetricsSummarySerializer(read_only=True)
+    call_latency = ConductorPipelineMetricsSummarySerializer(read_only=True)
+
+
 class ConductorChatOaiChatcmplSerializer(serializers.Serializer):
     """Serializer for the ConductorChatOaiChatcmplView"""
 
     request = serializers.JSONField(required=True)
+    cache = serializers.BooleanField(default=False)
     response = serializers.JSONField(read_only=True)
 
 
+class ConductorChatOaiChatcmplStreamSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatOaiChatcmplStreamView"""
+
+    request = serializers.JSONField(required=True)
+
+
 class ConductorChatVaiGeminiProSerializer(serializers.Serializer):
     """Serializer for the ConductorChatVaiGeminiProView"""
 
     request = serializers.JSONField(required=True)
+    cache = serializers.BooleanField(default=False)
     response = serializers.JSONField(read_only=True)
 
 
+class ConductorChatLlmCacheSerializer(serializers.Serializer):
+    """Serializer for the ConductorChatLlmCacheView"""
+
+    provider = serializers.CharField(read_only=True)
+    hits = serializers.IntegerField(read_only=True)
+    misses = serializers.IntegerField(read_only=True)
+    hit_rate = serializers.FloatField(read_only=True)
+    tokens_saved = serializers.IntegerField(read_only=True)
+    entries = serializers.IntegerField(read_only=True)
+
+
 class ConductorAdminWhitelistSerializer(serializers.Serializer):
     """Serializer for the ConductorAdminWhitelistView"""
 
@@ -346,3 +604,69 @@ class ConductorAdminTokenUsageSerializer(serializers.Serializer):
 
     username = serializers.CharField(read_only=True)
     usage = ConductorAdminTokenUsageUserSerializer(read_only=True)
+
+
+class ConductorAdminStatsDependencyCacheSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    hits = serializers.IntegerField(read_only=True)
+    misses = serializers.IntegerField(read_only=True)
+    entries = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsChatJobsSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    workers = serializers.IntegerField(read_only=True)
+    pending = serializers.IntegerField(read_only=True)
+    running = serializers.IntegerField(read_only=True)
+    succeeded = serializers.IntegerField(read_only=True)
+    failed = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsContainersSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    active = serializers.IntegerField(read_only=True)
+    hibernated = serializers.IntegerField(read_only=True)
+    pool = serializers.IntegerField(read_only=True)
+    memory_saved = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsSchedulerSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    running = serializers.IntegerField(read_only=True)
+    waiting = serializers.IntegerField(read_only=True)
+    users = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsAuditSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    pending = serializers.IntegerField(read_only=True)
+    written = serializers.IntegerField(read_only=True)
+    failed = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsLlmGatewaySerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    waiting = serializers.IntegerField(read_only=True)
+    throttled = serializers.IntegerField(read_only=True)
+    rejected = serializers.IntegerField(read_only=True)
+    retried = serializers.IntegerField(read_only=True)
+    blocked = serializers.IntegerField(read_only=True)
+
+
+class ConductorAdminStatsSerializer(serializers.Serializer):
+    """Serializer for the ConductorAdminStatsView"""
+
+    dependency_cache = ConductorAdminStatsDependencyCacheSerializer(
+        read_only=True
+    )
+    chat_jobs = ConductorAdminStatsChatJobsSerializer(read_only=True)
+    containers = ConductorAdminStatsContainersSerializer(read_only=True)
+    scheduler = ConductorAdminStatsSchedulerSerializer(read_only=True)
+    audit = ConductorAdminStatsAuditSerializer(read_only=True)
+    llm_gateway = ConductorAdminStatsLlmGatewaySerializer(read_only=True)
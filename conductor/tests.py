@@ -0,0 +1,167 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from config.containment import containment_config
+
+from .gateway import FairQueue, LlmGateway
+from .jobs import ChatJobQueue
+
+
+class FairQueueTests(SimpleTestCase):
+    """Tests of the order of the calls waiting in the fair queue"""
+
+    def test_calls_of_a_user_are_in_order(self):
+        """The calls of a user take their turns in the order they arrived"""
+        queue = FairQueue()
+        first, second = object(), object()
+
+        queue.join(1, first)
+        queue.join(1, second)
+
+        self.assertIs(queue.head(), first)
+        queue.leave(1, first)
+        self.assertIs(queue.head(), second)
+        queue.leave(1, second)
+        self.assertIsNone(queue.head())
+
+    def test_users_take_turns(self):
+        """The users take turns, one call each"""
+        queue = FairQueue()
+        a1, a2, a3, b1, b2 = (object() for _ in range(5))
+
+        for user_id, ticket in ((1, a1), (1, a2), (1, a3), (2, b1), (2, b2)):
+            queue.join(user_id, ticket)
+
+        order = []
+        while queue.head() is not None:
+            ticket = queue.head()
+            order.append(ticket)
+            queue.leave(1 if ticket in (a1, a2, a3) else 2, ticket)
+
+        self.assertEqual(order, [a1, b1, a2, b2, a3])
+        self.assertEqual(len(queue), 0)
+
+    def test_paused_call_gives_the_turn(self):
+        """A paused call lets the other users take their turns"""
+        queue = FairQueue()
+        a, b = object(), object()
+
+        queue.join(1, a)
+        queue.join(2, b)
+        self.assertIs(queue.head(), a)
+
+        queue.pause(1, a)
+        self.assertIs(queue.head(), b)
+        self.assertFalse(queue.wait(a, 0.01))
+
+        queue.resume(a)
+        queue.leave(2, b)
+        self.assertIs(queue.head(), a)
+        self.assertTrue(queue.wait(a, 0.01))
+
+    def test_paused_call_holds_back_its_user(self):
+        """A paused call keeps its place among the calls of its user"""
+        queue = FairQueue()
+        a1, a2 = object(), object()
+
+        queue.join(1, a1)
+        queue.join(1, a2)
+        queue.pause(1, a1)
+
+        self.assertIsNone(queue.head())
+        self.assertEqual(len(queue), 2)
+
+
+class LlmGatewayRefillTests(SimpleTestCase):
+    """Tests of the refill of the token buckets of the gateway"""
+
+    def test_refill_at_the_limit_per_minute(self):
+        """The buckets refill at the limit per minute"""
+        self.assertEqual(LlmGateway.refill(0, 60, 30), 30)
+        self.assertEqual(LlmGateway.refill(10, 600, 1), 20)
+
+    def test_refill_up_to_the_limit(self):
+        """The buckets refill up to the limit"""
+        self.assertEqual(LlmGateway.refill(50, 60, 30), 60)
+        self.assertEqual(LlmGateway.refill(0, 60, 3600), 60)
+
+    def test_refill_ignores_clock_skew(self):
+        """The buckets do not drain if the clock goes back"""
+        self.assertEqual(LlmGateway.refill(10, 60, -5), 10)
+
+    def test_refill_repays_debt(self):
+        """The buckets taken below empty refill from below empty"""
+        self.assertEqual(LlmGateway.refill(-30, 60, 30), 0)
+
+    def test_no_wait_with_enough(self):
+        """A call does not wait if the bucket has enough"""
+        self.assertEqual(LlmGateway.refill_wait(40, 60, 30), 0)
+        self.assertEqual(LlmGateway.refill_wait(30, 60, 30), 0)
+
+    def test_wait_for_the_missing_cost(self):
+        """A call waits for the bucket to refill to its cost"""
+        self.assertEqual(LlmGateway.refill_wait(0, 60, 30), 30)
+        self.assertEqual(LlmGateway.refill_wait(-60, 60, 1), 61)
+
+    def test_wait_for_a_full_bucket_over_the_limit(self):
+        """A call costing more than the limit waits for a full bucket"""
+        self.assertEqual(LlmGateway.refill_wait(0, 60, 120), 60)
+
+
+class ChatJobQueueDispatchTests(SimpleTestCase):
+    """Tests of the order the jobs take the workers of the queue"""
+
+    def setUp(self):
+        """Create the queue with a blocking task for each job"""
+        self.queue = ChatJobQueue()
+        self.release = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        """Release the tasks and stop the queue"""
+        self.release.set()
+        self.queue.executor.shutdown(wait=True)
+
+    def task(self, name: str):
+        """Get a task recording its start and blocking until released"""
+
+        def run():
+            with self.lock:
+                self.started.append(name)
+            self.release.wait(5)
+
+        return run
+
+    def test_user_takes_at_most_its_runs(self):
+        """The jobs of a user beyond its runs wait without a worker"""
+        runs = containment_config.max_user_runs
+
+        for i in range(runs + 2):
+            self.queue.dispatch(1, self.task(f"a{i}"))
+
+        self.assertEqual(self.queue.dispatched, runs)
+        self.assertEqual(len(self.queue.queues[1]), 2)
+
+    def test_other_users_are_not_blocked(self):
+        """A job of another user takes a worker before the queued jobs"""
+        runs = containment_config.max_user_runs
+
+        for i in range(runs + 2):
+            self.queue.dispatch(1, self.task(f"a{i}"))
+        self.queue.dispatch(2, self.task("b0"))
+
+        self.assertEqual(self.queue.dispatched, runs + 1)
+        self.assertNotIn(2, self.queue.queues)
+
+    def test_finished_job_gives_its_worker(self):
+        """The next job of the user takes the worker of a finished job"""
+        done = threading.Event()
+
+        self.queue.dispatch(1, done.set)
+        done.wait(5)
+        self.queue.executor.shutdown(wait=True)
+
+        self.assertEqual(self.queue.dispatched, 0)
+        self.assertEqual(self.queue.user_running, {})
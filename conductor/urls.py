@@ -72,11 +72,26 @@ urlpatterns = [
         views.ConductorComponentSearchView.as_view(),
         name="conductor-component-search",
     ),
+    path(
+        "component/cache/<int:pk>/",
+        views.ConductorComponentCacheView.as_view(),
+        name="conductor-component-cache",
+    ),
     path(
         "pipeline/save/<int:pk>/",
         views.ConductorPipelineSaveView.as_view(),
         name="conductor-pipeline-save",
     ),
+    path(
+        "pipeline/cache/<int:pk>/",
+        views.ConductorPipelineCacheView.as_view(),
+        name="conductor-pipeline-cache",
+    ),
+    path(
+        "pipeline/metrics/<int:pk>/",
+        views.ConductorPipelineMetricsView.as_view(),
+        name="conductor-pipeline-metrics",
+    ),
     path(
         "pipeline/download/<int:pk>/<archive:archive_type>/",
         views.ConductorPipelineDownloadView.as_view(),
@@ -87,6 +102,26 @@ urlpatterns = [
         views.ConductorChatSendView.as_view(),
         name="conductor-chat-send",
     ),
+    path(
+        "chat/batch/<int:pk>/",
+        views.ConductorChatBatchView.as_view(),
+        name="conductor-chat-batch",
+    ),
+    path(
+        "chat/stream/<int:pk>/",
+        views.ConductorChatStreamView.as_view(),
+        name="conductor-chat-stream",
+    ),
+    path(
+        "chat/submit/<int:pk>/",
+        views.ConductorChatSubmitView.as_view(),
+        name="conductor-chat-submit",
+    ),
+    path(
+        "chat/job/<int:pk>/",
+        views.ConductorChatJobView.as_view(),
+        name="conductor-chat-job",
+    ),
     path(
         "chat/save/chat/<int:pk>/",
         views.ConductorChatSaveChatView.as_view(),
@@ -102,11 +137,21 @@ urlpatterns = [
         views.ConductorChatOaiChatcmplView.as_view(),
         name="conductor-chat-oai-chatcmpl",
     ),
+    path(
+        "chat/oai/chatcmpl/stream/<int:pk>/",
+        views.ConductorChatOaiChatcmplStreamView.as_view(),
+        name="conductor-chat-oai-chatcmpl-stream",
+    ),
     path(
         "chat/vai/gemini-pro/<int:pk>/",
         views.ConductorChatVaiGeminiProView.as_view(),
         name="conductor-chat-vai-gemini-pro",
     ),
+    path(
+        "chat/llm-cache/",
+        views.ConductorChatLlmCacheView.as_view(),
+        name="conductor-chat-llm-cache",
+    ),
     path(
         "account/",
         views.ConductorAccountView.as_view(),
@@ -137,4 +182,9 @@ urlpatterns = [
         views.ConductorAdminTokenUsageView.as_view(),
         name="conductor-admin-token-usage",
     ),
+    path(
+        "admin/stats/",
+        views.ConductorAdminStatsView.as_view(),
+        name="conductor-admin-stats",
+    ),
 ]
@@ -1,7 +1,11 @@
+import json
 import logging
+import queue
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
+from django.db import transaction
 from django.db.models import Q, Sum
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from drf_spectacular.utils import (
     OpenApiParameter,
     extend_schema,
@@ -12,17 +16,23 @@ from pydantic import ValidationError
 from rest_framework import generics
 from rest_framework import permissions as rest_permissions
 from rest_framework import views, viewsets
-from rest_framework_simplejwt.tokens import RefreshToken
 
 import engine.modules.oai
 import engine.modules.vai
 import oai.models as oai_models
 import vai.models as vai_models
-from core import models
+from config.conductor import conductor_config
+from config.containment import containment_config
+from core import enums, models
 from engine.containment import ContainmentArchiveType, containment
 from rest_auth import permissions
 
 from . import exceptions, pagination, serializers
+from .audit import audit_writer
+from .cache import component_result_cache, llm_response_cache
+from .gateway import llm_gateway
+from .jobs import chat_job_queue
+from .metrics import component_metrics
 
 
 class ConductorPipelinesView(
@@ -324,6 +334,17 @@ class ConductorPipelineSaveView(views.APIView):
         pipeline.response = serializer.validated_data["response"]
         pipeline.state = serializer.validated_data["state"]
         pipeline.description = serializer.validated_data["description"]
+        pipeline.is_parallel = serializer.validated_data.get(
+            "is_parallel", pipeline.is_parallel
+        )
+        executor = serializer.validated_data.get(
+            "executor", pipeline.executor
+        )
+        if executor != pipeline.executor and not request.user.is_staff:
+            raise exceptions.BadArgumentsException(
+                "Only admins can change the executor of a pipeline."
+            )
+        pipeline.executor = executor
         pipeline.save()
 
         # For each component, save them
@@ -344,6 +365,9 @@ class ConductorPipelineSaveView(views.APIView):
             component_instance.component.description = component["description"]
             component_instance.component.code = component["code"]
             component_instance.component.state = component["state"]
+            component_instance.component.is_cacheable = component.get(
+                "is_cacheable", component_instance.component.is_cacheable
+            )
             component_instance.component.save()
 
         return views.Response(serializer.data)
@@ -489,11 +513,20 @@ class ConductorChatSendView(
             user=request.user
         ).get(id=pk)
 
-        refresh: RefreshToken = RefreshToken.for_user(request.user)
-        containment.run_pipeline(pipeline, user_message, refresh)
+        job = chat_job_queue.submit(pipeline, user_message)
+        job = chat_job_queue.wait(job, conductor_config.chat_job_max_wait)
 
-        # Get the newest response
-        chat: models.Chat = pipeline.chat_set.order_by("-created_at").first()
+        # The job is left to be polled if it takes too long
+        if not job.is_finished():
+            return views.Response(
+                serializers.ConductorChatJobSerializer(job).data,
+                status=views.status.HTTP_202_ACCEPTED,
+            )
+
+        if job.status != enums.ChatJobStatus.SUCCEEDED or job.chat is None:
+            raise exceptions.ChatJobFailedException()
+
+        chat: models.Chat = job.chat
         response = {
             "user_message": chat.user_message,
             "resp_message": chat.resp_message,
@@ -503,6 +536,228 @@ class ConductorChatSendView(
         return views.Response(response)
 
 
+class ConductorChatBatchView(
+    views.APIView,
+):
+    """View to run the chat of a pipeline with many messages at once
+
+    The pipeline is prepared once, and all messages are run by one process
+    in the container, optionally in parallel. A chat job is submitted for
+    each message, which are returned to be polled if the batch takes too
+    long.
+    """
+
+    serializer_class = serializers.ConductorChatBatchSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def post(self, request: views.Request, pk: int, *args, **kwargs):
+        """Run the chats"""
+        serializer: serializers.ConductorChatBatchSerializer = (
+            self.serializer_class(data=request.data)
+        )
+        serializer.is_valid(raise_exception=True)
+        user_messages: List[str] = serializer.validated_data["user_messages"]
+        parallel: int = serializer.validated_data["parallel"]
+
+        pipeline: models.Pipeline = models.Pipeline.objects.filter(
+            user=request.user
+        ).get(id=pk)
+
+        jobs = chat_job_queue.submit_batch(pipeline, user_messages, parallel)
+        jobs = chat_job_queue.wait_all(
+            jobs, conductor_config.chat_job_max_wait
+        )
+
+        # The jobs are left to be polled if the batch takes too long
+        if not all(job.is_finished() for job in jobs):
+            return views.Response(
+                {
+                    "jobs": serializers.ConductorChatJobSerializer(
+                        jobs, many=True
+                    ).data
+                },
+                status=views.status.HTTP_202_ACCEPTED,
+            )
+
+        if any(
+            job.status != enums.ChatJobStatus.SUCCEEDED or job.chat is None
+            for job in jobs
+        ):
+            raise exceptions.ChatJobFailedException()
+
+        serializer = self.serializer_class(
+            {"chats": [job.chat for job in jobs]}
+        )
+        return views.Response(serializer.data)
+
+
+class ConductorChatStreamView(
+    views.APIView,
+):
+    """View to run the chat of a pipeline, streaming the output
+
+    The output of the pipeline is streamed as server-sent `output` events,
+    followed by a `result` event with the chat and the response encoded as
+    JSON, or an `error` event. The stream ends with an `error` event if no
+    event is sent by the job for longer than the run timeout and the grace
+    period, e.g. if the job was lost by a restart of the server.
+    """
+
+    serializer_class = serializers.ConductorChatStreamSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def post(self, request: views.Request, pk: int, *args, **kwargs):
+        """Run the chat"""
+        serializer: serializers.ConductorChatStreamSerializer = (
+            self.serializer_class(data=request.data)
+        )
+        serializer.is_valid(raise_exception=True)
+        user_message: str = serializer.validated_data["user_message"]
+
+        pipeline: models.Pipeline = models.Pipeline.objects.filter(
+            user=request.user
+        ).get(id=pk)
+
+        # The chat is run as a job, which sends its events to be streamed
+        events_queue: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+        chat_job_queue.submit(
+            pipeline,
+            user_message,
+            lambda event, data: events_queue.put((event, data)),
+        )
+
+        timeout = (
+            max(
+                containment_config.run_timeout,
+                containment_config.restricted_timeout,
+            )
+            + conductor_config.chat_stream_grace_period
+        )
+
+        def events() -> Generator[str, None, None]:
+            """Generate the server-sent events of the chat"""
+            response: Optional[Dict[str, Any]] = None
+            chat: Optional[models.Chat] = None
+
+            while True:
+                try:
+                    event, data = events_queue.get(timeout=timeout)
+                except queue.Empty:
+                    logger = logging.getLogger(__name__)
+                    logger.error("Unable to stream chat: chat job timed out")
+                    detail = exceptions.ChatJobFailedException.default_detail
+                    yield self.sse("error", {"detail": str(detail)})
+                    return
+
+                if event == "output":
+                    yield self.sse("output", {"data": data})
+                elif event == "response":
+                    response = data
+                elif event == "chat":
+                    chat = data
+                elif event == "finished":
+                    break
+
+            if chat is None:
+                logger = logging.getLogger(__name__)
+                logger.error("Unable to stream chat: chat is None")
+                yield self.sse(
+                    "error",
+                    {
+                        "detail": str(
+                            exceptions.ChatJobFailedException.default_detail
+                        )
+                    },
+                )
+                return
+
+            yield self.sse(
+                "result",
+                {
+                    "user_message": chat.user_message,
+                    "resp_message": chat.resp_message,
+                    "exit_code": chat.exit_code,
+                    "response": response,
+                },
+            )
+
+        return StreamingHttpResponse(
+            events(),
+            content_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            },
+        )
+
+    @staticmethod
+    def sse(event: str, data: Dict[str, Any]) -> str:
+        """Format a server-sent event"""
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ConductorChatSubmitView(
+    views.APIView,
+):
+    """View to submit a chat job of a pipeline"""
+
+    serializer_class = serializers.ConductorChatSubmitSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def post(self, request: views.Request, pk: int, *args, **kwargs):
+        """Submit the chat job"""
+        serializer: serializers.ConductorChatSubmitSerializer = (
+            self.serializer_class(data=request.data)
+        )
+        serializer.is_valid(raise_exception=True)
+        user_message: str = serializer.validated_data["user_message"]
+
+        pipeline: models.Pipeline = models.Pipeline.objects.filter(
+            user=request.user
+        ).get(id=pk)
+
+        job = chat_job_queue.submit(pipeline, user_message)
+
+        return views.Response(
+            self.serializer_class(job).data,
+            status=views.status.HTTP_202_ACCEPTED,
+        )
+
+
+@extend_schema_view(
+    get=extend_schema(
+        parameters=[
+            OpenApiParameter(name="wait", type=float),
+        ]
+    )
+)
+class ConductorChatJobView(
+    views.APIView,
+):
+    """View to get a chat job, optionally waiting for it to finish"""
+
+    serializer_class = serializers.ConductorChatJobSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def get(self, request: views.Request, pk: int, *args, **kwargs):
+        """Return the chat job"""
+        job: models.ChatJob = models.ChatJob.objects.select_related(
+            "chat"
+        ).get(id=pk, pipeline__user=request.user)
+
+        try:
+            wait = float(request.query_params.get("wait", 0))
+        except ValueError:
+            raise exceptions.BadArgumentsException("wait must be a number")
+
+        wait = min(max(wait, 0.0), conductor_config.chat_job_max_wait)
+        if wait > 0 and not job.is_finished():
+            job = chat_job_queue.wait(job, wait)
+
+        serializer = self.serializer_class(job)
+        return views.Response(serializer.data)
+
+
 @extend_schema_view(
     get=extend_schema(
         parameters=[
@@ -551,13 +806,17 @@ class ConductorChatSaveChatView(views.APIView):
 
         pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
 
-        # Save the chat
-        models.Chat.objects.create(
-            pipeline=pipeline,
-            user_message=serializer.validated_data["user_message"],
-            resp_message=serializer.validated_data["resp_message"],
-            exit_code=serializer.validated_data["exit_code"],
-        )
+        # Save the chat, with the metrics of the components if any
+        with transaction.atomic():
+            chat = models.Chat.objects.create(
+                pipeline=pipeline,
+                user_message=serializer.validated_data["user_message"],
+                resp_message=serializer.validated_data["resp_message"],
+                exit_code=serializer.validated_data["exit_code"],
+            )
+            pipeline.create_component_metrics(
+                [chat], [serializer.validated_data.get("metrics", [])]
+            )
 
         return views.Response(serializer.data)
 
@@ -583,22 +842,140 @@ class ConductorChatStatesView(views.APIView):
     def post(self, request: views.Request, pk: int, *args, **kwargs):
         """Return the chat states"""
         pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
-        components = pipeline.get_components()
+        pipeline.set_states(request.data)
 
-        component_states = request.data["component_states"]
-        pipeline_state = request.data["pipeline_state"]
+        return views.Response()
 
-        for component_state in component_states:
-            component = components.get(id=component_state["id"])
-            component.state = component_state["state"]
-            component.save()
+    def patch(self, request: views.Request, pk: int, *args, **kwargs):
+        """Patch the chat states"""
+        serializer = serializers.ConductorChatStatesPatchSerializer(
+            data=request.data
+        )
+        serializer.is_valid(raise_exception=True)
 
-        pipeline.state = pipeline_state
-        pipeline.save()
+        patches = serializer.validated_data["patches"]
+        ops = serializer.validated_data["ops"]
+
+        pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
+
+        try:
+            with transaction.atomic():
+                if patches is not None:
+                    pipeline.patch_states(patches)
+
+                if ops is not None:
+                    pipeline.apply_state_ops(ops)
+        except ValueError as e:
+            raise exceptions.BadArgumentsException(str(e))
+
+        return views.Response()
+
+
+@extend_schema_view(
+    get=extend_schema(
+        parameters=[
+            OpenApiParameter(name="key", type=str, required=True),
+        ]
+    )
+)
+class ConductorComponentCacheView(views.APIView):
+    """View to get and set the cached results of a component"""
+
+    serializer_class = serializers.ConductorComponentCacheSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def get(self, request: views.Request, pk: int, *args, **kwargs):
+        """Return the cached result of the key"""
+        key = request.query_params.get("key")
+        if not key:
+            raise exceptions.BadArgumentsException("key is required")
+
+        component = models.Component.objects.filter(user=request.user).get(
+            id=pk
+        )
+        hit, value = component_result_cache.get(component, key)
+
+        serializer = self.serializer_class(
+            {"key": key, "value": value, "hit": hit}
+        )
+        return views.Response(serializer.data)
+
+    def post(self, request: views.Request, pk: int, *args, **kwargs):
+        """Cache the result of the key"""
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        component = models.Component.objects.filter(user=request.user).get(
+            id=pk
+        )
+        component_result_cache.set(
+            component,
+            serializer.validated_data["key"],
+            serializer.validated_data.get("value"),
+        )
 
         return views.Response()
 
 
+class ConductorPipelineCacheView(views.APIView):
+    """View to get and clear the cache statistics of the components"""
+
+    serializer_class = serializers.ConductorPipelineCacheSerializer
+    permission_classes = [permissions.IsWhitelisted]
+
+    def get(self, request: views.Request, pk: int, *args, **kwargs):
+        """Return the cache statistics of the components"""
+        pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
+
+        serializer = self.serializer_class(
+            component_result_cache.stats(list(pipeline.get_components())),
+            many=True,
+        )
+        return views.Response(serializer.data)
+
+    def delete(self, request: views.Request, pk: int, *args, **kwargs):
+        """Clear the cached results of the components"""
+        pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
+        component_result_cache.clear(list(pipeline.get_components()))
+
+        return views.Response()
+
+
+@extend_schema_view(
+    get=extend_schema(
+        parameters=[
+            OpenApiParameter(name="window", type=int),
+        ]
+    )
+)
+class ConductorPipelineMetricsView(views.APIView):
+    """View to get the latency percentiles of the components"""
+
+    serializer_class = serializers.ConductorPipelineMetricsSerializer
+    permission_classes = [permissions.IsWhitelisted]
+
+    def get(self, request: views.Request, pk: int, *args, **kwargs):
+        """Return the percentiles of the metrics of the components"""
+        try:
+            window = int(
+                request.query_params.get(
+                    "window", conductor_config.component_metrics_window
+                )
+            )
+        except ValueError:
+            raise exceptions.BadArgumentsException("window must be an integer")
+
+        if window < 1:
+            raise exceptions.BadArgumentsException("window must be positive")
+
+        pipeline = models.Pipeline.objects.filter(user=request.user).get(id=pk)
+
+        serializer = self.serializer_class(
+            component_metrics(pipeline, window), many=True
+        )
+        return views.Response(serializer.data)
+
+
 class ConductorChatOaiChatcmplView(views.APIView):
     """View to call the OpenAI chat completion"""
 
@@ -624,7 +1001,9 @@ class ConductorChatOaiChatcmplView(views.APIView):
             except ValidationError as e:
                 raise exceptions.BadArgumentsException(str(e))
 
-            response = engine.modules.oai.api.chatcmpl(chatcmpl_request)
+            response = engine.modules.oai.api.chatcmpl(
+                chatcmpl_request, serializer.validated_data["cache"]
+            )
 
         if response is None:
             raise ValueError("response is None")
@@ -633,6 +1012,63 @@ class ConductorChatOaiChatcmplView(views.APIView):
         return views.Response(serializer.data)
 
 
+class ConductorChatOaiChatcmplStreamView(views.APIView):
+    """View to call the OpenAI chat completion, streaming the response
+
+    The chunks of the response are streamed as server-sent `chunk` events,
+    followed by a `done` event, or an `error` event.
+    """
+
+    serializer_class = serializers.ConductorChatOaiChatcmplStreamSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def post(self, request: views.Request, pk: int, *args, **kwargs):
+        """Call the OpenAI chat completion"""
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        component = models.Component.objects.filter(user=request.user).get(
+            id=pk
+        )
+
+        try:
+            request_args = serializer.validated_data["request"]
+            chatcmpl_request = engine.modules.oai.api.ChatcmplRequest(
+                **request_args
+            )
+        except ValidationError as e:
+            raise exceptions.BadArgumentsException(str(e))
+
+        def events() -> Generator[str, None, None]:
+            """Generate the server-sent events of the chunks"""
+            sse = ConductorChatStreamView.sse
+
+            with engine.modules.composer.init_component(component.id):
+                try:
+                    for chunk in engine.modules.oai.api.chatcmpl_stream(
+                        chatcmpl_request
+                    ):
+                        yield sse("chunk", chunk.model_dump())
+
+                    yield sse("done", {})
+                except Exception as e:
+                    logger = logging.getLogger(__name__)
+                    logger.error(f"Unable to stream chat completion: {e}")
+                    yield sse(
+                        "error",
+                        {"detail": "Unable to stream chat completion"},
+                    )
+
+        return StreamingHttpResponse(
+            events(),
+            content_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            },
+        )
+
+
 class ConductorChatVaiGeminiProView(views.APIView):
     """View to call the Gemini Pro chat"""
 
@@ -658,7 +1094,9 @@ class ConductorChatVaiGeminiProView(views.APIView):
             except ValidationError as e:
                 raise exceptions.BadArgumentsException(str(e))
 
-            response = engine.modules.vai.api.gemini_pro(gemini_pro_request)
+            response = engine.modules.vai.api.gemini_pro(
+                gemini_pro_request, serializer.validated_data["cache"]
+            )
 
         if response is None:
             raise ValueError("response is None")
@@ -669,6 +1107,26 @@ class ConductorChatVaiGeminiProView(views.APIView):
         return views.Response(serializer.data)
 
 
+class ConductorChatLlmCacheView(views.APIView):
+    """View to get and clear the statistics of the LLM response cache"""
+
+    serializer_class = serializers.ConductorChatLlmCacheSerializer
+    permission_classes = [permissions.IsWhitelisted | permissions.HasApiKey]
+
+    def get(self, request: views.Request, *args, **kwargs):
+        """Return the cache statistics of the user for each provider"""
+        serializer = self.serializer_class(
+            llm_response_cache.stats(request.user), many=True
+        )
+        return views.Response(serializer.data)
+
+    def delete(self, request: views.Request, *args, **kwargs):
+        """Clear the cached responses of the user"""
+        llm_response_cache.clear(request.user)
+
+        return views.Response()
+
+
 class ConductorAdminWhitelistView(views.APIView):
     """View for whitelisting a user"""
 
@@ -763,7 +1221,7 @@ class ConductorAdminTokenUsageView(
                 or 0
             )
 
-            # vai
+            # vai, estimated as the API reports no usage
             vai_usage = (
                 vai_models.GeminiProRequest.objects.filter(
                     component__user=user
@@ -779,3 +1237,24 @@ class ConductorAdminTokenUsageView(
             )
 
         return views.Response(response)
+
+
+class ConductorAdminStatsView(views.APIView):
+    """View for getting the statistics of the server"""
+
+    serializer_class = serializers.ConductorAdminStatsSerializer
+    permission_classes = [rest_permissions.IsAdminUser]
+
+    def get(self, request: views.Request, *args, **kwargs):
+        """Return the statistics of the server"""
+        serializer = self.serializer_class(
+            {
+                "dependency_cache": containment.dependency_cache.stats(),
+                "chat_jobs": chat_job_queue.stats(),
+                "containers": containment.lifecycle.stats(),
+                "scheduler": containment.scheduler.stats(),
+                "audit": audit_writer.stats(),
+                "llm_gateway": llm_gateway.stats(),
+            }
+        )
+        return views.Response(serializer.data)
@@ -0,0 +1,44 @@
+from pydantic import Field
+
+from . import BaseConfig
+
+
+class ConductorConfig(BaseConfig):
+    """Conductor config"""
+
+    chat_job_workers: int = Field(4)
+    chat_job_max_pending: int = Field(64)
+    chat_job_max_wait: float = Field(30.0)
+    chat_job_heartbeat_interval: float = Field(10.0)
+    chat_stream_grace_period: float = Field(60.0)
+    chat_batch_max_size: int = Field(500)
+    chat_batch_max_parallel: int = Field(8)
+    component_cache_max_entries: int = Field(256)
+    component_cache_max_value_size: int = Field(65536)
+    component_cache_ttl: float = Field(86400.0)
+    cache_touch_interval: float = Field(60.0)
+    component_metrics_window: int = Field(1000)
+    llm_cache_max_entries: int = Field(1024)
+    llm_cache_max_value_size: int = Field(262144)
+    llm_cache_ttl: float = Field(86400.0)
+    audit_batch_size: int = Field(100)
+    audit_max_pending: int = Field(1000)
+    audit_flush_interval: float = Field(1.0)
+    llm_oai_requests_per_minute: int = Field(0)
+    llm_oai_tokens_per_minute: int = Field(0)
+    llm_vai_requests_per_minute: int = Field(0)
+    llm_vai_tokens_per_minute: int = Field(0)
+    llm_user_requests_per_minute: int = Field(0)
+    llm_user_tokens_per_minute: int = Field(0)
+    llm_gateway_max_wait: float = Field(60.0)
+    llm_gateway_max_waiting: int = Field(64)
+    llm_gateway_retries: int = Field(4)
+    llm_gateway_backoff_base: float = Field(0.5)
+    llm_gateway_backoff_max: float = Field(30.0)
+
+    class Config:
+        env_prefix = "CONDUCTOR_"
+        env_file = ".env"
+
+
+conductor_config = ConductorConfig()
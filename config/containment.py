@@ -9,6 +9,28 @@ class ContainmentConfig(BaseConfig):
     image: str = Field("python:3.11.5-slim")
     base_directory: str = Field("/composer")
     python_venv: str = Field(".venv")
+    specializer_cache_size: int = Field(128)
+    persistent_worker: bool = Field(True)
+    idle_timeout: float = Field(1800.0)
+    lifecycle_interval: float = Field(60.0)
+    pool_size: int = Field(2)
+    max_runs: int = Field(16)
+    max_user_runs: int = Field(2)
+    cpus: float = Field(1.0)
+    mem_limit: str = Field("1g")
+    client_connect_timeout: float = Field(5.0)
+    client_read_timeout: float = Field(300.0)
+    client_retries: int = Field(3)
+    client_async_concurrency: int = Field(8)
+    trace_memory: bool = Field(False)
+    output_limit: int = Field(1048576)
+    request_limit: int = Field(67108864)
+    run_timeout: float = Field(600.0)
+    executor: str = Field("docker")
+    restricted_allowed: bool = Field(False)
+    restricted_workers: int = Field(4)
+    restricted_timeout: float = Field(30.0)
+    restricted_memory_limit: int = Field(268435456)
 
     class Config:
         env_prefix = "CONTAINMENT_"
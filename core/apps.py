@@ -1,3 +1,4 @@
+import multiprocessing
 import sys
 
 from django.apps import AppConfig
@@ -9,7 +10,14 @@ class CoreConfig(AppConfig):
 
     def ready(self):
         """Run when the app is ready"""
-        if "runserver" in sys.argv:
+        # The processes of the restricted executor inherit the arguments
+        if (
+            "runserver" in sys.argv
+            and multiprocessing.parent_process() is None
+        ):
+            from conductor.jobs import chat_job_queue
             from engine.containment import containment
 
             containment.create_user_containers()
+            containment.lifecycle.start()
+            chat_job_queue.start()
@@ -10,3 +10,27 @@ class ReturnType(BaseChoice):
     LIST = "list"
     DICTIONARY = "dictionary"
     NONE = "none"
+
+
+class ChatJobStatus(BaseChoice):
+    """Status for chat jobs"""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class Executor(BaseChoice):
+    """Executor for pipelines"""
+
+    DEFAULT = "default"
+    DOCKER = "docker"
+    RESTRICTED = "restricted"
+
+
+class LlmProvider(BaseChoice):
+    """Provider of LLM APIs"""
+
+    OAI = "oai"
+    VAI = "vai"
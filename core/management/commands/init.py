@@ -54,14 +54,17 @@ COMPONENT_TEMPLATES = [
             " pipeline and component, which are persistent data stored in the"
             " backend for the pipeline and component.\n\nYou may access the"
             " states using the Composer module via the functions"
-            " `pipeline_state` and `component_state` respectively.\n\n##"
-            ' More\n\nClick the "DOCS" button on the top right to see more.'
+            " `pipeline_state` and `component_state` respectively.\n\nTo"
+            " update the keys of the states atomically, e.g. for counters, use"
+            " the key-value stores from the functions `pipeline_store` and"
+            " `component_store` instead.\n\n## More\n\nClick the \"DOCS\""
+            " button on the top right to see more."
         ),
         "code": (
             "from modules import composer\n\ndef default(user_message: str) ->"
-            " str:\n    state: dict = composer.component_state()\n   "
-            ' state["counter"] += 1\n    return f"Your message was:'
-            " {user_message} (counter: {state['counter']})\""
+            " str:\n    counter = composer.component_store().incr(\"counter\")"
+            '\n    return f"Your message was: {user_message} (counter:'
+            ' {counter})"'
         ),
         "state": {"counter": 0},
         "is_template": True,
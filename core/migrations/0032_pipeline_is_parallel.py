@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_chatjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipeline',
+            name='is_parallel',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_pipeline_is_parallel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='component',
+            name='is_cacheable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ComponentCacheStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hits', models.PositiveBigIntegerField(default=0)),
+                ('misses', models.PositiveBigIntegerField(default=0)),
+                ('component', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cache_stats', to='core.component')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ComponentCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.JSONField(null=True)),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('accessed_at', models.DateTimeField(auto_now_add=True)),
+                ('component', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.component')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['component', 'accessed_at'], name='core_compon_compone_94aa3f_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='componentcacheentry',
+            constraint=models.UniqueConstraint(fields=('component', 'key'), name='unique_component_cache_entry'),
+        ),
+    ]
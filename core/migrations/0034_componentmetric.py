@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_component_is_cacheable_componentcacheentry_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ComponentMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wall_time', models.FloatField()),
+                ('cpu_time', models.FloatField()),
+                ('peak_memory', models.PositiveBigIntegerField()),
+                ('calls', models.PositiveIntegerField()),
+                ('call_latency', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.chat')),
+                ('component', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.component')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['component', 'created_at'], name='core_compon_compone_2eb36b_idx')],
+            },
+        ),
+    ]
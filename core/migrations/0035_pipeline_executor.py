@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_componentmetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipeline',
+            name='executor',
+            field=models.CharField(choices=[('default', 'default'), ('docker', 'docker'), ('restricted', 'restricted')], default='default', max_length=255),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.5 on 2026-10-18 16:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_pipeline_executor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LlmCacheStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('oai', 'oai'), ('vai', 'vai')], max_length=255)),
+                ('hits', models.PositiveBigIntegerField(default=0)),
+                ('misses', models.PositiveBigIntegerField(default=0)),
+                ('tokens_saved', models.PositiveBigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LlmCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('oai', 'oai'), ('vai', 'vai')], max_length=255)),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.JSONField()),
+                ('tokens', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('accessed_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'accessed_at'], name='core_llmcac_user_id_fa1b22_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='llmcachestats',
+            constraint=models.UniqueConstraint(fields=('user', 'provider'), name='unique_llm_cache_stats'),
+        ),
+        migrations.AddConstraint(
+            model_name='llmcacheentry',
+            constraint=models.UniqueConstraint(fields=('user', 'provider', 'key'), name='unique_llm_cache_entry'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_llmcachestats_llmcacheentry_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('level', models.FloatField()),
+                ('updated_at', models.DateTimeField()),
+                ('blocked_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatjob',
+            name='runner',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
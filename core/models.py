@@ -4,10 +4,11 @@ import logging
 from typing import Dict, List
 
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models import QuerySet
+from django.db import models, transaction
+from django.db.models import Case, F, QuerySet, When
 from rest_framework_api_key.models import AbstractAPIKey
 
+from utils import json_patch, jsonb
 from utils.json_type import JsonType
 
 from . import enums, managers, validators
@@ -68,6 +69,7 @@ class Component(models.Model):
     description = models.TextField(default="", blank=True)
     code = models.TextField(blank=True)
     state = models.JSONField(default=dict)
+    is_cacheable = models.BooleanField(default=False)
     is_template = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -113,6 +115,31 @@ class Component(models.Model):
 
         return lines
 
+    def get_interpolated_expressions(self) -> List[str]:
+        """Get the interpolated expressions of the enabled arguments"""
+        expressions = []
+
+        def collect_interpolatable(value: Dict[str, JsonType]):
+            """Collect the expressions of the interpolatable value"""
+            if value["enabled"]:
+                expressions.append(value["interpolated"])
+            else:
+                collect_json(value["default"])
+
+        def collect_json(value: JsonType):
+            """Collect the expressions of the JSON value"""
+            if isinstance(value, dict):
+                for item in value.values():
+                    collect_interpolatable(item)
+            elif isinstance(value, list):
+                for item in value:
+                    collect_json(item)
+
+        for value in self.arguments.values():
+            collect_interpolatable(value)
+
+        return expressions
+
     @staticmethod
     def get_interpolatable_arguments(value: Dict[str, JsonType]) -> List[str]:
         """Get the arguments for this component.
@@ -161,6 +188,12 @@ class Pipeline(models.Model):
     response = models.TextField(default="", blank=True)
     state = models.JSONField(default=dict)
     description = models.TextField(default="", blank=True)
+    is_parallel = models.BooleanField(default=False)
+    executor = models.CharField(
+        max_length=255,
+        choices=enums.Executor.choices(),
+        default=enums.Executor.DEFAULT,
+    )
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -182,6 +215,130 @@ class Pipeline(models.Model):
             )
         ).order_by("componentinstance__order")
 
+    def get_states(self) -> Dict[str, JsonType]:
+        """Get the states of the components and this pipeline"""
+        return {
+            "component_states": [
+                {"id": component.id, "state": component.state}
+                for component in self.get_components()
+            ],
+            "pipeline_state": self.state,
+        }
+
+    def set_states(self, states: Dict[str, JsonType]):
+        """Set the states of the components and this pipeline"""
+        components = self.get_components()
+
+        for component_state in states["component_states"]:
+            component = components.get(id=component_state["id"])
+            component.state = component_state["state"]
+            component.save()
+
+        self.state = states["pipeline_state"]
+        self.save()
+
+    def patch_states(self, patches: Dict[str, JsonType]):
+        """Apply the patches to the states of the components and this pipeline
+
+        The patched rows are locked and updated in bulk, so the patches of
+        concurrent runs changing different keys are all kept.
+        """
+        component_patches = {
+            component_state["id"]: component_state["patch"]
+            for component_state in patches["component_states"]
+            if component_state["patch"]
+        }
+
+        with transaction.atomic():
+            if component_patches:
+                components = list(
+                    self.get_components()
+                    .filter(id__in=component_patches)
+                    .select_for_update(of=("self",))
+                )
+
+                for component in components:
+                    component.state = json_patch.apply(
+                        component.state, component_patches[component.id]
+                    )
+
+                Component.objects.bulk_update(components, ["state"])
+
+            if patches["pipeline_state"]:
+                state = (
+                    Pipeline.objects.select_for_update()
+                    .values_list("state", flat=True)
+                    .get(id=self.id)
+                )
+                self.state = json_patch.apply(
+                    state, patches["pipeline_state"]
+                )
+                Pipeline.objects.filter(id=self.id).update(state=self.state)
+
+    def apply_state_ops(self, ops: Dict[str, JsonType]):
+        """Apply the key-value operations to the states
+
+        Each key is updated atomically by the database, so the operations of
+        concurrent runs, e.g. increments of a counter, are all kept. The
+        components are updated in one statement.
+        """
+        component_ops = {
+            component_state["id"]: component_state["ops"]
+            for component_state in ops["component_states"]
+            if component_state["ops"]
+        }
+
+        with transaction.atomic():
+            if component_ops:
+                ids = self.get_components().filter(id__in=component_ops)
+                Component.objects.filter(
+                    id__in=list(ids.values_list("id", flat=True))
+                ).update(
+                    state=Case(
+                        *[
+                            When(
+                                id=id,
+                                then=jsonb.ops_expression("state", id_ops),
+                            )
+                            for id, id_ops in component_ops.items()
+                        ],
+                        default=F("state"),
+                    )
+                )
+
+            if ops["pipeline_state"]:
+                Pipeline.objects.filter(id=self.id).update(
+                    state=jsonb.ops_expression("state", ops["pipeline_state"])
+                )
+
+    def create_component_metrics(
+        self,
+        chats: List[Chat],
+        metrics: List[List[Dict[str, JsonType]]],
+    ) -> List[ComponentMetric]:
+        """Create the metrics of the components for each chat in bulk
+
+        The metrics of components not in this pipeline are ignored.
+        """
+        ids = set(self.get_components().values_list("id", flat=True))
+
+        return ComponentMetric.objects.bulk_create(
+            [
+                ComponentMetric(
+                    chat=chat,
+                    component_id=metric["id"],
+                    wall_time=metric["wall_time"],
+                    cpu_time=metric["cpu_time"],
+                    peak_memory=metric["peak_memory"],
+                    calls=metric["calls"],
+                    call_latency=metric["call_latency"],
+                )
+                for chat, chat_metrics in zip(chats, metrics)
+                for metric in chat_metrics
+                if metric["id"] in ids
+            ]
+        )
+
     def get_containment_directory(self) -> str:
         """Get the directory name containing this pipeline"""
         return f"{self.id}"
@@ -211,3 +368,134 @@ class Chat(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+
+
+class ComponentMetric(models.Model):
+    """ComponentMetric model"""
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    component = models.ForeignKey(Component, on_delete=models.CASCADE)
+    wall_time = models.FloatField()
+    cpu_time = models.FloatField()
+    peak_memory = models.PositiveBigIntegerField()
+    calls = models.PositiveIntegerField()
+    call_latency = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["component", "created_at"])]
+
+
+class ChatJob(models.Model):
+    """ChatJob model"""
+
+    pipeline = models.ForeignKey(Pipeline, on_delete=models.CASCADE)
+    user_message = models.TextField(blank=True)
+    status = models.CharField(
+        max_length=255,
+        choices=enums.ChatJobStatus.choices(),
+        default=enums.ChatJobStatus.PENDING,
+    )
+    chat = models.OneToOneField(
+        Chat, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    error = models.TextField(default="", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    runner = models.CharField(max_length=255, blank=True, default="")
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    def is_finished(self) -> bool:
+        """Check if the job is finished"""
+        return self.status in (
+            enums.ChatJobStatus.SUCCEEDED,
+            enums.ChatJobStatus.FAILED,
+        )
+
+
+class ComponentCacheEntry(models.Model):
+    """ComponentCacheEntry model"""
+
+    component = models.ForeignKey(Component, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    value = models.JSONField(null=True)
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    accessed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["component", "key"],
+                name="unique_component_cache_entry",
+            )
+        ]
+        indexes = [models.Index(fields=["component", "accessed_at"])]
+
+
+class ComponentCacheStats(models.Model):
+    """ComponentCacheStats model"""
+
+    component = models.OneToOneField(
+        Component,
+        on_delete=models.CASCADE,
+        related_name="cache_stats",
+    )
+    hits = models.PositiveBigIntegerField(default=0)
+    misses = models.PositiveBigIntegerField(default=0)
+
+
+class LlmCacheEntry(models.Model):
+    """LlmCacheEntry model"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    provider = models.CharField(
+        max_length=255,
+        choices=enums.LlmProvider.choices(),
+    )
+    key = models.CharField(max_length=64)
+    value = models.JSONField()
+    tokens = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    accessed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "provider", "key"],
+                name="unique_llm_cache_entry",
+            )
+        ]
+        indexes = [models.Index(fields=["user", "accessed_at"])]
+
+
+class LlmCacheStats(models.Model):
+    """LlmCacheStats model"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    provider = models.CharField(
+        max_length=255,
+        choices=enums.LlmProvider.choices(),
+    )
+    hits = models.PositiveBigIntegerField(default=0)
+    misses = models.PositiveBigIntegerField(default=0)
+    tokens_saved = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "provider"],
+                name="unique_llm_cache_stats",
+            )
+        ]
+
+
+class RateLimitBucket(models.Model):
+    """RateLimitBucket model"""
+
+    key = models.CharField(max_length=255, unique=True)
+    level = models.FloatField()
+    updated_at = models.DateTimeField()
+    blocked_until = models.DateTimeField(null=True, blank=True)
@@ -1,19 +1,41 @@
+import ast
+import contextlib
+import hashlib
+import io
+import json
 import logging
-import os
 import tarfile
+import threading
+import time
+import uuid
 import zipfile
+from collections import OrderedDict, deque
 from enum import Enum, StrEnum
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import docker
-from docker.errors import NotFound
+from cachetools import LRUCache
+from django.db import transaction
+from docker.errors import APIError, NotFound
 from docker.models.containers import Container
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from config.containment import containment_config
 from config.web import web_config
-from core import models
+from core import enums, models
+
+from . import restricted, worker
 
 
 class ContainmentArchiveType(StrEnum):
@@ -31,6 +53,90 @@ class ContainmentArchiveType(StrEnum):
             return "application/zip"
 
 
+class ContainmentTemplateCache:
+    """Cache of the specialized containment files.
+
+    The pipeline independent files are specialized once per version of the
+    engine code, and the pipeline dependent files are cached by the digest
+    of the pipeline content with LRU eviction.
+    """
+
+    lock: threading.Lock
+    version: Optional[str]
+    templates: Dict[str, str]
+    pipelines: LRUCache
+
+    def __init__(self):
+        """Initialize the cache."""
+        self.lock = threading.Lock()
+        self.version = None
+        self.templates = {}
+        self.pipelines = LRUCache(
+            maxsize=containment_config.specializer_cache_size
+        )
+
+    @staticmethod
+    def get_version() -> str:
+        """Get the version of the engine code.
+
+        The version is the digest of the paths, modification times and sizes
+        of the engine files and the shared files, so it changes whenever any
+        of them is edited.
+        """
+        dir = Path(__file__).resolve().parent
+        digest = hashlib.sha256()
+
+        files = sorted(dir.rglob("*")) + [
+            dir.parent / path
+            for path in sorted(ContainmentFileSpecializer.shared)
+        ]
+
+        for file in files:
+            if "__pycache__" in file.parts or not file.is_file():
+                continue
+
+            stat = file.stat()
+            digest.update(
+                f"{file.relative_to(dir.parent)}:{stat.st_mtime_ns}:"
+                f"{stat.st_size}\n".encode()
+            )
+
+        return digest.hexdigest()
+
+    def get_templates(
+        self, specialize: Callable[[], Dict[str, str]]
+    ) -> Dict[str, str]:
+        """Get the pipeline independent files.
+
+        The files are specialized with the given function if the engine code
+        changed since they were last specialized.
+        """
+        version = self.get_version()
+
+        with self.lock:
+            if self.version == version:
+                return self.templates
+
+        templates = specialize()
+
+        with self.lock:
+            self.version = version
+            self.templates = templates
+            self.pipelines.clear()
+
+        return templates
+
+    def get_pipeline(self, digest: str) -> Optional[Dict[str, str]]:
+        """Get the pipeline dependent files of the given digest."""
+        with self.lock:
+            return self.pipelines.get(digest)
+
+    def set_pipeline(self, digest: str, contents: Dict[str, str]):
+        """Set the pipeline dependent files of the given digest."""
+        with self.lock:
+            self.pipelines[digest] = contents
+
+
 class ContainmentFileSpecializer:
     """Specialize the containment files.
 
@@ -54,106 +160,143 @@ class ContainmentFileSpecializer:
         COMPONENTS = "# containment: components"
         PIPELINE = "# containment: pipeline"
 
-    tmp_dir_name: str
+    template_cache: ContainmentTemplateCache = ContainmentTemplateCache()
+
+    # The server-side files in the current directory
+    excluded: Set[str] = {"containment.py", "restricted.py"}
+
+    # The files of the server used by the containers, relative to the root
+    # of the server, copied to the same paths in the containers
+    shared: Set[str] = {"utils/__init__.py", "utils/json_patch.py"}
+
     pipeline: models.Pipeline
+    components: List[models.Component]
+    contents: Dict[str, str]
 
-    def __init__(
-        self, pipeline: models.Pipeline, tmp_dir_name: str = "containment_tmp"
-    ):
+    def __init__(self, pipeline: models.Pipeline):
         """Initialize the specializer."""
-        self.tmp_dir_name = tmp_dir_name
         self.pipeline = pipeline
+        self.components = []
+        self.contents = {}
 
     def __enter__(self):
         """Enter the context.
 
-        Generates a temporary directory containing the specialized
-        files. The files are specialized from the current directory.
+        Specializes the files in memory. The files are specialized from the
+        current directory. Only the files depending on the pipeline are
+        specialized if they are not cached.
         """
-        dir = Path(__file__).resolve().parent
-        dir_tmp = dir / self.tmp_dir_name
+        self.components = list(self.pipeline.get_components())
 
-        if not dir_tmp.exists():
-            dir_tmp.mkdir()
-            dir_tmp.chmod(0o777)
+        templates = self.template_cache.get_templates(
+            self.specialize_templates
+        )
 
-        for file in dir.iterdir():
-            if file.name == self.tmp_dir_name:
-                continue
+        digest = self.digest()
+        contents = self.template_cache.get_pipeline(digest)
 
-            self.specialize(file)
+        if contents is None:
+            contents = {
+                path: self.expand_content(content)
+                for path, content in templates.items()
+                if self.is_expandable(content)
+            }
+            contents.update(self.generate_components())
+            self.template_cache.set_pipeline(digest, contents)
 
-        self.generate_components()
+        self.contents = {**templates, **contents}
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit the context.
 
-        Deletes the temporary directory.
+        Discards the specialized files.
         """
-        dir = Path(__file__).resolve().parent
-        dir_tmp = dir / self.tmp_dir_name
-
-        # Remove dir
-        def rmdir(path: Path):
-            """Remove the given directory."""
-            for file in path.iterdir():
-                if file.is_dir():
-                    rmdir(file)
-                else:
-                    file.unlink()
-            path.rmdir()
+        self.components = []
+        self.contents = {}
+
+    def digest(self) -> str:
+        """Get the digest of the pipeline content the files depend on."""
+        content = json.dumps(
+            {
+                "id": self.pipeline.id,
+                "response": self.pipeline.response,
+                "is_parallel": self.pipeline.is_parallel,
+                "components": [
+                    {
+                        "id": component.id,
+                        "name": component.name,
+                        "function_name": component.function_name,
+                        "arguments": component.arguments,
+                        "code": component.code,
+                        "is_cacheable": component.is_cacheable,
+                    }
+                    for component in self.components
+                ],
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
 
-        rmdir(dir_tmp)
+    def specialize_templates(self) -> Dict[str, str]:
+        """Specialize the pipeline independent files.
 
-        # Remove archive
-        for archive_type in ContainmentArchiveType:
-            archive_path = dir / f"{self.tmp_dir_name}.{archive_type}"
+        The components and pipeline markers are left to be expanded for
+        each pipeline.
+        """
+        dir = Path(__file__).resolve().parent
+        templates: Dict[str, str] = {}
 
-            if archive_path.exists():
-                archive_path.unlink()
+        for file in dir.iterdir():
+            self.specialize(file, templates)
+
+        for path in self.shared:
+            with open(dir.parent / path, "r") as file:
+                templates[path] = file.read()
+
+        # The component files are generated for each pipeline
+        return {
+            path: content
+            for path, content in templates.items()
+            if not path.startswith("pipeline/")
+            or path == "pipeline/__init__.py"
+        }
 
-    def specialize(self, path: Path):
-        """Specialize the given file or directory.
+    def specialize(self, path: Path, templates: Dict[str, str]):
+        """Specialize the given file or directory into the templates.
 
         Give the path relative to the current directory.
         """
         dir = Path(__file__).resolve().parent
-        dir_tmp = dir / self.tmp_dir_name
-        dir_tmp_path = dir_tmp / path.relative_to(dir)
 
         if path.name == "__pycache__":
             return
 
-        if path == Path(__file__).resolve():
+        if path.relative_to(dir).as_posix() in self.excluded:
             return
 
         if path.is_dir():
-            if not dir_tmp_path.exists():
-                dir_tmp_path.mkdir()
-                dir_tmp_path.chmod(0o777)
-
             for file in path.iterdir():
-                self.specialize(file)
+                self.specialize(file, templates)
 
             return
 
-        if dir_tmp_path.exists():
-            dir_tmp_path.unlink()
-
         with open(path, "r") as file:
             content = file.read()
 
-        content = self.specialize_content(content, path)
-
-        with open(dir_tmp_path, "w") as file:
-            file.write(content)
+        templates[path.relative_to(dir).as_posix()] = self.specialize_content(
+            content, path, expand=False
+        )
 
     def specialize_content(
-        self, content: str, path: Optional[Path] = None
+        self, content: str, path: Optional[Path] = None, expand: bool = True
     ) -> str:
-        """Specialize the given content."""
+        """Specialize the given content.
+
+        If expand is False, the components and pipeline markers are left in
+        the content to be expanded later by `expand_content`.
+        """
         state = self.__SpecializerState.NONE
         comment_indent = 0
 
@@ -192,58 +335,11 @@ class ContainmentFileSpecializer:
                         if path
                         else ""
                     )
-            elif stripped_line == self.__SpecializerMarker.COMPONENTS:
-                imports = [
-                    "from modules.composer import init_component,"
-                    " init_pipeline"
-                ]
-                for component in self.pipeline.get_components():
-                    fn = component.function_name
-                    imports.append(f"from .{fn} import {fn}")
-
-                lines[i] = "\n".join(imports)
-            elif stripped_line == self.__SpecializerMarker.PIPELINE:
-                statements = []
-                for component in self.pipeline.get_components():
-                    fn = component.function_name
-
-                    # Generate arguments
-                    arguments = "\n".join(
-                        [f"{' ' * 16}{l}" for l in component.get_arguments()]
-                    )
-
-                    # Generate arg for record
-                    arg_assigns = models.Component.get_json_arguments(
-                        component.arguments
-                    )
-                    arg_assigns[0] = f"{fn}.arg = {arg_assigns[0]}"
-                    arg_assigns = "\n".join(
-                        [f"{' ' * 12}{l}" for l in arg_assigns]
-                    )
-
-                    # Generate function call
-                    statements.append(
-                        f"        # {component.name}\n"
-                        f"        with init_component({component.id}):\n"
-                        f"{arg_assigns}\n"
-                        f"{' ' * 12}{fn}.ret = {fn}(\n"
-                        f"{arguments}\n"
-                        f"{' ' * 12})"
-                    )
-
-                statements.append(
-                    # fmt: off
-                    "        # Response\n"
-                    "        pipeline_helper.set_response"
-                    f"({self.pipeline.response})"
-                    # fmt: on
-                )
-
-                lines[i] = (
-                    f"    with init_pipeline({self.pipeline.id},"
-                    " user_message) as pipeline_helper:\n"
-                )
-                lines[i] += "\n\n".join(statements)
+            elif stripped_line in (
+                self.__SpecializerMarker.COMPONENTS,
+                self.__SpecializerMarker.PIPELINE,
+            ):
+                continue
             else:
                 if state == self.__SpecializerState.CONTAINED:
                     if stripped_line.startswith("# "):
@@ -260,30 +356,189 @@ class ContainmentFileSpecializer:
                                 + line[comment_indent:]
                             )
 
+        content = "\n".join(lines)
+
+        if expand:
+            return self.expand_content(content)
+
+        return content
+
+    def is_expandable(self, content: str) -> bool:
+        """Check if the given content has components or pipeline markers."""
+        return any(
+            line.strip()
+            in (
+                self.__SpecializerMarker.COMPONENTS,
+                self.__SpecializerMarker.PIPELINE,
+            )
+            for line in content.split("\n")
+        )
+
+    def expand_content(self, content: str) -> str:
+        """Expand the components and pipeline markers in the given content."""
+        lines = content.split("\n")
+
+        for i, line in enumerate(lines):
+            stripped_line = line.strip()
+
+            if stripped_line == self.__SpecializerMarker.COMPONENTS:
+                lines[i] = self.expand_components()
+            elif stripped_line == self.__SpecializerMarker.PIPELINE:
+                lines[i] = self.expand_pipeline()
+
         return "\n".join(lines)
 
-    def generate_components(self):
-        """Generate the components file."""
-        dir = Path(__file__).resolve().parent
-        dir_tmp = dir / self.tmp_dir_name / "pipeline"
+    def expand_components(self) -> str:
+        """Expand the components marker."""
+        names = ["init_component", "init_pipeline"]
+        if any(component.is_cacheable for component in self.components):
+            names.append("memoize")
+        if self.pipeline.is_parallel:
+            names.append("run_parallel")
+
+        imports = [f"from modules.composer import {', '.join(names)}"]
+        for component in self.components:
+            fn = component.function_name
+            imports.append(f"from .{fn} import {fn}")
+
+        return "\n".join(imports)
+
+    def waves(self) -> List[List[models.Component]]:
+        """Group the components into waves of independent components.
+
+        A component depends on the earlier components whose function names
+        are referenced by its interpolated arguments, and it is put in the
+        wave after its last dependency. Arguments which cannot be parsed
+        depend on all the earlier components.
+        """
+        levels: Dict[str, int] = {}
+        waves: List[List[models.Component]] = []
+
+        for component in self.components:
+            names: Set[str] = set()
+            for expression in component.get_interpolated_expressions():
+                try:
+                    tree = ast.parse(expression.strip(), mode="eval")
+                except SyntaxError:
+                    names.update(levels)
+                    continue
+
+                names.update(
+                    node.id
+                    for node in ast.walk(tree)
+                    if isinstance(node, ast.Name)
+                )
+
+            level = max(
+                (levels[name] + 1 for name in names if name in levels),
+                default=0,
+            )
+            levels[component.function_name] = level
+
+            if level == len(waves):
+                waves.append([])
+            waves[level].append(component)
+
+        return waves
+
+    def expand_component(self, component: models.Component, indent: int):
+        """Expand the call of the component at the given indentation."""
+        fn = component.function_name
+
+        # Generate arguments
+        arguments = "\n".join(
+            [f"{' ' * (indent + 8)}{l}" for l in component.get_arguments()]
+        )
 
-        # Delete old components file
-        for file in os.listdir(dir_tmp):
-            if file != "__init__.py":
-                os.remove(dir_tmp / file)
+        # Generate arg for record
+        arg_assigns = models.Component.get_json_arguments(component.arguments)
+        arg_assigns[0] = f"{fn}.arg = {arg_assigns[0]}"
+        arg_assigns = "\n".join(
+            [f"{' ' * (indent + 4)}{l}" for l in arg_assigns]
+        )
+
+        # Generate function call, memoized if cacheable
+        call = fn
+        if component.is_cacheable:
+            code_hash = hashlib.sha256(component.code.encode()).hexdigest()
+            call = f'memoize({fn}, "{code_hash}")'
+
+        return (
+            f"{' ' * indent}# {component.name}\n"
+            f"{' ' * indent}with init_component({component.id}):\n"
+            f"{arg_assigns}\n"
+            f"{' ' * (indent + 4)}{fn}.ret = {call}(\n"
+            f"{arguments}\n"
+            f"{' ' * (indent + 4)})"
+        )
+
+    def expand_pipeline(self) -> str:
+        """Expand the pipeline marker.
+
+        If the pipeline is parallel, the components of each wave are run
+        concurrently, otherwise the components are run one after another.
+        """
+        statements = []
+        if self.pipeline.is_parallel:
+            for wave in self.waves():
+                runs = []
+                for component in wave:
+                    fn = component.function_name
+                    statements.append(
+                        f"        def {fn}_run():\n"
+                        + self.expand_component(component, 12)
+                    )
+                    runs.append(f"{fn}_run")
+
+                statements.append(
+                    f"        run_parallel({', '.join(runs)})"
+                )
+        else:
+            for component in self.components:
+                statements.append(self.expand_component(component, 8))
+
+        statements.append(
+            # fmt: off
+            "        # Response\n"
+            "        pipeline_helper.set_response"
+            f"({self.pipeline.response})"
+            # fmt: on
+        )
+
+        return (
+            (
+                f"    with init_pipeline({self.pipeline.id},"
+                " user_message) as pipeline_helper:\n"
+            )
+            + "\n\n".join(statements)
+            + "\n\n    return pipeline_helper.response"
+        )
 
-        for component in self.pipeline.get_components():
-            component_path = dir_tmp / f"{component.function_name}.py"
+    def files(self) -> Dict[str, bytes]:
+        """Get the specialized files.
 
-            with open(component_path, "w") as file:
-                file.write(component.code)
+        Returns:
+            Dict[str, bytes]: The content of the files mapped by their paths
+                relative to the current directory.
+        """
+        return {
+            path: content.encode("utf-8")
+            for path, content in self.contents.items()
+        }
+
+    def generate_components(self) -> Dict[str, str]:
+        """Generate the components files."""
+        return {
+            f"pipeline/{component.function_name}.py": component.code
+            for component in self.components
+        }
 
     def to_archive(
         self,
         archive_type: ContainmentArchiveType = ContainmentArchiveType.TARGZ,
         subroot: Optional[str] = None,
     ) -> bytes:
-        """Convert the temporary directory to a tar file.
+        """Convert the specialized files to an archive in memory.
 
         Args:
             archive_type (ContainmentArchiveType, optional): The archive type.
@@ -291,44 +546,445 @@ class ContainmentFileSpecializer:
             subroot (Optional[str], optional): The subroot to use. Defaults to
                 None.
         """
-        dir = Path(__file__).resolve().parent
-        dir_tmp = dir / self.tmp_dir_name
+        buffer = io.BytesIO()
+        files = self.files()
 
-        if not dir_tmp.exists():
-            raise RuntimeError("Temporary directory does not exist")
+        def arcname(path: str) -> str:
+            """Get the name of the given path in the archive."""
+            if subroot is not None:
+                return f"{subroot}/{path}"
 
-        archive_path = dir / f"{self.tmp_dir_name}.{archive_type}"
+            return path
 
         if archive_type == ContainmentArchiveType.TARGZ:
-            with tarfile.open(archive_path, "w:gz") as archive:
-                if subroot is not None:
-                    archive.add(dir_tmp, arcname=subroot)
-                else:
-                    for file in dir_tmp.iterdir():
-                        archive.add(file, arcname=file.name)
+            mtime = time.time()
+
+            with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+                for path in sorted(files):
+                    info = tarfile.TarInfo(arcname(path))
+                    info.size = len(files[path])
+                    info.mtime = mtime
+                    info.mode = 0o644
+                    archive.addfile(info, io.BytesIO(files[path]))
         elif archive_type == ContainmentArchiveType.ZIP:
-            with zipfile.ZipFile(archive_path, "w") as archive:
-
-                def add_dir(path: Path, arcname: Path | str):
-                    """Add the given directory to the archive."""
-                    arcname: Path = Path(arcname)
-                    for file in path.iterdir():
-                        if file.is_dir():
-                            add_dir(file, arcname / file.name)
-                        else:
-                            archive.write(file, arcname=arcname / file.name)
+            with zipfile.ZipFile(buffer, "w") as archive:
+                for path in sorted(files):
+                    archive.writestr(arcname(path), files[path])
 
-                if subroot is not None:
-                    add_dir(dir_tmp, arcname=subroot)
-                else:
-                    for file in dir_tmp.iterdir():
-                        if file.is_dir():
-                            add_dir(file, arcname=file.name)
-                        else:
-                            archive.write(file, arcname=file.name)
+        return buffer.getvalue()
+
+
+class ContainmentPipelineCache:
+    """Cache of the states of the pipeline directories.
+
+    The entries are keyed by the container name and the pipeline ID, so
+    they can be invalidated when the directory or the container is gone.
+    """
+
+    lock: threading.Lock
+    entries: Dict[Tuple[str, int], Any]
+
+    def __init__(self):
+        """Initialize the cache."""
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key: Tuple[str, int]) -> Optional[Any]:
+        """Get the entry of the given key."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key: Tuple[str, int], value: Any):
+        """Set the entry of the given key."""
+        with self.lock:
+            self.entries[key] = value
+
+    def invalidate(
+        self, container_name: str, pipeline_id: Optional[int] = None
+    ):
+        """Invalidate the entries of the given container.
+
+        If the pipeline ID is given, only the entry of that pipeline is
+        invalidated.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] != container_name:
+                    continue
+
+                if pipeline_id is None or key[1] == pipeline_id:
+                    del self.entries[key]
+
+
+class ContainmentDependencyCache(ContainmentPipelineCache):
+    """Cache of the dependencies installed in the pipeline environments.
+
+    The cache maps each pipeline environment to the digest of the
+    requirements it was last installed with, so the installation can be
+    skipped when the requirements have not changed.
+    """
+
+    stamp_name: str = "requirements.sha256"
+
+    hits: int
+    misses: int
+
+    def __init__(self):
+        """Initialize the cache."""
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(requirements: str) -> str:
+        """Get the digest of the given requirements.
+
+        The image is part of the digest so environments created with a
+        different Python version are never considered satisfied.
+        """
+        content = f"{containment_config.image}\n{requirements}"
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def count(self, hit: bool):
+        """Count a hit or a miss."""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the cache."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
+
+
+class ContainmentManifestCache(ContainmentPipelineCache):
+    """Cache of the files last synchronized to the pipeline directories.
+
+    The cache maps each pipeline directory to its manifest, which maps the
+    path of each file to the digest of its content, so only the added or
+    changed files have to be uploaded.
+    """
+
+    @staticmethod
+    def manifest(files: Dict[str, bytes]) -> Dict[str, str]:
+        """Get the manifest of the given files."""
+        return {
+            path: hashlib.sha256(content).hexdigest()
+            for path, content in files.items()
+        }
+
+
+class ContainmentScheduler:
+    """Schedule the runs in the containers fairly across the users.
+
+    At most `max_runs` runs are running at a time, and at most
+    `max_user_runs` runs per user. The waiting users are served in a
+    round-robin order, so a user with many runs cannot starve the others.
+    """
+
+    condition: threading.Condition
+    running: int
+    user_running: Dict[str, int]
+    queues: "OrderedDict[str, Deque[object]]"
+
+    def __init__(self):
+        """Initialize the scheduler."""
+        self.condition = threading.Condition()
+        self.running = 0
+        self.user_running = {}
+        self.queues = OrderedDict()
+
+    @contextlib.contextmanager
+    def slot(self, name: str) -> Generator[None, None, None]:
+        """Wait for a slot to run in the container with the given name."""
+        ticket = object()
+
+        with self.condition:
+            queue = self.queues.setdefault(name, deque())
+            queue.append(ticket)
+
+            while not self.can_run(name, ticket):
+                self.condition.wait()
+
+            # Move the user to the back of the round-robin order
+            queue.popleft()
+            if queue:
+                self.queues.move_to_end(name)
+            else:
+                del self.queues[name]
+
+            self.running += 1
+            self.user_running[name] = self.user_running.get(name, 0) + 1
+
+            # The next waiter may run now that the order changed
+            self.condition.notify_all()
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.user_running[name] -= 1
+                if self.user_running[name] == 0:
+                    del self.user_running[name]
+
+                self.condition.notify_all()
+
+    def can_run(self, name: str, ticket: object) -> bool:
+        """Check if the given ticket of the given user can run now."""
+        if self.queues[name][0] is not ticket:
+            return False
+
+        if self.running >= containment_config.max_runs:
+            return False
+
+        # The first user in the round-robin order not at its limit goes next
+        for other in self.queues:
+            if (
+                self.user_running.get(other, 0)
+                < containment_config.max_user_runs
+            ):
+                return other == name
+
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the scheduler."""
+        with self.condition:
+            return {
+                "running": self.running,
+                "waiting": sum(len(queue) for queue in self.queues.values()),
+                "users": len(self.user_running),
+            }
+
+
+class ContainmentLifecycleManager:
+    """Manage the lifecycle of the user containers.
+
+    The user containers idle for longer than the configured period are
+    stopped, and started again on demand. A pool of pre-warmed generic
+    containers is kept to be claimed by the users without a container.
+    """
+
+    user_prefix: str = "chat-composer-containment-"
+    pool_prefix: str = "chat-composer-pool-"
+
+    logger: logging.Logger
+    client: docker.DockerClient
+    condition: threading.Condition
+    last_used: Dict[str, float]
+    active: Dict[str, int]
+    stopping: Set[str]
+    hibernated: Dict[str, int]
+    pool_size: int
+    thread: Optional[threading.Thread]
+
+    def __init__(self, client: docker.DockerClient):
+        """Initialize the manager."""
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.condition = threading.Condition()
+        self.last_used = {}
+        self.active = {}
+        self.stopping = set()
+        self.hibernated = {}
+        self.pool_size = 0
+        self.thread = None
+
+    def start(self):
+        """Start managing the containers in the background."""
+        with self.condition:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(
+                target=self.loop, name="containment-lifecycle", daemon=True
+            )
+
+        self.thread.start()
+
+    def loop(self):
+        """Hibernate the idle containers and fill the pool periodically."""
+        while True:
+            try:
+                self.hibernate_idle_containers()
+                self.fill_pool()
+            except Exception as e:
+                self.logger.error(f"Unable to manage containers: {e}")
+
+            time.sleep(containment_config.lifecycle_interval)
+
+    @contextlib.contextmanager
+    def use(self, name: str) -> Generator[None, None, None]:
+        """Mark the container with the given name as in use.
+
+        The container is not hibernated while in use. If it is being
+        hibernated, the context waits until it is stopped, so it can be
+        started again.
+        """
+        with self.condition:
+            while name in self.stopping:
+                self.condition.wait()
+
+            self.active[name] = self.active.get(name, 0) + 1
+            self.last_used[name] = time.monotonic()
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[name] -= 1
+                if self.active[name] == 0:
+                    del self.active[name]
+
+                self.last_used[name] = time.monotonic()
+
+    def touch(self, name: str):
+        """Mark the container with the given name as just used and awake."""
+        with self.condition:
+            self.last_used[name] = time.monotonic()
+            self.hibernated.pop(name, None)
+
+    def forget(self, name: str):
+        """Forget the container with the given name."""
+        with self.condition:
+            self.last_used.pop(name, None)
+            self.hibernated.pop(name, None)
+
+    def hibernate_idle_containers(self):
+        """Stop the user containers idle for longer than the idle period."""
+        if containment_config.idle_timeout <= 0:
+            return
+
+        containers: List[Container] = self.client.containers.list(
+            filters={"name": self.user_prefix}
+        )
+
+        for container in containers:
+            name = container.name
+            now = time.monotonic()
 
-        with open(archive_path, "rb") as archive:
-            return archive.read()
+            with self.condition:
+                last_used = self.last_used.setdefault(name, now)
+
+                if (
+                    self.active.get(name)
+                    or now - last_used < containment_config.idle_timeout
+                ):
+                    continue
+
+                self.stopping.add(name)
+
+            try:
+                memory = self.memory_usage(container)
+
+                self.logger.info(f"Hibernating container {name}")
+                container.stop()
+
+                with self.condition:
+                    self.last_used.pop(name, None)
+                    self.hibernated[name] = memory
+            finally:
+                with self.condition:
+                    self.stopping.discard(name)
+                    self.condition.notify_all()
+
+    @staticmethod
+    def memory_usage(container: Container) -> int:
+        """Get the resident memory usage of the given container in bytes."""
+        try:
+            stats = container.stats(stream=False)
+            memory_stats = stats.get("memory_stats", {})
+            usage = memory_stats.get("usage", 0)
+
+            # Exclude the page cache as it is reclaimable anyway
+            cache = memory_stats.get("stats", {}).get("inactive_file", 0)
+
+            return max(usage - cache, 0)
+        except Exception:
+            return 0
+
+    def create_container(self, name: str) -> Container:
+        """Create and start a container with the given name."""
+        container: Container = self.client.containers.run(
+            containment_config.image,
+            detach=True,
+            tty=True,
+            name=name,
+            mem_limit=containment_config.mem_limit or None,
+            nano_cpus=int(containment_config.cpus * 1e9) or None,
+        )
+
+        # Create composer directory
+        result = container.exec_run(
+            f"test -d {containment_config.base_directory}"
+        )
+        if result.exit_code != 0:
+            result = container.exec_run(
+                f"mkdir {containment_config.base_directory}"
+            )
+            if result.exit_code != 0:
+                raise RuntimeError(
+                    f"Unable to create composer directory in {name}"
+                )
+
+        return container
+
+    def fill_pool(self):
+        """Create pre-warmed containers until the pool is full."""
+        containers: List[Container] = self.client.containers.list(
+            filters={"name": self.pool_prefix}
+        )
+
+        for _ in range(containment_config.pool_size - len(containers)):
+            name = f"{self.pool_prefix}{uuid.uuid4().hex[:12]}"
+            self.logger.info(f"Creating pool container {name}")
+            containers.append(self.create_container(name))
+
+        with self.condition:
+            self.pool_size = len(containers)
+
+    def claim(self, name: str) -> Optional[Container]:
+        """Claim a pre-warmed container from the pool.
+
+        The container is renamed to the given name.
+
+        Returns:
+            Optional[Container]: The container, or None if the pool is empty.
+        """
+        with self.condition:
+            containers: List[Container] = self.client.containers.list(
+                filters={"name": self.pool_prefix}
+            )
+
+            for container in containers:
+                try:
+                    container.rename(name)
+                except APIError:
+                    continue
+
+                self.pool_size = max(self.pool_size - 1, 0)
+                self.logger.info(f"Claimed pool container for {name}")
+
+                return container
+
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        """Get the statistics of the containers."""
+        with self.condition:
+            return {
+                "active": len(self.active),
+                "hibernated": len(self.hibernated),
+                "pool": self.pool_size,
+                "memory_saved": sum(self.hibernated.values()),
+            }
 
 
 class Containment:
@@ -336,36 +992,38 @@ class Containment:
 
     client: docker.DockerClient
     logger: logging.Logger
+    dependency_cache: ContainmentDependencyCache
+    manifest_cache: ContainmentManifestCache
+    lifecycle: ContainmentLifecycleManager
+    scheduler: ContainmentScheduler
 
     def __init__(self):
         """Initialize the containers"""
         self.logger = logging.getLogger(__name__)
         self.client = docker.from_env()
+        self.dependency_cache = ContainmentDependencyCache()
+        self.manifest_cache = ContainmentManifestCache()
+        self.lifecycle = ContainmentLifecycleManager(self.client)
+        self.scheduler = ContainmentScheduler()
 
     def container_exec_run(
         self,
         container: Container,
-        command: str,
+        command: str | List[str],
         workdir: Optional[str] = None,
         pipeline: Optional[models.Pipeline] = None,
         env: Optional[Dict[str, str]] = None,
         raise_for_exit_code: bool = True,
         return_exit_code: bool = False,
+        detach: bool = False,
     ) -> str | Tuple[str, int]:
-        """Run a command in a container"""
-        env_ = {
-            "PYTHONUNBUFFERED": "1",
-        }
-
-        if pipeline:
-            env_["PATH"] = (
-                f"{containment_config.base_directory}/"
-                f"{pipeline.get_containment_directory()}/"
-                f"{containment_config.python_venv}/bin:$PATH"
-            )
+        """Run a command in a container
 
-        if env:
-            env_.update(env)
+        The output is the stdout of the command, the stderr is only logged.
+        If detach is True, the command is left running in the background
+        and an empty output is returned.
+        """
+        env_ = self.container_env(pipeline, env)
 
         self.logger.debug(
             f"Running command in container {container.name}: {command}"
@@ -375,61 +1033,189 @@ class Containment:
             command,
             workdir=workdir,
             environment=env_,
+            detach=detach,
+            demux=True,
         )
 
-        output: str = result.output.decode("utf-8")
+        if detach:
+            return ("", 0) if return_exit_code else ""
+
+        stdout, stderr = (
+            (data or b"").decode("utf-8", errors="replace")
+            for data in result.output
+        )
 
         if result.exit_code != 0 and raise_for_exit_code:
             self.logger.error(
                 f"Exit code {result.exit_code} when running command {command}"
             )
-            self.logger.error(f"Output: {output}")
+            self.logger.error(f"Output: {self.truncate(stdout)}")
+            self.logger.error(f"Error: {self.truncate(stderr)}")
 
             raise RuntimeError(
                 f"Unable to run command {command} in container"
                 f" {container.name}"
             )
 
-        self.logger.debug(f"Output: {output}")
+        self.logger.debug(f"Output: {self.truncate(stdout)}")
+        if stderr:
+            self.logger.debug(f"Error: {self.truncate(stderr)}")
+
+        output = stdout
 
         if return_exit_code:
             return output, result.exit_code
 
         return output
 
-    def get_user_container(self, user: models.User) -> Container:
-        """Get the container for the given user"""
-        return self.client.containers.get(user.get_containment_name())
-
-    def user_has_container(self, user: models.User) -> bool:
-        """Check if the given user has a container"""
-        try:
-            self.get_user_container(user)
-            return True
-        except NotFound:
-            return False
+    def container_exec_stream(
+        self,
+        container: Container,
+        command: str | List[str],
+        workdir: Optional[str] = None,
+        pipeline: Optional[models.Pipeline] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Generator[Tuple[str, str], None, int]:
+        """Run a command in a container, streaming the output
 
-    def user_container_is_running(self, user: models.User) -> bool:
+        The output is yielded line by line as it is produced, along with its
+        stream, `stdout` or `stderr`, and the exit code is returned when the
+        command finishes.
+        """
+        self.logger.debug(
+            f"Streaming command in container {container.name}: {command}"
+        )
+
+        exec_id = self.client.api.exec_create(
+            container.id,
+            command,
+            workdir=workdir,
+            environment=self.container_env(pipeline, env),
+        )["Id"]
+
+        buffers = {"stdout": b"", "stderr": b""}
+        for chunks in self.client.api.exec_start(
+            exec_id, stream=True, demux=True
+        ):
+            for stream, chunk in zip(("stdout", "stderr"), chunks):
+                if not chunk:
+                    continue
+
+                *lines, buffers[stream] = (buffers[stream] + chunk).split(
+                    b"\n"
+                )
+
+                for line in lines:
+                    yield stream, line.decode("utf-8", errors="replace") + "\n"
+
+        for stream, buffer in buffers.items():
+            if buffer:
+                yield stream, buffer.decode("utf-8", errors="replace")
+
+        return self.client.api.exec_inspect(exec_id)["ExitCode"]
+
+    @staticmethod
+    def truncate(output: str) -> str:
+        """Truncate the output to the output limit to be logged"""
+        if len(output) <= containment_config.output_limit:
+            return output
+
+        return output[: containment_config.output_limit] + "[truncated]"
+
+    @staticmethod
+    def container_env(
+        pipeline: Optional[models.Pipeline] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, str]:
+        """Get the environment to run a command in a container"""
+        env_ = {
+            "PYTHONUNBUFFERED": "1",
+        }
+
+        if pipeline:
+            env_["PATH"] = (
+                f"{containment_config.base_directory}/"
+                f"{pipeline.get_containment_directory()}/"
+                f"{containment_config.python_venv}/bin:$PATH"
+            )
+
+        if env:
+            env_.update(env)
+
+        return env_
+
+    def get_user_container(self, user: models.User) -> Container:
+        """Get the container for the given user"""
+        return self.client.containers.get(user.get_containment_name())
+
+    def user_has_container(self, user: models.User) -> bool:
+        """Check if the given user has a container"""
+        try:
+            self.get_user_container(user)
+            return True
+        except NotFound:
+            return False
+
+    def user_container_is_running(self, user: models.User) -> bool:
         """Check if the given user's container is running"""
         container = self.get_user_container(user)
         return container.status == "running"
 
+    def get_running_user_container(self, user: models.User) -> Container:
+        """Get the container for the given user, waking it up if needed
+
+        The container is created if the user does not have one, and started
+        if it is hibernated.
+        """
+        if not self.user_has_container(user):
+            self.create_user_container(user)
+
+        container = self.get_user_container(user)
+
+        if container.status != "running":
+            self.logger.info(f"Starting container for user {user.username}")
+            container.start()
+
+        self.lifecycle.touch(container.name)
+
+        return container
+
+    @contextlib.contextmanager
+    def use_user_container(
+        self, user: models.User
+    ) -> Generator[Container, None, None]:
+        """Use the running container for the given user
+
+        The container is not hibernated while in use.
+        """
+        with self.lifecycle.use(user.get_containment_name()):
+            yield self.get_running_user_container(user)
+
     def create_user_containers(self):
-        """Create containers for all users"""
+        """Create containers for all users
+
+        Hibernated containers are left stopped until they are used.
+        """
         for user in models.User.objects.all():
+            if self.user_has_container(
+                user
+            ) and not self.user_container_is_running(user):
+                continue
+
             self.create_user_container(user)
 
     def create_user_container(self, user: models.User):
-        """Create a container for the given user"""
+        """Create a container for the given user
+
+        A pre-warmed container is claimed from the pool if available.
+        """
+        name = user.get_containment_name()
+
         # Create container
         if not self.user_has_container(user):
             self.logger.info(f"Creating container for user {user.username}")
-            self.client.containers.run(
-                containment_config.image,
-                detach=True,
-                tty=True,
-                name=user.get_containment_name(),
-            )
+            if self.lifecycle.claim(name) is None:
+                self.lifecycle.create_container(name)
 
         container = self.get_user_container(user)
 
@@ -438,6 +1224,8 @@ class Containment:
             self.logger.info(f"Starting container for user {user.username}")
             container.start()
 
+        self.lifecycle.touch(name)
+
         # Create composer directory
         result = container.exec_run(
             f"test -d {containment_config.base_directory}"
@@ -453,7 +1241,7 @@ class Containment:
 
     def create_pipeline_directory(self, pipeline: models.Pipeline):
         """Create a directory for the given pipeline"""
-        container = self.get_user_container(pipeline.user)
+        container = self.get_running_user_container(pipeline.user)
 
         workdir = (
             f"{containment_config.base_directory}/"
@@ -471,6 +1259,7 @@ class Containment:
                 container,
                 f"mkdir {workdir}",
             )
+            self.manifest_cache.invalidate(container.name, pipeline.id)
 
         # Create python environment
         result = self.container_exec_run(
@@ -485,16 +1274,22 @@ class Containment:
                 f"python3 -m venv {containment_config.python_venv}",
                 workdir=workdir,
             )
+            self.dependency_cache.invalidate(container.name, pipeline.id)
 
     def delete_user_container(self, user: models.User):
         """Delete the container for the given user"""
         container = self.get_user_container(user)
 
         container.remove(force=True)
+        self.dependency_cache.invalidate(container.name)
+        self.manifest_cache.invalidate(container.name)
+        self.lifecycle.forget(container.name)
 
     def delete_pipeline_directory(self, pipeline: models.Pipeline):
         """Delete the directory for the given pipeline"""
-        container = self.get_user_container(pipeline.user)
+        container = self.get_running_user_container(pipeline.user)
+
+        self.stop_worker(container, pipeline)
 
         self.container_exec_run(
             container,
@@ -502,46 +1297,150 @@ class Containment:
             f" {containment_config.base_directory}/"
             f"{pipeline.get_containment_directory()}",
         )
+        self.dependency_cache.invalidate(container.name, pipeline.id)
+        self.manifest_cache.invalidate(container.name, pipeline.id)
 
-    def archive(
-        self,
-        piepline: models.Pipeline,
-        archive_type: str,
-        subroot: str,
-    ) -> bytes:
-        """Archive the given pipeline"""
-        with ContainmentFileSpecializer(piepline) as specializer:
-            return specializer.to_archive(archive_type, subroot)
-
-    def run_pipeline(
+    def sync_files(
         self,
+        container: Container,
         pipeline: models.Pipeline,
-        user_message: str,
-        refresh: RefreshToken,
-    ):
-        """Run the given pipeline"""
-        container = self.get_user_container(pipeline.user)
+        files: Dict[str, bytes],
+    ) -> List[str]:
+        """Synchronize the given files to the directory of the pipeline.
+
+        Only the files added or changed since the last synchronization are
+        uploaded, and the files no longer present are deleted. If the
+        directory was never synchronized, it is cleaned and all files are
+        uploaded.
 
+        Args:
+            container (Container): The container of the pipeline.
+            pipeline (models.Pipeline): The pipeline.
+            files (Dict[str, bytes]): The files mapped by their paths
+                relative to the directory of the pipeline.
+
+        Returns:
+            List[str]: The paths of the uploaded and deleted files.
+        """
         workdir = (
             f"{containment_config.base_directory}/"
             f"{pipeline.get_containment_directory()}"
         )
+        key = (container.name, pipeline.id)
+        manifest = ContainmentManifestCache.manifest(files)
+        previous: Optional[Dict[str, str]] = self.manifest_cache.get(key)
 
-        # Specialize files
-        with ContainmentFileSpecializer(pipeline) as specializer:
-            # Remove old files except containment_config.python_venv
+        if previous == manifest:
+            return []
+
+        # Invalidate until synchronized in case anything fails in between
+        self.manifest_cache.invalidate(container.name, pipeline.id)
+
+        if previous is None:
+            # Remove old files except containment_config.python_venv and
+            # the files of the running worker
+            self.container_exec_run(
+                container,
+                "find . -mindepth 1 -maxdepth 1"
+                f" -not -name {containment_config.python_venv}"
+                f" -not -name {worker.SOCKET_PATH}"
+                f" -not -name {worker.LOCK_PATH}"
+                " -exec rm -rf {} +",
+                workdir=workdir,
+            )
+            previous = {}
+
+        changed = [
+            path
+            for path, digest in manifest.items()
+            if previous.get(path) != digest
+        ]
+        deleted = [path for path in previous if path not in manifest]
+
+        if deleted:
             self.container_exec_run(
                 container,
-                "find . -mindepth 1 -maxdepth 1 -not -name"
-                f" {containment_config.python_venv} -exec rm -rf {{}} +",
+                ["rm", "-f", *deleted],
                 workdir=workdir,
             )
 
-            # Put archive in container
-            if not container.put_archive(workdir, specializer.to_archive()):
+        if changed:
+            archive = self.files_to_archive(
+                {path: files[path] for path in changed}
+            )
+            if not container.put_archive(workdir, archive):
                 raise RuntimeError("Unable to copy files to container")
 
-        # Install dependencies
+        self.manifest_cache.set(key, manifest)
+
+        return changed + deleted
+
+    @staticmethod
+    def files_to_archive(files: Dict[str, bytes]) -> bytes:
+        """Convert the given files to a tar archive in memory.
+
+        The modification time is set to the current time so the cached
+        bytecode of the changed modules is invalidated in the container.
+        """
+        buffer = io.BytesIO()
+        mtime = time.time()
+
+        with tarfile.open(fileobj=buffer, mode="w") as archive:
+            for path, content in files.items():
+                info = tarfile.TarInfo(path)
+                info.size = len(content)
+                info.mtime = mtime
+                info.mode = 0o644
+                archive.addfile(info, io.BytesIO(content))
+
+        return buffer.getvalue()
+
+    def install_dependencies(
+        self,
+        container: Container,
+        pipeline: models.Pipeline,
+        requirements: str,
+    ) -> bool:
+        """Install the dependencies of the given pipeline.
+
+        The installation is skipped if the environment of the pipeline was
+        already installed with the same requirements, either as recorded in
+        the cache or in the stamp file left in the environment.
+
+        Returns:
+            bool: Whether the dependencies were installed.
+        """
+        workdir = (
+            f"{containment_config.base_directory}/"
+            f"{pipeline.get_containment_directory()}"
+        )
+        key = (container.name, pipeline.id)
+        digest = self.dependency_cache.digest(requirements)
+
+        if self.dependency_cache.get(key) == digest:
+            self.dependency_cache.count(hit=True)
+            return False
+
+        # Check the stamp left by a previous installation
+        stamp = (
+            f"{containment_config.python_venv}/"
+            f"{ContainmentDependencyCache.stamp_name}"
+        )
+        output, exit_code = self.container_exec_run(
+            container,
+            f"cat {stamp}",
+            workdir=workdir,
+            raise_for_exit_code=False,
+            return_exit_code=True,
+        )
+
+        if exit_code == 0 and output.strip() == digest:
+            self.dependency_cache.set(key, digest)
+            self.dependency_cache.count(hit=True)
+            return False
+
+        self.dependency_cache.count(hit=False)
+
         self.container_exec_run(
             container,
             "pip install -r requirements.txt",
@@ -549,34 +1448,623 @@ class Containment:
             pipeline=pipeline,
         )
 
-        # Run pipeline
-        sanitized_user_message = user_message.replace("'", "\\'")
-        output, exit_code = self.container_exec_run(
+        self.container_exec_run(
             container,
-            f"python -m main '{sanitized_user_message}'",
+            f"sh -c 'echo {digest} > {stamp}'",
             workdir=workdir,
+        )
+        self.dependency_cache.set(key, digest)
+
+        return True
+
+    def start_worker(self, container: Container, pipeline: models.Pipeline):
+        """Start the worker of the given pipeline in the background"""
+        self.logger.info(f"Starting worker for pipeline {pipeline.id}")
+
+        self.container_exec_run(
+            container,
+            "python -m worker serve",
+            workdir=(
+                f"{containment_config.base_directory}/"
+                f"{pipeline.get_containment_directory()}"
+            ),
+            pipeline=pipeline,
+            detach=True,
+        )
+
+    def stop_worker(self, container: Container, pipeline: models.Pipeline):
+        """Stop the worker of the given pipeline if it is running"""
+        self.container_exec_run(
+            container,
+            "python -m worker stop",
+            workdir=(
+                f"{containment_config.base_directory}/"
+                f"{pipeline.get_containment_directory()}"
+            ),
             pipeline=pipeline,
-            env={
-                "CHAT_COMPOSER_ACCESS_TOKEN": refresh.access_token,
-                "CHAT_COMPOSER_REFRESH_TOKEN": str(refresh),
-                "CHAT_COMPOSER_URL": web_config.url,
-                "CHAT_COMPOSER_PORT": web_config.port,
-            },
             raise_for_exit_code=False,
-            return_exit_code=True,
         )
 
-        # Save output if exit code is not 0
-        if exit_code == 0:
+    def worker_exec_stream(
+        self,
+        container: Container,
+        pipeline: models.Pipeline,
+        request: Dict[str, Any],
+    ) -> Generator[Dict[str, Any], None, int]:
+        """Run the given request with the worker of the given pipeline.
+
+        The worker is started if it is not running. If the persistent worker
+        is disabled, the request is run in a new interpreter instead.
+
+        The events of the run are yielded as they are received, and the exit
+        code is returned when the run finishes. The events are read from
+        stdout, any other line, such as errors of the interpreter written to
+        stderr, is yielded as an output event of its stream.
+
+        The request is copied to a file in the directory of the pipeline, as
+        it may be too large to be passed in the environment, and only its ID
+        is passed to the worker, which deletes the file once read. A request
+        larger than the request limit, e.g. with very large states, is not
+        run, and an error is yielded as output instead.
+        """
+        workdir = (
+            f"{containment_config.base_directory}/"
+            f"{pipeline.get_containment_directory()}"
+        )
+        data = json.dumps(request).encode("utf-8")
+
+        if len(data) > containment_config.request_limit:
+            yield {
+                "event": "output",
+                "stream": "stderr",
+                "data": (
+                    f"The request of {len(data)} bytes, with the messages and"
+                    " the states of the pipeline, exceeds the limit of"
+                    f" {containment_config.request_limit} bytes\n"
+                ),
+            }
+            return 1
+
+        request_id = uuid.uuid4().hex
+        archive = self.files_to_archive(
+            {str(worker.request_path(request_id)): data}
+        )
+        if not container.put_archive(workdir, archive):
+            raise RuntimeError("Unable to copy request to container")
+
+        env = {worker.REQUEST_ENV: request_id}
+
+        if containment_config.persistent_worker:
+            commands = [
+                "python -m worker send",
+                "python -m worker send --wait",
+            ]
+        else:
+            commands = [f"python -m worker {request['command']}"]
+
+        for i, command in enumerate(commands):
+            if i > 0:
+                self.start_worker(container, pipeline)
+
+            received = False
+            stream = self.container_exec_stream(
+                container,
+                command,
+                workdir=workdir,
+                pipeline=pipeline,
+                env=env,
+            )
+
+            while True:
+                try:
+                    name, line = next(stream)
+                except StopIteration as e:
+                    exit_code: int = e.value
+                    break
+
+                received = True
+
+                if name == "stdout":
+                    try:
+                        yield json.loads(line)
+                        continue
+                    except json.JSONDecodeError:
+                        pass
+
+                yield {"event": "output", "stream": name, "data": line}
+
+            if received or exit_code != worker.EXIT_UNAVAILABLE:
+                break
+
+        return exit_code
+
+    def archive(
+        self,
+        piepline: models.Pipeline,
+        archive_type: str,
+        subroot: str,
+    ) -> bytes:
+        """Archive the given pipeline"""
+        with ContainmentFileSpecializer(piepline) as specializer:
+            return specializer.to_archive(archive_type, subroot)
+
+    def prepare_pipeline(
+        self, container: Container, pipeline: models.Pipeline
+    ) -> Optional[Dict[str, str]]:
+        """Prepare the directory of the given pipeline to run
+
+        The files are synchronized and the dependencies are installed. The
+        worker is stopped to be restarted with the new files unless only the
+        pipeline modules changed, which are reloaded by the worker itself.
+
+        Returns:
+            Optional[Dict[str, str]]: The digests of the content of the
+                pipeline modules mapped by their paths, for the worker to
+                reload the changed modules, or None if they are unknown.
+        """
+        # Create directory if its state is unknown
+        if self.manifest_cache.get((container.name, pipeline.id)) is None:
+            self.create_pipeline_directory(pipeline)
+
+        # Specialize files
+        with ContainmentFileSpecializer(pipeline) as specializer:
+            files = specializer.files()
+
+        # Synchronize files
+        changed = self.sync_files(container, pipeline, files)
+
+        requirements = files["requirements.txt"].decode("utf-8")
+
+        # Install dependencies
+        installed = self.install_dependencies(
+            container, pipeline, requirements
+        )
+
+        # Restart worker
+        if installed or any(
+            not path.startswith("pipeline/") for path in changed
+        ):
+            self.stop_worker(container, pipeline)
+
+        # The manifest of the files is left in the cache by the synchronization
+        manifest = self.manifest_cache.get((container.name, pipeline.id))
+        if manifest is None:
+            return None
+
+        return {
+            path: digest
+            for path, digest in manifest.items()
+            if path.startswith("pipeline/")
+        }
+
+    def run_pipeline(
+        self,
+        pipeline: models.Pipeline,
+        user_message: str,
+        refresh: RefreshToken,
+    ) -> Optional[models.Chat]:
+        """Run the given pipeline
+
+        Returns:
+            Optional[models.Chat]: The chat saved by the run.
+        """
+        chat = None
+
+        for event, data in self.run_pipeline_stream(
+            pipeline, user_message, refresh
+        ):
+            if event == "chat":
+                chat = data
+
+        return chat
+
+    def run_pipeline_stream(
+        self,
+        pipeline: models.Pipeline,
+        user_message: str,
+        refresh: RefreshToken,
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """Run the given pipeline, streaming the output
+
+        The run waits for a slot from the scheduler first.
+
+        Yields:
+            Tuple[str, Any]: The `("output", str)` events for the output of
+                the pipeline as it is produced, followed by a
+                `("response", dict)` event for the response encoded as JSON
+                if the pipeline produced one, and a `("chat", models.Chat)`
+                event for the chat saved with the result of the run.
+        """
+        if self.get_executor(pipeline) == enums.Executor.RESTRICTED:
+            yield from self.run_pipeline_restricted_stream(
+                pipeline, user_message, refresh
+            )
+            return
+
+        name = pipeline.user.get_containment_name()
+
+        with self.scheduler.slot(name), self.use_user_container(
+            pipeline.user
+        ) as container:
+            yield from self.run_pipeline_container_stream(
+                container, pipeline, user_message, refresh
+            )
+
+    @staticmethod
+    def get_executor(pipeline: models.Pipeline) -> enums.Executor:
+        """Get the executor to run the given pipeline with
+
+        The executor of the pipeline is used if set, otherwise the executor
+        of the deployment. A pipeline only selects the restricted executor if
+        it is allowed by the deployment and the pipeline is owned by an admin,
+        as RestrictedPython is not a sandbox for the code of other users.
+        """
+        default = enums.Executor(containment_config.executor)
+
+        if pipeline.executor == enums.Executor.RESTRICTED and (
+            default == enums.Executor.RESTRICTED
+            or (
+                containment_config.restricted_allowed
+                and pipeline.user.is_staff
+            )
+        ):
+            return enums.Executor.RESTRICTED
+
+        if pipeline.executor == enums.Executor.DEFAULT:
+            return default
+
+        return enums.Executor.DOCKER
+
+    def run_pipeline_container_stream(
+        self,
+        container: Container,
+        pipeline: models.Pipeline,
+        user_message: str,
+        refresh: RefreshToken,
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """Run the given pipeline in the given container
+
+        See `run_pipeline_stream` for the events yielded.
+        """
+        digests = self.prepare_pipeline(container, pipeline)
+
+        # Run pipeline
+        stream = self.worker_exec_stream(
+            container,
+            pipeline,
+            {
+                "command": "run",
+                "user_message": user_message,
+                "states": pipeline.get_states(),
+                "digests": digests,
+                "env": self.pipeline_env(refresh),
+            },
+        )
+
+        yield from self.run_events_stream(pipeline, user_message, stream)
+
+    def run_pipeline_restricted_stream(
+        self,
+        pipeline: models.Pipeline,
+        user_message: str,
+        refresh: RefreshToken,
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """Run the given pipeline with the restricted executor
+
+        The pipeline runs in a process of the server without a container,
+        the output is yielded when the run finishes. See
+        `run_pipeline_stream` for the events yielded.
+        """
+        with ContainmentFileSpecializer(pipeline) as specializer:
+            digest = specializer.digest()
+            files = {
+                path: content
+                for path, content in specializer.contents.items()
+                if path.startswith(f"{restricted.PACKAGE}/")
+            }
+
+        events, exit_code = restricted.restricted_executor.run(
+            digest,
+            files,
+            {
+                "user_message": user_message,
+                "states": pipeline.get_states(),
+                "env": self.pipeline_env(refresh),
+            },
+        )
+
+        def stream() -> Generator[Dict[str, Any], None, int]:
+            yield from events
+            return exit_code
+
+        yield from self.run_events_stream(pipeline, user_message, stream())
+
+    def run_events_stream(
+        self,
+        pipeline: models.Pipeline,
+        user_message: str,
+        stream: Generator[Dict[str, Any], None, int],
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """Handle the events of a run, saving the chat
+
+        See `run_pipeline_stream` for the events yielded.
+        """
+        output = []
+        output_size = 0
+        result: Optional[Dict[str, Any]] = None
+
+        while True:
+            try:
+                event = next(stream)
+            except StopIteration as e:
+                exit_code: int = e.value
+                break
+
+            if event["event"] == "output":
+                # Only the output within the limit is kept for the chat
+                if output_size < containment_config.output_limit:
+                    output.append(event["data"])
+                    output_size += len(event["data"])
+
+                yield "output", event["data"]
+            elif event["event"] == "result":
+                result = event["result"]
+
+        # Save the result of the pipeline, or the output if there is none
+        if result is not None:
+            chat = self.result_chat(pipeline, result)
+            yield "response", result.get("response")
+        else:
+            chat = self.fatal_chat(pipeline, user_message, exit_code, output)
+
+        self.log_calls(pipeline, [result])
+
+        yield "chat", self.save_chats(pipeline, [chat], [result])[0]
+
+    def run_pipeline_batch(
+        self,
+        pipeline: models.Pipeline,
+        user_messages: List[str],
+        refresh: RefreshToken,
+        parallel: int = 1,
+    ) -> List[models.Chat]:
+        """Run the given pipeline with each of the given messages
+
+        The pipeline is prepared once and all messages are run by one worker,
+        in up to `parallel` processes. The chats are created in bulk, along
+        with the changes to the states.
+
+        Returns:
+            List[models.Chat]: The chats in the order of the messages.
+        """
+        name = pipeline.user.get_containment_name()
+
+        with self.scheduler.slot(name), self.use_user_container(
+            pipeline.user
+        ) as container:
+            digests = self.prepare_pipeline(container, pipeline)
+
+            outputs: List[List[str]] = [[] for _ in user_messages]
+            exit_codes: List[int] = [1 for _ in user_messages]
+            results: List[Optional[Dict[str, Any]]] = [
+                None for _ in user_messages
+            ]
+            errors: List[str] = []
+
+            stream = self.worker_exec_stream(
+                container,
+                pipeline,
+                {
+                    "command": "batch",
+                    "user_messages": user_messages,
+                    "parallel": parallel,
+                    "states": pipeline.get_states(),
+                    "digests": digests,
+                    "env": self.pipeline_env(refresh),
+                },
+            )
+
+            while True:
+                try:
+                    event = next(stream)
+                except StopIteration as e:
+                    exit_code: int = e.value
+                    break
+
+                index: Optional[int] = event.get("index")
+                if index is None:
+                    if event["event"] == "output":
+                        errors.append(event["data"])
+                    continue
+
+                if event["event"] == "output":
+                    outputs[index].append(event["data"])
+                elif event["event"] == "exit":
+                    exit_codes[index] = event["exit_code"]
+                elif event["event"] == "result":
+                    results[index] = event["result"]
+
+        chats = []
+        for i, user_message in enumerate(user_messages):
+            result = results[i]
+
+            if result is None:
+                chats.append(
+                    self.fatal_chat(
+                        pipeline,
+                        user_message,
+                        exit_codes[i] or exit_code or 1,
+                        outputs[i] or errors,
+                    )
+                )
+                continue
+
+            chats.append(self.result_chat(pipeline, result))
+
+        self.log_calls(pipeline, results)
+
+        return self.save_chats(pipeline, chats, results)
+
+    def save_chats(
+        self,
+        pipeline: models.Pipeline,
+        chats: List[models.Chat],
+        results: List[Optional[Dict[str, Any]]],
+    ) -> List[models.Chat]:
+        """Save the chats and the changes to the states in one transaction
+
+        The results are those of the chats, or None for the runs without a
+        result. The patches and the key-value operations of the results are
+        each concatenated in order to be applied at once, and nothing is
+        written for the states if no run changed them. The metrics of the
+        components are saved with the chats.
+
+        As the runs of a batch start from the same states, their patches may
+        conflict. The changes to the states are then dropped and logged, and
+        the chats are saved regardless.
+
+        Returns:
+            List[models.Chat]: The created chats.
+        """
+        component_patches: Dict[int, List[Dict[str, Any]]] = {}
+        pipeline_patch: List[Dict[str, Any]] = []
+        component_ops: Dict[int, List[Dict[str, Any]]] = {}
+        pipeline_ops: List[Dict[str, Any]] = []
+
+        for result in results:
+            if result is None:
+                continue
+
+            if result["patches"] is not None:
+                for component_state in result["patches"]["component_states"]:
+                    component_patches.setdefault(
+                        component_state["id"], []
+                    ).extend(component_state["patch"])
+
+                pipeline_patch.extend(result["patches"]["pipeline_state"])
+
+            if result["ops"] is not None:
+                for component_state in result["ops"]["component_states"]:
+                    component_ops.setdefault(component_state["id"], []).extend(
+                        component_state["ops"]
+                    )
+
+                pipeline_ops.extend(result["ops"]["pipeline_state"])
+
+        with transaction.atomic():
+            try:
+                # The states are rolled back alone if they cannot be changed
+                with transaction.atomic():
+                    if component_patches or pipeline_patch:
+                        pipeline.patch_states(
+                            {
+                                "component_states": [
+                                    {"id": id, "patch": patch}
+                                    for id, patch in component_patches.items()
+                                ],
+                                "pipeline_state": pipeline_patch,
+                            }
+                        )
+
+                    if component_ops or pipeline_ops:
+                        pipeline.apply_state_ops(
+                            {
+                                "component_states": [
+                                    {"id": id, "ops": ops}
+                                    for id, ops in component_ops.items()
+                                ],
+                                "pipeline_state": pipeline_ops,
+                            }
+                        )
+            except ValueError as e:
+                self.logger.warning(
+                    "Unable to change the states of pipeline"
+                    f" {pipeline.id}: {e}"
+                )
+
+            chats = models.Chat.objects.bulk_create(chats)
+            pipeline.create_component_metrics(
+                chats,
+                [
+                    [] if result is None else result.get("metrics", [])
+                    for result in results
+                ],
+            )
+
+            return chats
+
+    @staticmethod
+    def pipeline_env(refresh: RefreshToken) -> Dict[str, str]:
+        """Get the environment variables for running a pipeline"""
+        return {
+            "CHAT_COMPOSER_ACCESS_TOKEN": str(refresh.access_token),
+            "CHAT_COMPOSER_REFRESH_TOKEN": str(refresh),
+            "CHAT_COMPOSER_URL": web_config.url,
+            "CHAT_COMPOSER_PORT": str(web_config.port),
+            "CHAT_COMPOSER_CONNECT_TIMEOUT": str(
+                containment_config.client_connect_timeout
+            ),
+            "CHAT_COMPOSER_READ_TIMEOUT": str(
+                containment_config.client_read_timeout
+            ),
+            "CHAT_COMPOSER_RETRIES": str(containment_config.client_retries),
+            "CHAT_COMPOSER_ASYNC_CONCURRENCY": str(
+                containment_config.client_async_concurrency
+            ),
+            "CHAT_COMPOSER_TRACE_MEMORY": (
+                "1" if containment_config.trace_memory else ""
+            ),
+            worker.OUTPUT_LIMIT_ENV: str(containment_config.output_limit),
+            worker.RUN_TIMEOUT_ENV: str(containment_config.run_timeout),
+        }
+
+    def log_calls(
+        self,
+        pipeline: models.Pipeline,
+        results: List[Optional[Dict[str, Any]]],
+    ):
+        """Log the latency of the HTTP calls reported by the results"""
+        latencies = [
+            call["latency"]
+            for result in results
+            if result is not None
+            for call in result.get("calls", [])
+        ]
+        if not latencies:
             return
 
-        models.Chat.objects.create(
+        self.logger.info(
+            f"Pipeline {pipeline.id} made {len(latencies)} calls in"
+            f" {sum(latencies):.3f}s (max {max(latencies):.3f}s)"
+        )
+
+    @staticmethod
+    def result_chat(
+        pipeline: models.Pipeline, result: Dict[str, Any]
+    ) -> models.Chat:
+        """Get the unsaved chat for the result of a run"""
+        return models.Chat(
+            pipeline=pipeline,
+            user_message=result["chat"]["user_message"],
+            resp_message=result["chat"]["resp_message"],
+            exit_code=result["chat"]["exit_code"],
+        )
+
+    @staticmethod
+    def fatal_chat(
+        pipeline: models.Pipeline,
+        user_message: str,
+        exit_code: int,
+        output: List[str],
+    ) -> models.Chat:
+        """Get the unsaved chat for a run which did not save one"""
+        return models.Chat(
             pipeline=pipeline,
             user_message=user_message,
             resp_message=(
                 f"**FATAL ERROR**: Container exited with code {exit_code}\n"
                 "```\n"
-                f"{output}"
+                f"{''.join(output)}"
                 "```"
             ),
             exit_code=exit_code,
@@ -1,12 +1,35 @@
 """Chat Composer module."""
 
+import base64
+import contextlib
+import contextvars
+import copy
+import functools
+import hashlib
+import json
 import os
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from types import TracebackType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
 import requests
-from typing import Any, Dict, List, Optional, Type
 from pydantic import BaseModel
 
+from utils import json_patch
+
+from . import metrics, store
+from .client import Client
+
 
 class ComponentState(BaseModel):
     """State of a component."""
@@ -22,11 +45,209 @@ class States(BaseModel):
     pipeline_state: Dict[str, Any]
 
 
-def url(path: str) -> str:
-    """Get the composer URL for the given path."""
+def diff_states(old: States, new: States) -> Optional[Dict[str, Any]]:
+    """Get the patches of the states changed from the old states.
+
+    Returns:
+        Optional[Dict[str, Any]]: The patches of the changed component
+            states and the pipeline state, or None if nothing changed.
+    """
+    old_component_states = {
+        component_state.id: component_state.state
+        for component_state in old.component_states
+    }
+
+    component_states = []
+    for component_state in new.component_states:
+        component_patch = json_patch.diff(
+            old_component_states.get(component_state.id, {}),
+            component_state.state,
+        )
+        if component_patch:
+            component_states.append(
+                {"id": component_state.id, "patch": component_patch}
+            )
+
+    pipeline_state = json_patch.diff(old.pipeline_state, new.pipeline_state)
+
+    if not component_states and not pipeline_state:
+        return None
+
+    return {
+        "component_states": component_states,
+        "pipeline_state": pipeline_state,
+    }
+
+
+def get_ops() -> Optional[Dict[str, Any]]:
+    """Get the operations recorded by the key-value stores.
+
+    Returns:
+        Optional[Dict[str, Any]]: The operations on the component states and
+            the pipeline state, or None if there is none.
+    """
+    run = _run.get()
+    if run is None:
+        return None
+
+    component_states = [
+        {"id": id, "ops": ops}
+        for id, ops in run.ops["component_states"].items()
+        if ops
+    ]
+    pipeline_state = run.ops["pipeline_state"]
+
+    if not component_states and not pipeline_state:
+        return None
+
+    return {
+        "component_states": component_states,
+        "pipeline_state": pipeline_state,
+    }
+
+
+def apply_states(
+    states: Dict[str, Any],
+    patches: Optional[Dict[str, Any]],
+    ops: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Apply the patches and then the operations to a copy of the states."""
+    states = copy.deepcopy(states)
+
+    if patches is not None:
+        component_patches = {
+            component_state["id"]: component_state["patch"]
+            for component_state in patches["component_states"]
+        }
+
+        for component_state in states["component_states"]:
+            component_state["state"] = json_patch.apply(
+                component_state["state"],
+                component_patches.get(component_state["id"], []),
+            )
+
+        states["pipeline_state"] = json_patch.apply(
+            states["pipeline_state"], patches["pipeline_state"]
+        )
+
+    if ops is not None:
+        component_ops = {
+            component_state["id"]: component_state["ops"]
+            for component_state in ops["component_states"]
+        }
+
+        for component_state in states["component_states"]:
+            for op in component_ops.get(component_state["id"], []):
+                store.apply(component_state["state"], op)
+
+        for op in ops["pipeline_state"]:
+            store.apply(states["pipeline_state"], op)
+
+    return states
+
+
+class Run:
+    """States of a run, and the operations and metrics recorded by it.
+
+    The threads of a wave of parallel components each run on a copy, which
+    is merged back after the wave, see `run_parallel`.
+    """
+
+    def __init__(self, states: States, initial_states: States):
+        """Initialize the run"""
+        self.states = states
+        self.initial_states = initial_states
+        self.ops: Dict[str, Any] = {
+            "component_states": {},
+            "pipeline_state": [],
+        }
+        self.metrics: List[Dict[str, Any]] = []
+
+    def component_state(self, id: int) -> Dict[str, Any]:
+        """Get the state of the component with the given ID"""
+        for component_state in self.states.component_states:
+            if component_state.id == id:
+                return component_state.state
+
+        raise ValueError(f"component with id {id} not found")
+
+    def component_store(self, id: int) -> store.Store:
+        """Get the key-value store of the component with the given ID"""
+        for initial_state in self.initial_states.component_states:
+            if initial_state.id == id:
+                return store.Store(
+                    self.component_state(id),
+                    initial_state.state,
+                    self.ops["component_states"].setdefault(id, []),
+                )
+
+        raise ValueError(f"component with id {id} not found")
+
+    def pipeline_store(self) -> store.Store:
+        """Get the key-value store of the pipeline"""
+        return store.Store(
+            self.states.pipeline_state,
+            self.initial_states.pipeline_state,
+            self.ops["pipeline_state"],
+        )
+
+    def copy(self) -> "Run":
+        """Copy the current states, with no operations or metrics"""
+        states = self.states.model_copy(deep=True)
+        return Run(states, states.model_copy(deep=True))
+
+    def merge(self, run: "Run"):
+        """Merge the changes, operations and metrics of the copy
+
+        The states changed directly are patched, and the operations are
+        recorded again, as if they were made on this run.
+        """
+        patches = diff_states(run.initial_states, run.states)
+        if patches is not None:
+            self.states = States(
+                **apply_states(self.states.model_dump(), patches)
+            )
+
+        for id, ops in run.ops["component_states"].items():
+            component_store = self.component_store(id)
+            for op in ops:
+                component_store.record(op)
+
+        pipeline_store = self.pipeline_store()
+        for op in run.ops["pipeline_state"]:
+            pipeline_store.record(op)
+
+        self.metrics.extend(run.metrics)
+
+
+def current_run() -> Run:
+    """Get the current run."""
+    run = _run.get()
+    if run is None:
+        raise ValueError("states is None")
+
+    return run
+
+
+def base_url() -> str:
+    """Get the composer base URL."""
     port = os.environ.get("CHAT_COMPOSER_PORT", 8000)
     base_url = os.environ.get("CHAT_COMPOSER_URL", "http://localhost")
-    return f"{base_url}:{port}/{path}"
+    return f"{base_url}:{port}"
+
+
+def url(path: str) -> str:
+    """Get the composer URL for the given path."""
+    return f"{base_url()}/{path}"
+
+
+def client() -> Client:
+    """Get the shared HTTP client for the composer server.
+
+    The client keeps the connections alive between the calls, and records
+    the latency of each call to be reported with the run.
+    """
+    return _client
 
 
 def headers() -> Dict[str, str]:
@@ -64,10 +285,10 @@ def refresh() -> str:
 
 def component_id() -> int:
     """Get the current component ID."""
-    if _component_id is None:
+    if _component_id.get() is None:
         raise ValueError("component_id is None")
 
-    return _component_id
+    return _component_id.get()
 
 
 def pipeline_id() -> int:
@@ -80,30 +301,82 @@ def pipeline_id() -> int:
 
 def component_state(id: Optional[int] = None) -> Dict[str, Any]:
     """Get the state of the component with the given ID."""
-    if _states is None:
-        raise ValueError("states is None")
+    run = current_run()
 
     if id is None:
         id = component_id()
 
-    for component_state in _states.component_states:
-        if component_state.id == id:
-            return component_state.state
-
-    raise ValueError(f"component with id {id} not found")
+    return run.component_state(id)
 
 
 def pipeline_state() -> Dict[str, Any]:
     """Get the state of the pipeline."""
-    if _states is None:
-        raise ValueError("states is None")
+    return current_run().states.pipeline_state
+
+
+def component_store(id: Optional[int] = None) -> store.Store:
+    """Get the key-value store of the component with the given ID.
+
+    Unlike changing the state directly, the operations of the store are
+    applied per key atomically, e.g. `incr` keeps a counter correct even for
+    concurrent runs.
+    """
+    run = current_run()
+
+    if id is None:
+        id = component_id()
+
+    return run.component_store(id)
 
-    return _states.pipeline_state
+
+def pipeline_store() -> store.Store:
+    """Get the key-value store of the pipeline.
+
+    Unlike changing the state directly, the operations of the store are
+    applied per key atomically, e.g. `incr` keeps a counter correct even for
+    concurrent runs.
+    """
+    return current_run().pipeline_store()
+
+
+@contextlib.contextmanager
+def defer_results(
+    states: Optional[Dict[str, Any]] = None,
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """Collect the results of the runs instead of saving them.
+
+    Each result has the `chat` of a run, its `response` encoded by `encode`,
+    the `patches` of the states changed by the run and the `ops` recorded
+    by the key-value stores, each None if there is none or the run failed,
+    the HTTP `calls` made by the run and the `metrics` of its components.
+    If states are given, they are used as the initial states instead of
+    fetching them. The collected results are to be saved by the caller.
+    """
+    global _deferred_results
+    global _injected_states
+
+    results = []
+    _deferred_results = results
+    _injected_states = None if states is None else States(**states)
+
+    try:
+        yield results
+    finally:
+        _deferred_results = None
+        _injected_states = None
 
 
 _pipeline_id: Optional[int] = None
-_component_id: Optional[int] = None
-_states: Optional[States] = None
+_component_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "component_id", default=None
+)
+_run: contextvars.ContextVar[Optional[Run]] = contextvars.ContextVar(
+    "run", default=None
+)
+_deferred_results: Optional[List[Dict[str, Any]]] = None
+_injected_states: Optional[States] = None
+_lock = threading.Lock()
+_client = Client(base_url, headers, _component_id.get)
 
 
 class CurrentPipelineHelper:
@@ -114,20 +387,25 @@ class CurrentPipelineHelper:
         self.pipeline_id = pipeline_id
         self.user_message = user_message
         self.response = None
+        self.token = None
 
     def __enter__(self):
         """Enter the context"""
         global _pipeline_id
-        global _states
 
-        response = requests.get(
-            url(f"conductor/chat/states/{self.pipeline_id}/"),
-            headers=headers(),
-        )
-        response.raise_for_status()
+        _client.begin()
+
+        if _injected_states is not None:
+            states = _injected_states.model_copy(deep=True)
+        else:
+            response = _client.get(
+                f"conductor/chat/states/{self.pipeline_id}/"
+            )
+            response.raise_for_status()
+            states = States(**response.json())
 
         _pipeline_id = self.pipeline_id
-        _states = States(**response.json())
+        self.token = _run.set(Run(states, states.model_copy(deep=True)))
 
         return self
 
@@ -139,50 +417,73 @@ class CurrentPipelineHelper:
     ):
         """Exit the context"""
         global _pipeline_id
-        global _states
 
-        try:
-            # Save state if any
-            if exc_type is None:
-                response = requests.post(
-                    url(f"conductor/chat/states/{self.pipeline_id}/"),
-                    headers=headers(),
-                    json=_states.model_dump(),
-                )
-                response.raise_for_status()
+        run = current_run()
 
+        try:
             # Save chat
             if exc_type is None:
-                response = requests.patch(
-                    url(f"conductor/chat/save/chat/{self.pipeline_id}/"),
-                    headers=headers(),
-                    json={
-                        "user_message": self.user_message,
-                        "resp_message": str(self.response),
-                        "exit_code": 0,
-                    },
-                )
+                chat = {
+                    "user_message": self.user_message,
+                    "resp_message": str(self.response),
+                    "exit_code": 0,
+                }
             else:
                 traceback_str = "".join(traceback.format_exception(exc_value))
-                response = requests.patch(
-                    url(f"conductor/chat/save/chat/{self.pipeline_id}/"),
-                    headers=headers(),
-                    json={
-                        "user_message": self.user_message,
-                        "resp_message": (
-                            # fmt: off
-                            "Pipeline exited with code 1\n"
-                            "```\n"
-                            f"{traceback_str}"
-                            "```"
-                            # fmt: on
-                        ),
-                        "exit_code": 1,
-                    },
+                chat = {
+                    "user_message": self.user_message,
+                    "resp_message": (
+                        # fmt: off
+                        "Pipeline exited with code 1\n"
+                        "```\n"
+                        f"{traceback_str}"
+                        "```"
+                        # fmt: on
+                    ),
+                    "exit_code": 1,
+                }
+
+            # Only the changed states are saved
+            response = None
+            patches = None
+            ops = None
+            if exc_type is None:
+                response = encode(self.response)
+                patches = diff_states(run.initial_states, run.states)
+                ops = get_ops()
+
+            component_metrics = run.metrics
+            metrics.add_calls(component_metrics, _client.calls)
+
+            if _deferred_results is not None:
+                with _lock:
+                    _deferred_results.append(
+                        {
+                            "chat": chat,
+                            "response": response,
+                            "patches": patches,
+                            "ops": ops,
+                            "calls": _client.calls,
+                            "metrics": component_metrics,
+                        }
+                    )
+                return True
+
+            # Save state if any
+            if patches is not None or ops is not None:
+                response = _client.patch(
+                    f"conductor/chat/states/{self.pipeline_id}/",
+                    json={"patches": patches, "ops": ops},
                 )
+                response.raise_for_status()
+
+            response = _client.patch(
+                f"conductor/chat/save/chat/{self.pipeline_id}/",
+                json={**chat, "metrics": component_metrics},
+            )
             response.raise_for_status()
         finally:
-            _states = None
+            _run.reset(self.token)
             _pipeline_id = None
 
         return True
@@ -193,21 +494,36 @@ class CurrentPipelineHelper:
 
 
 class CurrentComponentHelper:
-    """Helper class for setting current component."""
+    """Helper class for setting current component.
+
+    Within a pipeline, the wall time, CPU time and peak memory of the
+    component are measured, to be saved with the chat.
+    """
 
     def __init__(self, component_id: int):
         """Initialize the helper"""
         self.component_id = component_id
+        self.token = None
+        self.meter: Optional[metrics.Meter] = None
 
     def __enter__(self):
         """Enter the context"""
-        global _component_id
-        _component_id = self.component_id
+        self.token = _component_id.set(self.component_id)
+
+        if _run.get() is not None:
+            self.meter = metrics.Meter(self.component_id)
+            self.meter.start()
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit the context"""
-        global _component_id
-        _component_id = None
+        _component_id.reset(self.token)
+
+        if self.meter is not None:
+            metric = self.meter.stop()
+            run = _run.get()
+            if run is not None:
+                run.metrics.append(metric)
+            self.meter = None
 
 
 def init_pipeline(
@@ -222,3 +538,146 @@ def init_component(
 ) -> CurrentComponentHelper:
     """Set the current component"""
     return CurrentComponentHelper(component_id)
+
+
+def run_parallel(*functions: Callable[[], Any]):
+    """Run the functions concurrently in threads.
+
+    Each function runs in a copy of the current context, so the current
+    component is kept per function. Within a run, each function also runs on
+    a copy of the states, so the threads share no state, and the copies are
+    merged in the order of the functions once all functions are done: a key
+    changed by many functions has the value of the last one. Then the first
+    exception raised, in the order of the functions, is re-raised.
+    """
+    if len(functions) == 1:
+        functions[0]()
+        return
+
+    run = _run.get()
+    runs = [None if run is None else run.copy() for _ in functions]
+
+    def call(function: Callable[[], Any], thread_run: Optional[Run]) -> Any:
+        if thread_run is not None:
+            _run.set(thread_run)
+
+        return function()
+
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, call, *args)
+            for args in zip(functions, runs)
+        ]
+
+    if run is not None:
+        for thread_run in runs:
+            run.merge(thread_run)
+
+    for future in futures:
+        future.result()
+
+
+def is_json(value: Any) -> bool:
+    """Check if the value is made of JSON types only."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return True
+
+    if isinstance(value, list):
+        return all(is_json(item) for item in value)
+
+    if isinstance(value, dict):
+        return all(
+            isinstance(key, str) and is_json(item)
+            for key, item in value.items()
+        )
+
+    return False
+
+
+def encode(value: Any) -> Dict[str, Any]:
+    """Encode the value as JSON.
+
+    JSON values are kept as they are, bytes are encoded in base64, and the
+    other values are encoded as their string.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return {
+            "type": "bytes",
+            "data": base64.b64encode(value).decode("ascii"),
+        }
+
+    if is_json(value):
+        return {"type": "json", "data": value}
+
+    return {"type": "str", "data": str(value)}
+
+
+def server_sent_events(
+    response: requests.Response,
+) -> Generator[Tuple[str, Any], None, None]:
+    """Parse the server-sent events of the streamed response.
+
+    Yields:
+        Tuple[str, Any]: The name of each event and its data decoded from
+            JSON.
+    """
+    event = "message"
+    data: List[str] = []
+
+    for line in response.iter_lines(decode_unicode=True):
+        if line:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+            continue
+
+        # An empty line ends the event
+        if data:
+            yield event, json.loads("\n".join(data))
+
+        event = "message"
+        data = []
+
+
+def memoize(
+    function: Callable[..., Any], code_hash: str
+) -> Callable[..., Any]:
+    """Memoize the results of the component function.
+
+    The results are cached by the server by the hash of the code and the
+    arguments, and the function is not called if the result is cached.
+    Calls with arguments or results which are not JSON are not cached.
+    """
+
+    @functools.wraps(function)
+    def wrapper(**kwargs):
+        if not is_json(kwargs):
+            return function(**kwargs)
+
+        arguments = json.dumps(
+            {"code": code_hash, "arguments": kwargs}, sort_keys=True
+        )
+        key = hashlib.sha256(arguments.encode()).hexdigest()
+        path = f"conductor/component/cache/{component_id()}/"
+
+        response = _client.get(path, params={"key": key})
+        response.raise_for_status()
+        cached = response.json()
+
+        if cached["hit"]:
+            return cached["value"]
+
+        result = function(**kwargs)
+
+        if is_json(result):
+            response = _client.post(path, json={"key": key, "value": result})
+            response.raise_for_status()
+
+        return result
+
+    return wrapper
@@ -0,0 +1,181 @@
+"""HTTP client module.
+
+The client keeps a pooled keep-alive session to the composer server, with
+timeouts and bounded retries, and records the latency of each call. The
+asynchronous requests are run by a bounded pool of threads sharing the
+session, so many calls can be made concurrently from an event loop.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_SIZE = 16
+
+
+class Client:
+    """HTTP client for the composer server."""
+
+    def __init__(
+        self,
+        base_url: Callable[[], str],
+        headers: Callable[[], Dict[str, str]],
+        component_id: Callable[[], Optional[int]],
+    ):
+        """Initialize the client
+
+        Args:
+            base_url (Callable[[], str]): Function to get the base URL.
+            headers (Callable[[], Dict[str, str]]): Function to get the
+                headers.
+            component_id (Callable[[], Optional[int]]): Function to get the
+                current component ID, recorded with the calls.
+        """
+        self.get_base_url = base_url
+        self.get_headers = headers
+        self.get_component_id = component_id
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self.session: Optional[requests.Session] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.executor_pid: Optional[int] = None
+        self.base_url: Optional[str] = None
+        self.headers: Optional[Dict[str, str]] = None
+        self.calls: List[Dict[str, Any]] = []
+
+    def timeout(self) -> Tuple[float, float]:
+        """Get the connect and read timeouts in seconds."""
+        return (
+            float(os.environ.get("CHAT_COMPOSER_CONNECT_TIMEOUT", 5.0)),
+            float(os.environ.get("CHAT_COMPOSER_READ_TIMEOUT", 300.0)),
+        )
+
+    def get_session(self) -> requests.Session:
+        """Get the session, creating it for each process."""
+        with self.lock:
+            if self.session is None or self.pid != os.getpid():
+                # Connections must not be shared with the forking process
+                retries = Retry(
+                    total=int(os.environ.get("CHAT_COMPOSER_RETRIES", 3)),
+                    backoff_factor=0.2,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=POOL_SIZE,
+                    pool_maxsize=POOL_SIZE,
+                    max_retries=retries,
+                )
+
+                self.session = requests.Session()
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+                self.pid = os.getpid()
+
+            return self.session
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """Get the executor of the asynchronous requests for each process."""
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ThreadPoolExecutor(
+                    max_workers=int(
+                        os.environ.get("CHAT_COMPOSER_ASYNC_CONCURRENCY", 8)
+                    ),
+                    thread_name_prefix="composer-client",
+                )
+                self.executor_pid = os.getpid()
+
+            return self.executor
+
+    def begin(self):
+        """Begin a run, reading the URL and headers and clearing the calls."""
+        self.base_url = self.get_base_url()
+        self.headers = self.get_headers()
+        self.calls = []
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Send the request to the given path of the composer server.
+
+        The latency of the call is recorded, along with the component ID.
+        """
+        base_url = self.base_url or self.get_base_url()
+        headers = self.headers or self.get_headers()
+
+        start = time.perf_counter()
+        status = None
+
+        try:
+            response = self.get_session().request(
+                method,
+                f"{base_url}/{path}",
+                headers={**headers, **kwargs.pop("headers", {})},
+                timeout=kwargs.pop("timeout", self.timeout()),
+                **kwargs,
+            )
+            status = response.status_code
+
+            return response
+        finally:
+            call = {
+                "method": method,
+                "path": path,
+                "component_id": self.get_component_id(),
+                "status": status,
+                "latency": time.perf_counter() - start,
+            }
+
+            # The calls are made by the threads of the parallel components
+            with self.lock:
+                self.calls.append(call)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """Send a GET request to the given path."""
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """Send a POST request to the given path."""
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path: str, **kwargs) -> requests.Response:
+        """Send a PATCH request to the given path."""
+        return self.request("PATCH", path, **kwargs)
+
+    async def request_async(
+        self, method: str, path: str, **kwargs
+    ) -> requests.Response:
+        """Send the request without blocking the event loop.
+
+        At most `CHAT_COMPOSER_ASYNC_CONCURRENCY` requests are in flight at
+        once, the others wait for a free thread.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+
+        call = functools.partial(
+            context.run, self.request, method, path, **kwargs
+        )
+
+        return await loop.run_in_executor(self.get_executor(), call)
+
+    async def get_async(self, path: str, **kwargs) -> requests.Response:
+        """Send a GET request to the given path asynchronously."""
+        return await self.request_async("GET", path, **kwargs)
+
+    async def post_async(self, path: str, **kwargs) -> requests.Response:
+        """Send a POST request to the given path asynchronously."""
+        return await self.request_async("POST", path, **kwargs)
+
+    async def patch_async(self, path: str, **kwargs) -> requests.Response:
+        """Send a PATCH request to the given path asynchronously."""
+        return await self.request_async("PATCH", path, **kwargs)
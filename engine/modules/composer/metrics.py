@@ -0,0 +1,113 @@
+"""Metrics module.
+
+The meters measure the wall time, CPU time and peak memory of the
+components. By default, the peak memory is the growth of the peak resident
+memory of the process, which is free to measure but only counts memory
+beyond the previous peak. If `CHAT_COMPOSER_TRACE_MEMORY` is set, the
+allocations are traced while the components run instead, which is exact but
+slows down the components. The peak memory of components run in parallel is
+shared between them.
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+_lock = threading.Lock()
+_tracing = 0
+
+
+def is_tracing_memory() -> bool:
+    """Check if the allocations are traced to measure the peak memory."""
+    return bool(os.environ.get("CHAT_COMPOSER_TRACE_MEMORY"))
+
+
+def start_tracing():
+    """Start tracing the allocations if no component is traced."""
+    global _tracing
+
+    with _lock:
+        if _tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing += 1
+
+
+def stop_tracing():
+    """Stop tracing the allocations if no other component is traced."""
+    global _tracing
+
+    with _lock:
+        _tracing -= 1
+        if _tracing == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def max_rss() -> int:
+    """Get the peak resident memory of the process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # The peak is in kilobytes on Linux and in bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Meter:
+    """Meter of a component."""
+
+    def __init__(self, component_id: int):
+        """Initialize the meter"""
+        self.component_id = component_id
+        self.trace_memory = is_tracing_memory()
+        self.wall_start = 0.0
+        self.cpu_start = 0.0
+        self.memory_start = 0
+        self.metric: Optional[Dict[str, Any]] = None
+
+    def start(self):
+        """Start measuring the component."""
+        if self.trace_memory:
+            start_tracing()
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        else:
+            self.memory_start = max_rss()
+
+        self.cpu_start = time.thread_time()
+        self.wall_start = time.perf_counter()
+
+    def stop(self) -> Dict[str, Any]:
+        """Stop measuring the component, returning the metric."""
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.thread_time() - self.cpu_start
+
+        if self.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            stop_tracing()
+        else:
+            peak_memory = max_rss()
+
+        self.metric = {
+            "id": self.component_id,
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "peak_memory": max(peak_memory - self.memory_start, 0),
+            "calls": 0,
+            "call_latency": 0.0,
+        }
+        return self.metric
+
+
+def add_calls(metrics: List[Dict[str, Any]], calls: List[Dict[str, Any]]):
+    """Add the number and latency of the calls of each component."""
+    by_id: Dict[int, Dict[str, Any]] = {}
+    for metric in metrics:
+        by_id.setdefault(metric["id"], metric)
+
+    for call in calls:
+        metric = by_id.get(call["component_id"])
+        if metric is not None:
+            metric["calls"] += 1
+            metric["call_latency"] += call["latency"]
@@ -0,0 +1,92 @@
+"""Key-value store module.
+
+The stores record the operations on the keys of a state, to be applied
+atomically per key by the server, so the operations of concurrent runs, e.g.
+increments of a counter, are all kept.
+"""
+
+import copy
+from typing import Any, Dict, List, Union
+
+Op = Dict[str, Any]
+
+
+def is_number(value: Any) -> bool:
+    """Check if the value is a JSON number."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def apply(state: Dict[str, Any], op: Op):
+    """Apply the operation to the state in place.
+
+    Incrementing a missing key or a key which is not a number starts from 0,
+    and appending to a missing key or a key which is not a list starts from
+    an empty list.
+    """
+    key = op["key"]
+
+    if op["op"] == "set":
+        state[key] = copy.deepcopy(op["value"])
+    elif op["op"] == "delete":
+        state.pop(key, None)
+    elif op["op"] == "incr":
+        value = state.get(key)
+        state[key] = (value if is_number(value) else 0) + op["value"]
+    elif op["op"] == "append":
+        value = state.get(key)
+        state[key] = [*(value if isinstance(value, list) else [])]
+        state[key].append(copy.deepcopy(op["value"]))
+    else:
+        raise ValueError(f"unknown operation {op['op']}")
+
+
+class Store:
+    """Key-value store of a component or pipeline state."""
+
+    def __init__(
+        self,
+        state: Dict[str, Any],
+        initial_state: Dict[str, Any],
+        ops: List[Op],
+    ):
+        """Initialize the store"""
+        self.state = state
+        self.initial_state = initial_state
+        self.ops = ops
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value of the key."""
+        return self.state.get(key, default)
+
+    def set(self, key: str, value: Any):
+        """Set the value of the key."""
+        self.record({"op": "set", "key": key, "value": value})
+
+    def incr(
+        self, key: str, amount: Union[int, float] = 1
+    ) -> Union[int, float]:
+        """Increment the number of the key, returning the new number."""
+        if not is_number(amount):
+            raise TypeError("amount must be a number")
+
+        self.record({"op": "incr", "key": key, "value": amount})
+
+        return self.state[key]
+
+    def append(self, key: str, value: Any):
+        """Append the value to the list of the key."""
+        self.record({"op": "append", "key": key, "value": value})
+
+    def delete(self, key: str):
+        """Delete the key."""
+        self.record({"op": "delete", "key": key})
+
+    def record(self, op: Op):
+        """Apply the operation to the state and record it.
+
+        The operation is also applied to the initial state, so the change is
+        not sent again as a patch of the state.
+        """
+        apply(self.state, op)
+        apply(self.initial_state, op)
+        self.ops.append(copy.deepcopy(op))
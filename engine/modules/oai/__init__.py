@@ -3,14 +3,28 @@
 from . import api, enums, models  # noqa: F401
 
 # containment: not contained
+import json
 import logging
-from typing import Any, Dict
+import math
+from typing import Any, Dict, List, Optional
 
 import openai
 
+from conductor.audit import audit_writer
+from conductor.cache import llm_response_cache
+from conductor.gateway import llm_gateway
 from config.openai import openai_config
+from core import enums as core_enums
 from core import models as core_models
-from engine.modules.oai.models import Chatcmpl
+from engine.modules.oai.enums import FinishReason, Role
+from engine.modules.oai.models import (
+    Chatcmpl,
+    ChatcmplChunk,
+    Choice,
+    FunctionCall,
+    Message,
+    Usage,
+)
 from engine.modules.composer import component_id
 from oai import models as django_models
 
@@ -26,45 +40,283 @@ logger = logging.getLogger(__name__)
 openai_chatcmpl = openai.ChatCompletion.create
 
 
-def create_chatcmpl_models(request: Dict[str, Any], response: Chatcmpl):
-    """Create a Chatcmpl models from the request and response"""
-    current_component = core_models.Component.objects.get(id=component_id())
-
-    chatcmpl_request = django_models.ChatcmplRequest.objects.create(
-        response=django_models.Chatcmpl.objects.create(
-            id=response.id,
-            created=response.created,
-            model=response.model,
-            object=response.object,
-            usage=django_models.Usage.objects.create(
-                completion_tokens=response.usage.completion_tokens,
-                prompt_tokens=response.usage.prompt_tokens,
-                total_tokens=response.usage.total_tokens,
-            ),
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of the text, about 4 characters each"""
+    return math.ceil(len(text) / 4)
+
+
+def estimate_prompt_tokens(request: Dict[str, Any]) -> int:
+    """Estimate the number of prompt tokens of the request
+
+    Each message takes a few tokens more than its content, and the reply is
+    primed with a few tokens.
+    """
+    tokens = 3
+
+    for message in request["messages"]:
+        tokens += 4 + estimate_tokens(message["content"])
+        if message.get("name") is not None:
+            tokens += estimate_tokens(message["name"])
+
+    if request.get("functions") is not None:
+        tokens += estimate_tokens(json.dumps(request["functions"]))
+
+    return tokens
+
+
+def assemble_chatcmpl(
+    request: Dict[str, Any], chunks: List[ChatcmplChunk]
+) -> Optional[Chatcmpl]:
+    """Assemble the chat completion from the streamed chunks
+
+    The usage is not streamed, so it is estimated, the completion tokens by
+    the number of chunks of each choice, which is about a token each. None
+    is returned if no chunk has an ID, e.g. if the stream only contains the
+    prompt filter results or is interrupted before the first ID.
+    """
+    messages: Dict[int, Dict[str, Any]] = {}
+    completion_tokens = 0
+
+    for chunk in chunks:
+        for choice in chunk.choices:
+            message = messages.setdefault(
+                choice.index,
+                {
+                    "role": Role.ASSISTANT,
+                    "content": "",
+                    "function_call": None,
+                    "finish_reason": FinishReason.STOP,
+                },
+            )
+            delta = choice.delta
+
+            if delta.role is not None:
+                message["role"] = delta.role
+
+            if delta.content:
+                message["content"] += delta.content
+                completion_tokens += 1
+
+            if delta.function_call is not None:
+                function_call = message["function_call"] or {
+                    "name": "",
+                    "arguments": "",
+                }
+                function_call["name"] += delta.function_call.name or ""
+                function_call["arguments"] += (
+                    delta.function_call.arguments or ""
+                )
+                message["function_call"] = function_call
+                completion_tokens += 1
+
+            if choice.finish_reason is not None:
+                message["finish_reason"] = choice.finish_reason
+
+    # The first chunk may only contain the prompt filter results
+    chunk = next((chunk for chunk in reversed(chunks) if chunk.id), None)
+    if chunk is None:
+        return None
+
+    prompt_tokens = estimate_prompt_tokens(request)
+
+    return Chatcmpl(
+        id=chunk.id,
+        choices=[
+            Choice(
+                finish_reason=message["finish_reason"],
+                index=index,
+                message=Message(
+                    content=message["content"],
+                    function_call=(
+                        FunctionCall(**message["function_call"])
+                        if message["function_call"] is not None
+                        else None
+                    ),
+                    role=message["role"],
+                ),
+            )
+            for index, message in sorted(messages.items())
+        ],
+        created=chunk.created,
+        model=chunk.model,
+        object="chat.completion",
+        usage=Usage(
+            completion_tokens=completion_tokens,
+            prompt_tokens=prompt_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
         ),
-        request=request,
-        component=current_component,
     )
 
-    chatcmpl = chatcmpl_request.response
+
+def reserved_tokens(request: Dict[str, Any]) -> int:
+    """Get the tokens reserved by the request in the LLM gateway
+
+    The tokens are the estimated prompt tokens and the maximum completion
+    tokens of each choice.
+    """
+    completion_tokens = request["max_tokens"] * request["n"]
+
+    return estimate_prompt_tokens(request) + completion_tokens
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Get the seconds to wait before retrying the call failing with the error
+
+    The rate limits and the transient errors of the API are retried, after
+    the `Retry-After` header if given.
+    """
+    if not isinstance(
+        e,
+        (
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+        ),
+    ) and not (
+        isinstance(e, openai.error.APIError)
+        and e.http_status is not None
+        and e.http_status >= 500
+    ):
+        return None
+
+    try:
+        return float((e.headers or {}).get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def gateway_chatcmpl(request: Dict[str, Any]) -> Any:
+    """Call the OpenAI chat completion through the LLM gateway
+
+    The tokens of a streamed response are settled once it is assembled, see
+    `settle_chatcmpl`.
+    """
+    return llm_gateway.call(
+        core_enums.LlmProvider.OAI,
+        component_id(),
+        reserved_tokens(request),
+        lambda: openai_chatcmpl(**request),
+        retry_after,
+        lambda response: (
+            None if request["stream"] else response["usage"]["total_tokens"]
+        ),
+    )
+
+
+def settle_chatcmpl(
+    request: Dict[str, Any],
+    response: Chatcmpl,
+    current_component_id: Optional[int] = None,
+):
+    """Settle the tokens reserved by the request with the tokens used
+
+    The component defaults to the current component.
+    """
+    llm_gateway.settle(
+        core_enums.LlmProvider.OAI,
+        current_component_id or component_id(),
+        reserved_tokens(request),
+        response.usage.total_tokens,
+    )
+
+
+def create_chatcmpl_models(
+    request: Dict[str, Any],
+    response: Chatcmpl,
+    current_component_id: Optional[int] = None,
+):
+    """Create a Chatcmpl models from the request and response
+
+    The models are saved in the background by the audit writer. The
+    component defaults to the current component.
+    """
+    usage = django_models.Usage(
+        completion_tokens=response.usage.completion_tokens,
+        prompt_tokens=response.usage.prompt_tokens,
+        total_tokens=response.usage.total_tokens,
+    )
+    chatcmpl = django_models.Chatcmpl(
+        id=response.id,
+        created=response.created,
+        model=response.model,
+        object=response.object,
+        usage=usage,
+    )
+    records = [
+        usage,
+        chatcmpl,
+        django_models.ChatcmplRequest(
+            response=chatcmpl,
+            request=request,
+            component_id=current_component_id or component_id(),
+        ),
+    ]
 
     for choice in response.choices:
-        django_models.Choice.objects.create(
-            chatcmpl=chatcmpl,
-            finish_reason=choice.finish_reason,
-            index=choice.index,
-            message=django_models.Message.objects.create(
-                content=choice.message.content,
-                name=choice.message.name,
-                function_call=django_models.FunctionCall.objects.create(
-                    arguments=choice.message.function_call.arguments,
-                    name=choice.message.function_call.name,
-                )
-                if choice.message.function_call is not None
-                else None,
-                role=choice.message.role,
-            ),
+        function_call = (
+            django_models.FunctionCall(
+                arguments=choice.message.function_call.arguments,
+                name=choice.message.function_call.name,
+            )
+            if choice.message.function_call is not None
+            else None
+        )
+        message = django_models.Message(
+            content=choice.message.content,
+            name=choice.message.name,
+            function_call=function_call,
+            role=choice.message.role,
         )
 
+        if function_call is not None:
+            records.append(function_call)
+
+        records += [
+            message,
+            django_models.Choice(
+                chatcmpl=chatcmpl,
+                finish_reason=choice.finish_reason,
+                index=choice.index,
+                message=message,
+            ),
+        ]
+
+    audit_writer.write(records)
+
+
+def cache_key(request: Dict[str, Any]) -> str:
+    """Get the key of the request in the response cache"""
+    return llm_response_cache.key(
+        core_enums.LlmProvider.OAI, request["model"], request
+    )
+
+
+def get_cached_chatcmpl(request: Dict[str, Any]) -> Optional[Chatcmpl]:
+    """Get the cached response of the request for the current user"""
+    user = core_models.Component.objects.get(id=component_id()).user
+
+    hit, response = llm_response_cache.get(
+        user, core_enums.LlmProvider.OAI, cache_key(request)
+    )
+    if not hit:
+        return None
+
+    return Chatcmpl(**response)
+
+
+def set_cached_chatcmpl(request: Dict[str, Any], response: Chatcmpl):
+    """Set the cached response of the request for the current user"""
+    user = core_models.Component.objects.get(id=component_id()).user
+
+    llm_response_cache.set(
+        user,
+        core_enums.LlmProvider.OAI,
+        cache_key(request),
+        response.model_dump(),
+        response.usage.total_tokens,
+    )
+
 
 # containment: end
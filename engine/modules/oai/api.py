@@ -1,50 +1,72 @@
 """OpenAI API functions."""
 
-# containment: contained
-# import requests
+from typing import Iterator
 
-# containment: end
+from .models import Chatcmpl, ChatcmplChunk, ChatcmplRequest
 
-from .models import Chatcmpl, ChatcmplRequest
 
-
-def chatcmpl(request: ChatcmplRequest) -> Chatcmpl:
+def chatcmpl(request: ChatcmplRequest, cache: bool = False) -> Chatcmpl:
     """Call the OpenAI chat completion with the given request.
 
     The request and response are logged to the database.
 
+    If cached, the response of an identical request is reused, which is
+    meant for deterministic requests, e.g. with a temperature of 0.
+
     Args:
         request (models.ChatcmplRequest): The request to be sent to the API.
+        cache (bool): Whether to cache the response. Defaults to False.
 
     Returns:
         models.Chatcmpl: The response from the API.
     """
     # containment: not contained
     from engine.modules.oai import (
+        assemble_chatcmpl,
         create_chatcmpl_models,
+        gateway_chatcmpl,
+        get_cached_chatcmpl,
         logger,
-        openai_chatcmpl,
+        set_cached_chatcmpl,
+        settle_chatcmpl,
     )
 
     request = request.model_dump()
 
+    if cache:
+        response = get_cached_chatcmpl(request)
+        if response is not None:
+            logger.debug(f"Cached response: {response}")
+            return response
+
     logger.debug(f"Calling OpenAI chat completion with request: {request}")
 
-    response = openai_chatcmpl(**request)
-    response = Chatcmpl(**response)
+    response = gateway_chatcmpl(request)
+    if request["stream"]:
+        response = assemble_chatcmpl(
+            request, [ChatcmplChunk(**chunk) for chunk in response]
+        )
+        if response is None:
+            raise RuntimeError("The streamed chat completion has no ID")
+
+        settle_chatcmpl(request, response)
+    else:
+        response = Chatcmpl(**response)
 
     logger.debug(f"API response: {response}")
 
     create_chatcmpl_models(request, response)
 
+    if cache:
+        set_cached_chatcmpl(request, response)
+
     return response
     # containment: else
     # from modules import composer
 
-    # response = requests.post(
-    #     composer.url(f"conductor/chat/oai/chatcmpl/{composer.component_id()}/"),
-    #     json={"request": request.model_dump()},
-    #     headers=composer.headers(),
+    # response = composer.client().post(
+    #     f"conductor/chat/oai/chatcmpl/{composer.component_id()}/",
+    #     json={"request": request.model_dump(), "cache": cache},
     # )
     # response.raise_for_status()
     # response = response.json()["response"]
@@ -52,3 +74,114 @@ def chatcmpl(request: ChatcmplRequest) -> Chatcmpl:
 
     # return response
     # containment: end
+
+
+async def chatcmpl_async(
+    request: ChatcmplRequest, cache: bool = False
+) -> Chatcmpl:
+    """Call the OpenAI chat completion with the given request asynchronously.
+
+    Many calls can be made concurrently, e.g. with `asyncio.gather`, up to
+    a bounded number of calls in flight at once.
+
+    Args:
+        request (models.ChatcmplRequest): The request to be sent to the API.
+        cache (bool): Whether to cache the response, see `chatcmpl`.
+            Defaults to False.
+
+    Returns:
+        models.Chatcmpl: The response from the API.
+    """
+    # containment: not contained
+    import asyncio
+
+    return await asyncio.to_thread(chatcmpl, request, cache)
+    # containment: else
+    # from modules import composer
+
+    # response = await composer.client().post_async(
+    #     f"conductor/chat/oai/chatcmpl/{composer.component_id()}/",
+    #     json={"request": request.model_dump(), "cache": cache},
+    # )
+    # response.raise_for_status()
+    # response = response.json()["response"]
+    # response = Chatcmpl(**response)
+
+    # return response
+    # containment: end
+
+
+def chatcmpl_stream(request: ChatcmplRequest) -> Iterator[ChatcmplChunk]:
+    """Call the OpenAI chat completion with the given request, streaming.
+
+    The chunks of the response are yielded as they are received. The request
+    and the response assembled from the chunks are logged to the database
+    once the stream completes, with the usage estimated.
+
+    Args:
+        request (models.ChatcmplRequest): The request to be sent to the API.
+
+    Yields:
+        models.ChatcmplChunk: The chunks of the response from the API.
+    """
+    # containment: not contained
+    from engine.modules.composer import component_id
+    from engine.modules.oai import (
+        assemble_chatcmpl,
+        create_chatcmpl_models,
+        gateway_chatcmpl,
+        logger,
+        settle_chatcmpl,
+    )
+
+    request = {**request.model_dump(), "stream": True}
+
+    # The component may no longer be current once the stream is closed, e.g.
+    # if the client disconnects
+    current_component_id = component_id()
+
+    logger.debug(f"Streaming OpenAI chat completion with request: {request}")
+
+    chunks = []
+    try:
+        for chunk in gateway_chatcmpl(request):
+            chunk = ChatcmplChunk(**chunk)
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        # The chunks received are logged even if the stream is interrupted,
+        # without masking the error interrupting it
+        try:
+            response = (
+                assemble_chatcmpl(request, chunks)
+                if any(chunk.choices for chunk in chunks)
+                else None
+            )
+
+            logger.debug(f"API response: {response}")
+
+            if response is not None:
+                settle_chatcmpl(request, response, current_component_id)
+                create_chatcmpl_models(
+                    request, response, current_component_id
+                )
+        except Exception as e:
+            logger.error(f"Unable to log streamed chat completion: {e}")
+    # containment: else
+    # from modules import composer
+
+    # response = composer.client().post(
+    #     f"conductor/chat/oai/chatcmpl/stream/{composer.component_id()}/",
+    #     json={"request": request.model_dump()},
+    #     stream=True,
+    # )
+    # response.raise_for_status()
+
+    # with response:
+    #     for event, data in composer.server_sent_events(response):
+    #         if event == "error":
+    #             raise RuntimeError(data["detail"])
+
+    #         if event == "chunk":
+    #             yield ChatcmplChunk(**data)
+    # containment: end
@@ -100,6 +100,67 @@ class Chatcmpl(BaseModel):
     usage: Usage
 
 
+class FunctionCallDelta(BaseModel):
+    """Part of the function call in a chat completion chunk.
+
+    Attributes:
+        arguments (Optional[str]): The part of the arguments. Defaults to
+            None.
+        name (Optional[str]): The name of the function. Defaults to None.
+    """
+
+    arguments: Optional[str] = Field(None)
+    name: Optional[str] = Field(None)
+
+
+class Delta(BaseModel):
+    """Part of the message in a chat completion chunk.
+
+    Attributes:
+        content (Optional[str]): The part of the content. Defaults to None.
+        function_call (Optional[FunctionCallDelta]): The part of the
+            function call. Defaults to None.
+        role (Optional[Role]): The role, in the first chunk. Defaults to
+            None.
+    """
+
+    content: Optional[str] = Field(None)
+    function_call: Optional[FunctionCallDelta] = Field(None)
+    role: Optional[Role] = Field(None)
+
+
+class ChunkChoice(BaseModel):
+    """Message choice in a chat completion chunk.
+
+    Attributes:
+        delta (Delta): The part of the message.
+        finish_reason (Optional[FinishReason]): The finish reason, in the
+            last chunk. Defaults to None.
+        index (int): The index of the message.
+    """
+
+    delta: Delta
+    finish_reason: Optional[FinishReason] = Field(None)
+    index: int
+
+
+class ChatcmplChunk(BaseModel):
+    """Chat completion chunk streamed by OpenAI API.
+
+    Attributes:
+        choices (List[ChunkChoice]): The choices.
+        created (int): The created timestamp.
+        model (str): The model.
+        object (str): The object.
+    """
+
+    id: str
+    choices: List[ChunkChoice]
+    created: int
+    model: str
+    object: str
+
+
 class FunctionCallRequest(BaseModel):
     """Function call for chat completion to call.
 
@@ -194,7 +255,9 @@ class ChatcmplRequest(BaseModel):
         n (int): The number of responses to return. Defaults to 1.
         presence_penalty (float): The presence penalty. Defaults to 0.0.
         stop (Optional[str | List[str]]): The stop. Defaults to None.
-        stream (bool): Whether to stream the response. Defaults to False.
+        stream (bool): Whether to stream the response from the API, which
+            is assembled once complete. Defaults to False. To receive the
+            chunks as they are streamed, use `api.chatcmpl_stream` instead.
         temperature (float): The temperature. Defaults to 1.0.
         top_p (float): The top p. Defaults to 1.0.
         user (Optional[str]): The user. Defaults to None.
@@ -4,13 +4,21 @@ from . import models, api  # noqa: F401
 
 # containment: not contained
 
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 import logging
+import math
+import re
+from google.ai import generativelanguage as glm
 from google.protobuf.json_format import MessageToDict
 
+from conductor.audit import audit_writer
+from conductor.cache import llm_response_cache
+from conductor.gateway import llm_gateway
 from config.vertexai import vertexai_config
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from google.generativeai.types import GenerateContentResponse
+from core import enums as core_enums
 from core import models as core_models
 from engine.modules.composer import component_id
 from vai import models as django_models
@@ -21,6 +29,8 @@ model = genai.GenerativeModel("gemini-pro")
 
 logger = logging.getLogger(__name__)
 
+MAX_TOKENS = 2048
+
 
 def gemini_pro(
     contents: models.google_types.ContentsType,
@@ -43,39 +53,176 @@ def gemini_pro(
     Returns:
         GenerateContentResponse: The response from the API.
     """
-    # Create the client
-    response = model.generate_content(
-        contents,
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        stream=stream,
+    # The tokens used are settled once counted, see `create_gemini_pro_models`
+    response = llm_gateway.call(
+        core_enums.LlmProvider.VAI,
+        component_id(),
+        reserved_tokens(
+            {"contents": contents, "generation_config": generation_config}
+        ),
+        lambda: model.generate_content(
+            contents,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+            stream=stream,
+        ),
+        retry_after,
+        lambda response: None,
     )
 
     return response
 
 
+def reserved_tokens(request: Dict[str, Any]) -> int:
+    """Get the tokens reserved by the request in the LLM gateway
+
+    The tokens are the estimated prompt tokens and the maximum output
+    tokens.
+    """
+    max_tokens = (request.get("generation_config") or {}).get(
+        "max_tokens", MAX_TOKENS
+    )
+
+    return estimate_tokens(contents_text(request["contents"])) + max_tokens
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Get the seconds to wait before retrying the call failing with the error
+
+    The rate limits and the transient errors of the API are retried.
+    """
+    if isinstance(
+        e,
+        (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+        ),
+    ):
+        return 0.0
+
+    return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of the text locally
+
+    Each word takes about a token per 4 characters, and each other
+    character a token.
+    """
+    return sum(
+        math.ceil(len(word) / 4) if word[0].isalnum() else 1
+        for word in re.findall(r"\w+|[^\w\s]", text)
+    )
+
+
+def contents_text(contents: Any) -> str:
+    """Get the text of the contents, parts, or candidates"""
+    if isinstance(contents, str):
+        return contents
+
+    if isinstance(contents, list):
+        return "\n\n".join(contents_text(content) for content in contents)
+
+    if isinstance(contents, dict):
+        for key in ("text", "parts", "content"):
+            if key in contents:
+                return contents_text(contents[key])
+
+    return ""
+
+
+def token_count(request: Dict[str, Any], response: Dict[str, Any]) -> int:
+    """Estimate the number of tokens of the request and response
+
+    The pinned version of the API reports no usage metadata, so the number
+    is always estimated locally, see `estimate_tokens`, and is not exact.
+    """
+    return estimate_tokens(
+        contents_text(request["contents"])
+        + "\n\n"
+        + contents_text(response.get("candidates", []))
+    )
+
+
 def create_gemini_pro_models(
     request: Dict[str, Any],
     response: models.google_types.GenerateContentResponse,
 ):
-    """Create a Chatcmpl models from the request and response"""
-    current_component = core_models.Component.objects.get(id=component_id())
+    """Create a Chatcmpl models from the request and response
 
+    The models are saved in the background by the audit writer, which also
+    estimates the tokens, see `token_count`, and settles them in the LLM
+    gateway.
+    """
     response = MessageToDict(
         response._result._pb, preserving_proto_field_name=True
     )
+    current_component_id = component_id()
+
+    def build() -> List[django_models.GeminiProRequest]:
+        tokens = token_count(request, response)
+
+        llm_gateway.settle(
+            core_enums.LlmProvider.VAI,
+            current_component_id,
+            reserved_tokens(request),
+            tokens,
+        )
+
+        return [
+            django_models.GeminiProRequest(
+                token_count=tokens,
+                request=request,
+                response=response,
+                component_id=current_component_id,
+            )
+        ]
+
+    audit_writer.defer(build)
+
+
+def cache_key(request: Dict[str, Any]) -> str:
+    """Get the key of the request in the response cache"""
+    return llm_response_cache.key(
+        core_enums.LlmProvider.VAI, model.model_name, request
+    )
 
-    token_count = model.count_tokens(
-        request["contents"]
-        + "\n\n"
-        + response["candidates"][0]["content"]["parts"][0]["text"]
+
+def get_cached_gemini_pro(
+    request: Dict[str, Any],
+) -> Optional[GenerateContentResponse]:
+    """Get the cached response of the request for the current user"""
+    user = core_models.Component.objects.get(id=component_id()).user
+
+    hit, response = llm_response_cache.get(
+        user, core_enums.LlmProvider.VAI, cache_key(request)
+    )
+    if not hit:
+        return None
+
+    return GenerateContentResponse.from_response(
+        glm.GenerateContentResponse(response)
+    )
+
+
+def set_cached_gemini_pro(
+    request: Dict[str, Any], response: GenerateContentResponse
+):
+    """Set the cached response of the request for the current user"""
+    user = core_models.Component.objects.get(id=component_id()).user
+    response = MessageToDict(
+        response._result._pb, preserving_proto_field_name=True
     )
 
-    django_models.GeminiProRequest.objects.create(
-        token_count=token_count.total_tokens,
-        request=request,
-        response=response,
-        component=current_component,
+    llm_response_cache.set(
+        user,
+        core_enums.LlmProvider.VAI,
+        cache_key(request),
+        response,
+        token_count(request, response),
     )
 
 
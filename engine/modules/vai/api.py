@@ -1,21 +1,22 @@
 """Vertex AI API functions."""
 
-# containment: contained
-# import requests
-
-# containment: end
-
 from .models import (
     GeminiRequest,
     google_types,
 )
 
 
-def gemini_pro(request: GeminiRequest) -> google_types.GenerateContentResponse:
+def gemini_pro(
+    request: GeminiRequest, cache: bool = False
+) -> google_types.GenerateContentResponse:
     """Call the Gemini Pro chat with the given request.
 
+    If cached, the response of an identical request is reused, which is
+    meant for deterministic requests, e.g. with a temperature of 0.
+
     Args:
         request (GeminiRequest): The request.
+        cache (bool): Whether to cache the response. Defaults to False.
 
     Returns:
         GenerateContentResponse: The response from the API.
@@ -24,11 +25,19 @@ def gemini_pro(request: GeminiRequest) -> google_types.GenerateContentResponse:
     from engine.modules.vai import (
         gemini_pro,
         create_gemini_pro_models,
+        get_cached_gemini_pro,
         logger,
+        set_cached_gemini_pro,
     )
 
     request = request.model_dump()
 
+    if cache:
+        response = get_cached_gemini_pro(request)
+        if response is not None:
+            logger.debug(f"Cached response: {response}")
+            return response
+
     logger.debug(f"Calling Gemini Pro with request: {request}")
 
     response = gemini_pro(**request)
@@ -37,6 +46,9 @@ def gemini_pro(request: GeminiRequest) -> google_types.GenerateContentResponse:
 
     create_gemini_pro_models(request, response)
 
+    if cache:
+        set_cached_gemini_pro(request, response)
+
     return response
     # containment: else
     # from modules import composer
@@ -44,12 +56,49 @@ def gemini_pro(request: GeminiRequest) -> google_types.GenerateContentResponse:
     #     GenerateContentResponse,
     # )
 
-    # response = requests.post(
-    #     composer.url(
-    #         f"conductor/chat/vai/gemini-pro/{composer.component_id()}/"
-    #     ),
-    #     json={"request": request.model_dump()},
-    #     headers=composer.headers(),
+    # response = composer.client().post(
+    #     f"conductor/chat/vai/gemini-pro/{composer.component_id()}/",
+    #     json={"request": request.model_dump(), "cache": cache},
+    # )
+    # response.raise_for_status()
+    # response = response.json()["response"]
+    # response = google_types.GenerateContentResponse.from_response(
+    #     GenerateContentResponse(response)
+    # )
+
+    # return response
+    # containment: end
+
+
+async def gemini_pro_async(
+    request: GeminiRequest, cache: bool = False
+) -> google_types.GenerateContentResponse:
+    """Call the Gemini Pro chat with the given request asynchronously.
+
+    Many calls can be made concurrently, e.g. with `asyncio.gather`, up to
+    a bounded number of calls in flight at once.
+
+    Args:
+        request (GeminiRequest): The request.
+        cache (bool): Whether to cache the response, see `gemini_pro`.
+            Defaults to False.
+
+    Returns:
+        GenerateContentResponse: The response from the API.
+    """
+    # containment: not contained
+    import asyncio
+
+    return await asyncio.to_thread(gemini_pro, request, cache)
+    # containment: else
+    # from modules import composer
+    # from google.ai.generativelanguage_v1beta.types import (
+    #     GenerateContentResponse,
+    # )
+
+    # response = await composer.client().post_async(
+    #     f"conductor/chat/vai/gemini-pro/{composer.component_id()}/",
+    #     json={"request": request.model_dump(), "cache": cache},
     # )
     # response.raise_for_status()
     # response = response.json()["response"]
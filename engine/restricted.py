@@ -0,0 +1,573 @@
+"""Restricted executor module.
+
+The restricted executor runs the specialized pipelines in a pool of server
+processes instead of the user containers, compiled with RestrictedPython.
+The pipelines import only the whitelisted API of the modules of the server,
+and are limited in time and memory. RestrictedPython is not a sandbox for
+untrusted code, the executor is meant for trusted pipelines, e.g.
+benchmarks, for which the latency of the containers dominates the run, and
+only admins can select it.
+
+This file is not part of the containment files.
+"""
+
+import builtins
+import contextlib
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import types
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cachetools import LRUCache
+from RestrictedPython import compile_restricted
+from RestrictedPython.Eval import (
+    default_guarded_getitem,
+    default_guarded_getiter,
+)
+from RestrictedPython.Guards import (
+    full_write_guard,
+    guarded_iter_unpack_sequence,
+    guarded_unpack_sequence,
+    safe_builtins,
+    safer_getattr,
+)
+from RestrictedPython.Utilities import utility_builtins
+
+from config.containment import containment_config
+
+from . import worker
+
+PACKAGE = "pipeline"
+CACHE_SIZE = 32
+GRACE_PERIOD = 5.0
+STUCK_THREAD_TIMEOUT = 1.0
+
+ALLOWED_MODULES = frozenset(
+    (
+        "base64",
+        "collections",
+        "copy",
+        "dataclasses",
+        "datetime",
+        "decimal",
+        "enum",
+        "fractions",
+        "functools",
+        "hashlib",
+        "heapq",
+        "itertools",
+        "json",
+        "math",
+        "operator",
+        "random",
+        "re",
+        "statistics",
+        "string",
+        "textwrap",
+        "time",
+        "typing",
+        "uuid",
+    )
+)
+
+# The names of the API of the modules importable by the restricted code, the
+# rest of the modules, e.g. their imports of the server modules, is hidden
+API: Dict[str, Tuple[str, ...]] = {
+    "modules": (),
+    "modules.composer": (
+        "access",
+        "api_key",
+        "component_id",
+        "component_state",
+        "component_store",
+        "encode",
+        "headers",
+        "init_component",
+        "init_pipeline",
+        "is_json",
+        "memoize",
+        "pipeline_id",
+        "pipeline_state",
+        "pipeline_store",
+        "refresh",
+        "run_parallel",
+        "url",
+    ),
+    "modules.oai": (),
+    "modules.oai.api": ("chatcmpl", "chatcmpl_stream"),
+    "modules.oai.enums": ("FinishReason", "Role"),
+    "modules.oai.models": (
+        "Chatcmpl",
+        "ChatcmplChunk",
+        "ChatcmplRequest",
+        "Choice",
+        "ChunkChoice",
+        "Delta",
+        "Function",
+        "FunctionCall",
+        "FunctionCallDelta",
+        "FunctionCallRequest",
+        "Message",
+        "Parameter",
+        "Parameters",
+        "Usage",
+    ),
+    "modules.vai": (),
+    "modules.vai.api": ("gemini_pro",),
+    "modules.vai.enums": (
+        "GeminiHarmBlockThreshold",
+        "GeminiHarmCategory",
+        "GeminiRole",
+    ),
+    "modules.vai.models": (
+        "GeminiContent",
+        "GeminiGenerationConfig",
+        "GeminiPart",
+        "GeminiRequest",
+        "GeminiSafetySetting",
+    ),
+}
+
+BUILTINS = {
+    **safe_builtins,
+    **utility_builtins,
+    **{
+        name: getattr(builtins, name)
+        for name in (
+            "all",
+            "any",
+            "dict",
+            "enumerate",
+            "filter",
+            "iter",
+            "list",
+            "map",
+            "max",
+            "min",
+            "next",
+            "reversed",
+            "sum",
+        )
+    },
+    "getattr": safer_getattr,
+}
+
+_compiled: LRUCache = LRUCache(maxsize=CACHE_SIZE)
+_api_modules: Dict[str, types.ModuleType] = {}
+_timed_out = False
+
+
+class Printer:
+    """Printer of the restricted code, printing to the current stdout."""
+
+    def __init__(self, _getattr_=None):
+        """Initialize the printer"""
+        self._getattr_ = _getattr_
+
+    def __call__(self) -> str:
+        """Get the printed text, which is sent as output instead"""
+        return ""
+
+    def _call_print(self, *objects, **kwargs):
+        """Print the objects"""
+        if kwargs.get("file") is None:
+            kwargs["file"] = sys.stdout
+
+        print(*objects, **kwargs)
+
+
+def guarded_write(ob: Any) -> Any:
+    """Guard the writes to the attributes and items of the object
+
+    The attributes of functions, e.g. `arg` and `ret` of the components, and
+    of the objects of the classes defined by the pipeline can be written.
+    """
+    if isinstance(ob, types.FunctionType) or type(ob).__module__.startswith(
+        PACKAGE
+    ):
+        return ob
+
+    return full_write_guard(ob)
+
+
+def inplace_var(op: str, x: Any, y: Any) -> Any:
+    """Apply the augmented assignment operator"""
+    return {
+        "+=": lambda: x + y,
+        "-=": lambda: x - y,
+        "*=": lambda: x * y,
+        "/=": lambda: x / y,
+        "//=": lambda: x // y,
+        "%=": lambda: x % y,
+        "**=": lambda: x**y,
+        "<<=": lambda: x << y,
+        ">>=": lambda: x >> y,
+        "&=": lambda: x & y,
+        "^=": lambda: x ^ y,
+        "|=": lambda: x | y,
+    }[op]()
+
+
+def api_module(name: str) -> types.ModuleType:
+    """Get the module exposing the API of the module with the given name
+
+    The module only has the whitelisted names of the module, see `API`, and
+    the API modules of its submodules.
+    """
+    if name in _api_modules:
+        return _api_modules[name]
+
+    module = types.ModuleType(name)
+
+    if API[name]:
+        source = importlib.import_module(f"engine.{name}")
+        for item in API[name]:
+            setattr(module, item, getattr(source, item))
+
+    for child in API:
+        parent, _, item = child.rpartition(".")
+        if parent == name:
+            setattr(module, item, api_module(child))
+
+    _api_modules[name] = module
+
+    return module
+
+
+def compile_pipeline(files: Dict[str, str]) -> Dict[str, types.CodeType]:
+    """Compile the pipeline files with RestrictedPython
+
+    Returns:
+        Dict[str, types.CodeType]: The code of each module of the pipeline,
+            mapped by the module name.
+
+    Raises:
+        SyntaxError: If the code is not allowed.
+    """
+    code: Dict[str, types.CodeType] = {}
+
+    for path, content in files.items():
+        name = path[: -len(".py")].replace("/", ".")
+        if name.endswith(".__init__"):
+            name = name[: -len(".__init__")]
+
+        # The printed text is sent as output rather than read
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", SyntaxWarning)
+            code[name] = compile_restricted(
+                content, filename=path, mode="exec"
+            )
+
+    return code
+
+
+class Loader:
+    """Loader of the compiled pipeline modules."""
+
+    def __init__(self, code: Dict[str, types.CodeType]):
+        """Initialize the loader"""
+        self.code = code
+        self.modules: Dict[str, types.ModuleType] = {}
+
+    def load(self, name: str) -> types.ModuleType:
+        """Load the module of the pipeline with the given name"""
+        if name in self.modules:
+            return self.modules[name]
+
+        if name not in self.code:
+            raise ImportError(f"No module named {name}")
+
+        module = types.ModuleType(name)
+        module.__dict__.update(
+            {
+                "__builtins__": {**BUILTINS, "__import__": self.import_},
+                "__name__": name,
+                "__package__": PACKAGE,
+                "__metaclass__": type,
+                "_getattr_": safer_getattr,
+                "_getitem_": default_guarded_getitem,
+                "_getiter_": default_guarded_getiter,
+                "_iter_unpack_sequence_": guarded_iter_unpack_sequence,
+                "_unpack_sequence_": guarded_unpack_sequence,
+                "_write_": guarded_write,
+                "_inplacevar_": inplace_var,
+                "_print_": Printer,
+            }
+        )
+        self.modules[name] = module
+
+        exec(self.code[name], module.__dict__)
+
+        return module
+
+    def import_(
+        self,
+        name: str,
+        globals: Optional[Dict[str, Any]] = None,
+        locals: Optional[Dict[str, Any]] = None,
+        fromlist: Tuple[str, ...] = (),
+        level: int = 0,
+    ) -> types.ModuleType:
+        """Import the module for the restricted code
+
+        The pipeline modules, the API of the composer modules and the allowed
+        standard modules can be imported.
+        """
+        if level > 0 or name == PACKAGE or name.startswith(f"{PACKAGE}."):
+            if level > 0:
+                name = f"{PACKAGE}.{name}" if name else PACKAGE
+
+            module = self.load(name)
+            if not fromlist:
+                return self.load(PACKAGE)
+
+            for item in fromlist:
+                if f"{name}.{item}" in self.code:
+                    setattr(module, item, self.load(f"{name}.{item}"))
+
+            return module
+
+        root = name.split(".")[0]
+
+        if root == "modules":
+            if name not in API:
+                raise ImportError(f"Import of module {name} is not allowed")
+
+            module = api_module(name)
+            return module if fromlist else api_module(root)
+
+        if root in ALLOWED_MODULES:
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        raise ImportError(f"Import of module {name} is not allowed")
+
+
+def initialize(memory_limit: int):
+    """Initialize the process of the pool
+
+    Django is set up for the modules, and the address space of the process
+    is limited to its current size plus the memory limit.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_composer.settings")
+
+    import django
+
+    django.setup()
+    importlib.import_module("engine.modules")
+
+    with contextlib.suppress(OSError, ValueError):
+        import resource
+
+        with open("/proc/self/statm") as file:
+            size = int(file.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+        limit = size + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def alarm(signum, frame):
+    """Raise the timeout of the run"""
+    global _timed_out
+
+    _timed_out = True
+    raise TimeoutError("Pipeline timed out")
+
+
+def has_stuck_threads(idents: Set[int]) -> bool:
+    """Check if threads started by the run other than the given are alive
+
+    The threads are looked up by the running frames, as a thread whose join
+    is interrupted by the timeout is marked stopped even if it is running.
+    The threads of the composer client are kept between the runs.
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.monotonic() + STUCK_THREAD_TIMEOUT
+
+    while True:
+        running = [
+            ident
+            for ident in sys._current_frames()
+            if ident not in idents
+            and not names.get(ident, "").startswith("composer-client")
+        ]
+        if not running or time.monotonic() > deadline:
+            return bool(running)
+
+        time.sleep(0.05)
+
+
+def run(
+    digest: str,
+    files: Dict[str, str],
+    request: Dict[str, Any],
+    timeout: float,
+) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """Run the pipeline in the process of the pool
+
+    The events are the same as the events of the worker, see `worker.run`.
+
+    Returns:
+        Tuple[List[Dict[str, Any]], int, bool]: The events, the exit code,
+            and whether the run timed out leaving threads running, e.g.
+            components run in parallel, in which case the process is to be
+            replaced.
+    """
+    global _timed_out
+
+    os.environ.update(request.get("env", {}))
+    _timed_out = False
+    idents = set(sys._current_frames())
+
+    events: List[Dict[str, Any]] = []
+    limit = worker.OutputLimit()
+    stdout = worker.EventWriter(events.append, "stdout", limit)
+    stderr = worker.EventWriter(events.append, "stderr", limit)
+    exit_code = 0
+    results = []
+
+    previous = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+        stderr
+    ):
+        try:
+            code = _compiled.get(digest)
+            if code is None:
+                code = compile_pipeline(files)
+                _compiled[digest] = code
+
+            composer = importlib.import_module("engine.modules.composer")
+            with composer.defer_results(request.get("states")) as results:
+                pipeline = Loader(code).load(PACKAGE)
+                pipeline.run(request["user_message"])
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    stdout.flush()
+    stderr.flush()
+    result = results[0] if results else None
+    events.append({"event": "result", "result": result})
+    events.append({"event": "exit", "exit_code": exit_code})
+
+    return events, exit_code, _timed_out and has_stuck_threads(idents)
+
+
+class RestrictedExecutor:
+    """Executor running the pipelines in a pool of processes.
+
+    The processes are spawned once and reused. The runs wait for a free
+    process before they are submitted, so that the time limit of a run is
+    measured from its start rather than from its submission. A run exceeding
+    its time limit is interrupted in its process, and the pool is replaced
+    only if a process is stuck or dies, e.g. when killed for exceeding its
+    memory, as the processes of a pool cannot be replaced one by one.
+    """
+
+    logger: logging.Logger
+    lock: threading.Lock
+    slots: threading.BoundedSemaphore
+    executor: Optional[ProcessPoolExecutor]
+
+    def __init__(self):
+        """Initialize the executor"""
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(
+            containment_config.restricted_workers
+        )
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        """Get the pool of processes, spawning it if needed"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=containment_config.restricted_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=initialize,
+                    initargs=(containment_config.restricted_memory_limit,),
+                )
+
+            return self.executor
+
+    def reset(self, executor: ProcessPoolExecutor):
+        """Replace the given pool of processes, killing its processes"""
+        with self.lock:
+            if self.executor is not executor:
+                return
+
+            self.executor = None
+
+        for process in list(getattr(executor, "_processes", {}).values()):
+            with contextlib.suppress(Exception):
+                process.kill()
+
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(
+        self, digest: str, files: Dict[str, str], request: Dict[str, Any]
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Run the pipeline of the given files with the given request
+
+        Args:
+            digest (str): The digest of the pipeline files, to reuse the
+                compiled code.
+            files (Dict[str, str]): The files of the `pipeline` package.
+            request (Dict[str, Any]): The run request, see `worker.run`.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], int]: The events and the exit code.
+        """
+        timeout = containment_config.restricted_timeout
+
+        with self.slots:
+            executor = self.get_executor()
+
+            try:
+                future = executor.submit(
+                    run, digest, files, request, timeout
+                )
+                events, exit_code, stuck = future.result(
+                    timeout=timeout + GRACE_PERIOD
+                )
+
+                if stuck:
+                    self.logger.error("Restricted executor has stuck threads")
+                    self.reset(executor)
+
+                return events, exit_code
+            except FutureTimeoutError as e:
+                # The process ignored the alarm, e.g. running native code
+                self.logger.error(f"Restricted executor is stuck: {e!r}")
+                self.reset(executor)
+            except BrokenProcessPool as e:
+                self.logger.error(f"Restricted executor failed: {e!r}")
+                self.reset(executor)
+
+        return [
+            {
+                "event": "output",
+                "stream": "stderr",
+                "data": "Pipeline exceeded its time or memory limit\n",
+            },
+            {"event": "exit", "exit_code": 1},
+        ], 1
+
+
+restricted_executor = RestrictedExecutor()
@@ -0,0 +1,539 @@
+"""Worker module for the pipeline.
+
+The worker keeps a long-lived interpreter for the pipeline, so the imports
+stay warm between messages and only the pipeline modules whose content
+changed are reloaded. The globals of the pipeline modules thus persist
+between the runs until the module changes. Requests are sent to the worker
+over a Unix socket as JSON lines, and the events of the run are sent back as
+JSON lines.
+
+A request running longer than the run timeout stops the worker, as the
+threads of the pipeline cannot be stopped otherwise, and the worker is
+started again by the next request, paying for the cold imports.
+
+The worker serves one request at a time, as the runs share the output
+streams and the globals of the modules of the interpreter, so concurrent
+runs of the same pipeline wait for each other in the worker.
+
+Usage:
+    python -m worker serve: Serve the requests on the socket.
+    python -m worker send [--wait]: Send the request to the worker.
+    python -m worker run: Run the request in this interpreter.
+    python -m worker batch: Run the batch request in this interpreter.
+    python -m worker stop: Stop the worker.
+
+The request is read by the `send`, `run` and `batch` commands from the file
+of the request ID in the `CHAT_COMPOSER_WORKER_REQUEST` environment
+variable, since the request may be too large for the environment, and the
+events are written to stdout.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import importlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+SOCKET_PATH = ".worker.sock"
+LOCK_PATH = ".worker.lock"
+REQUEST_ENV = "CHAT_COMPOSER_WORKER_REQUEST"
+REQUEST_PREFIX = ".worker-request-"
+OUTPUT_LIMIT_ENV = "CHAT_COMPOSER_OUTPUT_LIMIT"
+RUN_TIMEOUT_ENV = "CHAT_COMPOSER_RUN_TIMEOUT"
+EXIT_UNAVAILABLE = 75
+EXIT_TIMEOUT = 124
+WAIT_TIMEOUT = 60.0
+LOCK_TIMEOUT = 1.0
+
+Send = Callable[[Dict[str, Any]], None]
+
+
+class OutputLimit:
+    """Limit of the output of a run shared by its writers.
+
+    The limit is read from `CHAT_COMPOSER_OUTPUT_LIMIT` in bytes, the output
+    is not limited if it is not set.
+    """
+
+    def __init__(self):
+        """Initialize the limit"""
+        limit = os.environ.get(OUTPUT_LIMIT_ENV)
+        self.remaining = int(limit) if limit else None
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    def take(self, data: str) -> Optional[str]:
+        """Take the data within the limit, None if the limit was reached."""
+        with self.lock:
+            if self.remaining is None:
+                return data
+
+            if self.truncated:
+                return None
+
+            encoded = data.encode("utf-8", errors="replace")
+            if len(encoded) <= self.remaining:
+                self.remaining -= len(encoded)
+                return data
+
+            data = encoded[: self.remaining].decode("utf-8", errors="ignore")
+            self.remaining = 0
+            self.truncated = True
+
+            return data
+
+
+class EventWriter(io.TextIOBase):
+    """Writer sending the written lines as output events of a stream.
+
+    The writer is locked, since components may run in parallel threads. The
+    output beyond the limit is dropped, and a truncated output event is sent
+    once instead.
+    """
+
+    def __init__(self, send: Send, stream: str, limit: OutputLimit):
+        """Initialize the writer"""
+        self.send = send
+        self.stream = stream
+        self.limit = limit
+        self.buffer = ""
+        self.lock = threading.Lock()
+
+    def writable(self) -> bool:
+        """Return whether the writer is writable"""
+        return True
+
+    def write(self, text: str) -> int:
+        """Write the text, sending the complete lines"""
+        with self.lock:
+            self.buffer += text
+
+            if "\n" in self.buffer:
+                data, self.buffer = self.buffer.rsplit("\n", 1)
+                self.send_output(data + "\n")
+
+        return len(text)
+
+    def flush(self):
+        """Send the incomplete line"""
+        with self.lock:
+            if self.buffer:
+                self.send_output(self.buffer)
+                self.buffer = ""
+
+    def send_output(self, data: str):
+        """Send the data within the limit as an output event"""
+        if self.limit.truncated:
+            return
+
+        data = self.limit.take(data)
+        if data:
+            self.send({"event": "output", "stream": self.stream, "data": data})
+
+        if self.limit.truncated:
+            self.send(
+                {
+                    "event": "output",
+                    "stream": self.stream,
+                    "data": "\n[output truncated]\n",
+                    "truncated": True,
+                }
+            )
+
+
+_digests: Dict[str, str] = {}
+
+
+def load_pipeline(digests: Optional[Dict[str, str]] = None):
+    """Import the pipeline, reloading the modules whose content changed.
+
+    The digests of the content of the pipeline modules, mapped by their
+    paths, are those computed by the server when the files were synchronized.
+    If they are not given, they are computed from the files.
+    """
+    global _digests
+
+    if digests is None:
+        digests = {
+            str(path): hashlib.sha256(path.read_bytes()).hexdigest()
+            for path in Path("pipeline").glob("*.py")
+        }
+
+    digests = {
+        Path(path).stem: digest
+        for path, digest in digests.items()
+        if Path(path).parent == Path("pipeline")
+    }
+
+    if digests != _digests:
+        # The package is always reloaded to bind the reloaded components
+        for name in list(sys.modules):
+            if not name.startswith("pipeline."):
+                continue
+
+            stem = name.split(".", 1)[1]
+            if digests.get(stem) != _digests.get(stem):
+                del sys.modules[name]
+
+        sys.modules.pop("pipeline", None)
+        importlib.invalidate_caches()
+        _digests = digests
+
+    return importlib.import_module("pipeline")
+
+
+def start_watchdog(
+    request: Dict[str, Any], send: Send
+) -> Optional[threading.Timer]:
+    """Start the watchdog stopping the worker if the request times out.
+
+    The timeout of each run is read from `CHAT_COMPOSER_RUN_TIMEOUT` in the
+    environment of the request in seconds, a batch is given the time of its
+    runs one after another. On timeout, an error and the exit event are sent
+    and the process exits, the request is not timed out if it is not set.
+    """
+    timeout = request.get("env", {}).get(RUN_TIMEOUT_ENV)
+    if not timeout:
+        return None
+
+    runs = 1
+    if request.get("command") == "batch":
+        parallel = max(int(request.get("parallel", 1)), 1)
+        runs = max(math.ceil(len(request["user_messages"]) / parallel), 1)
+
+    def expire():
+        """Send the timeout and exit"""
+        send(
+            {
+                "event": "output",
+                "stream": "stderr",
+                "data": f"Pipeline timed out after {timeout} seconds\n",
+            }
+        )
+        send({"event": "exit", "exit_code": EXIT_TIMEOUT})
+        os._exit(EXIT_TIMEOUT)
+
+    watchdog = threading.Timer(float(timeout) * runs, expire)
+    watchdog.daemon = True
+    watchdog.start()
+
+    return watchdog
+
+
+def run(request: Dict[str, Any], send: Send) -> int:
+    """Run the pipeline with the given request.
+
+    The pipeline starts with the states of the request, and the output of
+    the pipeline is sent as output events of the `stdout` and `stderr`
+    streams, up to the output limit. Then a result event with the chat, the
+    encoded response and the changes to the states is sent, followed by an
+    exit event with the exit code. The result is None if the pipeline did
+    not produce one.
+
+    Returns:
+        int: The exit code.
+    """
+    os.environ.update(request.get("env", {}))
+
+    limit = OutputLimit()
+    stdout = EventWriter(send, "stdout", limit)
+    stderr = EventWriter(send, "stderr", limit)
+    exit_code = 0
+    results = []
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+        stderr
+    ):
+        try:
+            composer = importlib.import_module("modules.composer")
+            with composer.defer_results(request.get("states")) as results:
+                pipeline = load_pipeline(request.get("digests"))
+                pipeline.run(request["user_message"])
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                exit_code = 1
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+
+    stdout.flush()
+    stderr.flush()
+    send({"event": "result", "result": results[0] if results else None})
+    send({"event": "exit", "exit_code": exit_code})
+
+    return exit_code
+
+
+def collect_message(request: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Run the pipeline with the given request, collecting its events."""
+    events = []
+    run(request, events.append)
+
+    return events
+
+
+def run_batch(request: Dict[str, Any], send: Send) -> int:
+    """Run the pipeline with each user message of the batch request.
+
+    The events of each run are tagged with the index of its message. The
+    runs are run one after another, each starting with the states changed
+    by the previous run, or in up to `parallel` forked processes, each
+    starting with the states of the request, in which case the events of
+    each run are sent once it finishes. The batch ends with an untagged exit
+    event.
+
+    Returns:
+        int: The exit code.
+    """
+    os.environ.update(request.get("env", {}))
+
+    user_messages: List[str] = request["user_messages"]
+    states: Optional[Dict[str, Any]] = request.get("states")
+    digests: Optional[Dict[str, str]] = request.get("digests")
+    parallel = max(int(request.get("parallel", 1)), 1)
+
+    def send_indexed(index: int) -> Send:
+        """Get the send function tagging the events with the index"""
+
+        def send_event(event: Dict[str, Any]):
+            """Send the event tagged with the index"""
+            nonlocal states
+
+            result = event.get("result")
+            if parallel == 1 and result is not None and states is not None:
+                composer = importlib.import_module("modules.composer")
+                states = composer.apply_states(
+                    states, result["patches"], result["ops"]
+                )
+
+            send({**event, "index": index})
+
+        return send_event
+
+    if parallel == 1 or len(user_messages) <= 1:
+        for index, user_message in enumerate(user_messages):
+            run(
+                {
+                    "user_message": user_message,
+                    "states": states,
+                    "digests": digests,
+                },
+                send_indexed(index),
+            )
+    else:
+        # Import before forking so the processes share the warm imports
+        with contextlib.suppress(Exception):
+            load_pipeline(digests)
+
+        context = multiprocessing.get_context("fork")
+        processes = min(parallel, len(user_messages))
+        requests = [
+            {
+                "user_message": user_message,
+                "states": states,
+                "digests": digests,
+            }
+            for user_message in user_messages
+        ]
+
+        with context.Pool(processes) as pool:
+            for index, events in enumerate(
+                pool.imap(collect_message, requests)
+            ):
+                for event in events:
+                    send_indexed(index)(event)
+
+    send({"event": "exit", "exit_code": 0})
+
+    return 0
+
+
+def serve():
+    """Serve the requests on the socket until stopped.
+
+    Only one worker serves a directory at a time, any other worker exits
+    if the lock is not released by a stopping worker shortly. The requests
+    are served one after another, see the module documentation.
+    """
+    lock = open(LOCK_PATH, "w")
+    deadline = time.monotonic() + LOCK_TIMEOUT
+
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                lock.close()
+                return
+
+        time.sleep(0.05)
+
+    # Warm up the imports
+    with contextlib.suppress(Exception):
+        importlib.import_module("modules")
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(SOCKET_PATH)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SOCKET_PATH)
+    server.listen()
+
+    try:
+        while True:
+            connection, _ = server.accept()
+
+            with connection, connection.makefile("r") as reader:
+                send_lock = threading.Lock()
+
+                def send(event: Dict[str, Any]):
+                    """Send the event, ignoring disconnected clients
+
+                    The events are sent whole, since the watchdog may send
+                    concurrently.
+                    """
+                    data = json.dumps(event).encode() + b"\n"
+                    with send_lock, contextlib.suppress(OSError):
+                        connection.sendall(data)
+
+                line = reader.readline()
+                if not line:
+                    continue
+
+                request = json.loads(line)
+                if request["command"] == "stop":
+                    send({"event": "exit", "exit_code": 0})
+                    break
+
+                watchdog = start_watchdog(request, send)
+
+                try:
+                    if request["command"] == "batch":
+                        run_batch(request, send)
+                    else:
+                        run(request, send)
+                finally:
+                    if watchdog is not None:
+                        watchdog.cancel()
+    finally:
+        server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(SOCKET_PATH)
+        lock.close()
+
+
+def connect(wait: bool = False) -> Optional[socket.socket]:
+    """Connect to the worker.
+
+    If wait is True, the connection is retried until the worker is ready.
+    """
+    deadline = time.monotonic() + WAIT_TIMEOUT
+
+    while True:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(SOCKET_PATH)
+            return client
+        except OSError:
+            client.close()
+
+        if not wait or time.monotonic() > deadline:
+            return None
+
+        time.sleep(0.05)
+
+
+def send(request: Dict[str, Any], wait: bool = False) -> int:
+    """Send the request to the worker, writing the events to stdout.
+
+    Returns:
+        int: The exit code, or `EXIT_UNAVAILABLE` if the worker is not
+            running.
+    """
+    client = connect(wait)
+    if client is None:
+        return EXIT_UNAVAILABLE
+
+    exit_code = EXIT_UNAVAILABLE
+
+    with client, client.makefile("r") as reader:
+        client.sendall(json.dumps(request).encode() + b"\n")
+
+        for line in reader:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+            event = json.loads(line)
+            if event["event"] == "exit" and "index" not in event:
+                return event["exit_code"]
+
+            exit_code = 1
+
+    return exit_code
+
+
+def request_path(request_id: str) -> Path:
+    """Get the path of the file of the request with the given ID."""
+    return Path(f"{REQUEST_PREFIX}{request_id}.json")
+
+
+def main():
+    """Main function for the worker."""
+    command = sys.argv[1]
+
+    if command == "serve":
+        serve()
+    elif command == "send":
+        path = request_path(os.environ[REQUEST_ENV])
+        request = json.loads(path.read_text())
+        wait = "--wait" in sys.argv
+        exit_code = send(request, wait=wait)
+
+        # The request is kept to be sent again once the worker is started
+        if exit_code != EXIT_UNAVAILABLE or wait:
+            path.unlink(missing_ok=True)
+
+        sys.exit(exit_code)
+    elif command in ("run", "batch"):
+        stdout = sys.stdout
+        write_lock = threading.Lock()
+
+        def write(event: Dict[str, Any]):
+            """Write the event to stdout, whole as for `serve`"""
+            with write_lock:
+                stdout.write(json.dumps(event) + "\n")
+                stdout.flush()
+
+        path = request_path(os.environ[REQUEST_ENV])
+        request = json.loads(path.read_text())
+        path.unlink(missing_ok=True)
+
+        start_watchdog({**request, "command": command}, write)
+
+        if command == "batch":
+            sys.exit(run_batch(request, write))
+
+        sys.exit(run(request, write))
+    elif command == "stop":
+        sys.exit(send({"command": "stop"}))
+    else:
+        raise ValueError(f"Unknown command {command}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""JSON patch module.
+
+A subset of JSON patches (RFC 6902) with the `add`, `remove` and `replace`
+operations, used to send only the changes of the states.
+"""
+
+import copy
+import json
+from typing import Any, Dict, List
+
+Patch = List[Dict[str, Any]]
+
+OPS = ("add", "remove", "replace")
+
+
+def escape(key: str) -> str:
+    """Escape the key for a JSON pointer."""
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def unescape(token: str) -> str:
+    """Unescape the token of a JSON pointer."""
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def equal(a: Any, b: Any) -> bool:
+    """Check if the documents are equal, e.g. `1` is not equal to `True`."""
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+def diff(old: Any, new: Any, path: str = "") -> Patch:
+    """Get the patch turning the old document into the new document."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+
+        for key in old:
+            if key not in new:
+                patch.append({"op": "remove", "path": f"{path}/{escape(key)}"})
+
+        for key, value in new.items():
+            key_path = f"{path}/{escape(key)}"
+            if key not in old:
+                patch.append({"op": "add", "path": key_path, "value": value})
+            else:
+                patch.extend(diff(old[key], value, key_path))
+
+        return patch
+
+    if equal(old, new):
+        return []
+
+    # Appended items are added at the end of the list
+    if (
+        isinstance(old, list)
+        and isinstance(new, list)
+        and len(new) > len(old)
+        and equal(new[: len(old)], old)
+    ):
+        return [
+            {"op": "add", "path": f"{path}/-", "value": value}
+            for value in new[len(old) :]
+        ]
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def apply(document: Any, patch: Patch) -> Any:
+    """Apply the patch to a copy of the document.
+
+    Missing parents are created and missing values are ignored when
+    removed, so the patches of concurrent runs can be applied one after
+    another, the last one winning on the same path.
+
+    Raises:
+        ValueError: If an operation is invalid or conflicts with the
+            document, e.g. adds a key to a value which is not an object.
+    """
+    document = copy.deepcopy(document)
+
+    for operation in patch:
+        validate(operation)
+
+        try:
+            document = apply_operation(document, operation)
+        except (
+            AttributeError,
+            IndexError,
+            KeyError,
+            TypeError,
+            ValueError,
+        ) as e:
+            raise ValueError(
+                f"operation {operation['op']} of {operation['path']}"
+                f" conflicts with the document: {e!r}"
+            ) from e
+
+    return document
+
+
+def validate(operation: Dict[str, Any]):
+    """Validate the operation of a patch.
+
+    Raises:
+        ValueError: If the operation is invalid.
+    """
+    if operation.get("op") not in OPS:
+        raise ValueError(f"op must be one of {', '.join(OPS)}")
+
+    path = operation.get("path")
+    if not isinstance(path, str) or (path and not path.startswith("/")):
+        raise ValueError("path must be a JSON pointer")
+
+    if operation["op"] != "remove" and "value" not in operation:
+        raise ValueError(f"operation {operation['op']} must have a value")
+
+
+def apply_operation(document: Any, operation: Dict[str, Any]) -> Any:
+    """Apply the validated operation to the document in place.
+
+    Returns:
+        Any: The document, which is replaced if the path is the root.
+    """
+    tokens = [unescape(t) for t in operation["path"].split("/")[1:]]
+
+    if not tokens:
+        if operation["op"] != "remove":
+            document = copy.deepcopy(operation["value"])
+        return document
+
+    parent = document
+    for token in tokens[:-1]:
+        if isinstance(parent, list):
+            parent = parent[int(token)]
+        else:
+            parent = parent.setdefault(token, {})
+
+    token = tokens[-1]
+
+    if operation["op"] == "remove":
+        if isinstance(parent, list):
+            if 0 <= int(token) < len(parent):
+                del parent[int(token)]
+        else:
+            parent.pop(token, None)
+    elif isinstance(parent, list):
+        value = copy.deepcopy(operation["value"])
+        if token == "-":
+            parent.append(value)
+        elif operation["op"] == "add":
+            parent.insert(int(token), value)
+        else:
+            parent[int(token)] = value
+    else:
+        parent[token] = copy.deepcopy(operation["value"])
+
+    return document
@@ -0,0 +1,107 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+from django.db import models
+from django.db.models.expressions import RawSQL
+
+from .json_type import JsonType
+
+
+def is_number(value: Any) -> bool:
+    """Check if the value is a JSON number"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def fold_ops(ops: List[Dict[str, JsonType]]) -> Dict[str, Tuple[str, Any]]:
+    """Fold the key-value operations into one operation per key
+
+    The folded operations are `set`, `delete`, `incr` and `extend`, applied
+    with the same semantics as the operations one after another, i.e.
+    incrementing a value which is not a number starts from 0, and appending
+    to a value which is not a list starts from an empty list.
+
+    Raises:
+        ValueError: If an operation is invalid.
+    """
+    folded: Dict[str, Tuple[str, Any]] = {}
+
+    for op in ops:
+        key = op.get("key")
+        if not isinstance(key, str):
+            raise ValueError("key must be a string")
+
+        previous = folded.get(key)
+
+        if op["op"] == "set":
+            folded[key] = ("set", op["value"])
+        elif op["op"] == "delete":
+            folded[key] = ("delete", None)
+        elif op["op"] == "incr":
+            amount = op["value"]
+            if not is_number(amount):
+                raise ValueError("amount must be a number")
+
+            if previous is None:
+                folded[key] = ("incr", amount)
+            elif previous[0] == "incr":
+                folded[key] = ("incr", previous[1] + amount)
+            elif previous[0] == "set" and is_number(previous[1]):
+                folded[key] = ("set", previous[1] + amount)
+            else:
+                folded[key] = ("set", amount)
+        elif op["op"] == "append":
+            value = op["value"]
+
+            if previous is None:
+                folded[key] = ("extend", [value])
+            elif previous[0] == "extend":
+                folded[key] = ("extend", [*previous[1], value])
+            elif previous[0] == "set" and isinstance(previous[1], list):
+                folded[key] = ("set", [*previous[1], value])
+            else:
+                folded[key] = ("set", [value])
+        else:
+            raise ValueError(f"unknown operation {op['op']}")
+
+    return folded
+
+
+def ops_expression(column: str, ops: List[Dict[str, JsonType]]) -> RawSQL:
+    """Get the expression applying the key-value operations to the column
+
+    The operations are applied by PostgreSQL on the current value of the
+    column, so concurrent updates of the same row do not lose operations.
+    Only the keys of the operations are changed.
+    """
+    state = f'"{column}"'
+    sql = (
+        f"CASE WHEN jsonb_typeof({state}) = 'object' THEN {state}"
+        " ELSE '{}'::jsonb END"
+    )
+    params: List[Any] = []
+
+    for key, (op, value) in fold_ops(ops).items():
+        if op == "delete":
+            sql = f"({sql}) - %s"
+            params += [key]
+        elif op == "set":
+            sql = f"jsonb_set({sql}, ARRAY[%s], %s::jsonb)"
+            params += [key, json.dumps(value)]
+        elif op == "incr":
+            sql = (
+                f"jsonb_set({sql}, ARRAY[%s], to_jsonb("
+                f"CASE WHEN jsonb_typeof({state} -> %s) = 'number'"
+                f" THEN ({state} ->> %s)::numeric ELSE 0 END"
+                " + %s::numeric))"
+            )
+            params += [key, key, key, value]
+        elif op == "extend":
+            sql = (
+                f"jsonb_set({sql}, ARRAY[%s], "
+                f"CASE WHEN jsonb_typeof({state} -> %s) = 'array'"
+                f" THEN {state} -> %s ELSE '[]'::jsonb END"
+                " || %s::jsonb)"
+            )
+            params += [key, key, key, json.dumps(value)]
+
+    return RawSQL(sql, params, output_field=models.JSONField())
@@ -0,0 +1,160 @@
+from django.test import SimpleTestCase
+
+from . import json_patch
+
+
+class JsonPatchDiffTests(SimpleTestCase):
+    """Tests of the patches between the documents"""
+
+    def test_equal_documents(self):
+        """Equal documents have no patch"""
+        document = {"a": [1, {"b": 2}]}
+
+        self.assertEqual(json_patch.diff(document, {"a": [1, {"b": 2}]}), [])
+
+    def test_changed_keys(self):
+        """The added, removed and replaced keys are patched"""
+        patch = json_patch.diff({"a": 1, "b": 2}, {"b": 3, "c": 4})
+
+        self.assertEqual(
+            patch,
+            [
+                {"op": "remove", "path": "/a"},
+                {"op": "replace", "path": "/b", "value": 3},
+                {"op": "add", "path": "/c", "value": 4},
+            ],
+        )
+
+    def test_nested_keys(self):
+        """The changes of the nested objects are patched by their path"""
+        patch = json_patch.diff({"a": {"b": 1}}, {"a": {"b": 2}})
+
+        self.assertEqual(
+            patch, [{"op": "replace", "path": "/a/b", "value": 2}]
+        )
+
+    def test_escaped_keys(self):
+        """The keys are escaped in the paths"""
+        patch = json_patch.diff({}, {"a/b~c": 1})
+
+        self.assertEqual(
+            patch, [{"op": "add", "path": "/a~1b~0c", "value": 1}]
+        )
+
+    def test_appended_items(self):
+        """The appended items are added at the end of the list"""
+        patch = json_patch.diff({"l": [1]}, {"l": [1, 2, 3]})
+
+        self.assertEqual(
+            patch,
+            [
+                {"op": "add", "path": "/l/-", "value": 2},
+                {"op": "add", "path": "/l/-", "value": 3},
+            ],
+        )
+
+    def test_changed_types(self):
+        """A value of another type is replaced, e.g. `1` by `True`"""
+        patch = json_patch.diff({"a": 1}, {"a": True})
+
+        self.assertEqual(
+            patch, [{"op": "replace", "path": "/a", "value": True}]
+        )
+
+    def test_diff_applies(self):
+        """The patch turns the old document into the new document"""
+        old = {"a": {"b": [1, 2]}, "c": "d", "e": None}
+        new = {"a": {"b": [2], "f": {}}, "e": [1], "g/h": 0}
+
+        self.assertEqual(
+            json_patch.apply(old, json_patch.diff(old, new)), new
+        )
+
+
+class JsonPatchApplyTests(SimpleTestCase):
+    """Tests of the patches applied to the documents"""
+
+    def test_copy(self):
+        """The patch is applied to a copy of the document"""
+        document = {"a": {"b": 1}}
+        patched = json_patch.apply(
+            document, [{"op": "replace", "path": "/a/b", "value": 2}]
+        )
+
+        self.assertEqual(document, {"a": {"b": 1}})
+        self.assertEqual(patched, {"a": {"b": 2}})
+
+    def test_root(self):
+        """The root is replaced by the value"""
+        patch = [{"op": "replace", "path": "", "value": 2}]
+
+        self.assertEqual(json_patch.apply({"a": 1}, patch), 2)
+
+    def test_missing_parents(self):
+        """The missing parents are created"""
+        self.assertEqual(
+            json_patch.apply({}, [{"op": "add", "path": "/a/b", "value": 1}]),
+            {"a": {"b": 1}},
+        )
+
+    def test_missing_removed(self):
+        """The missing values are ignored when removed"""
+        patch = [
+            {"op": "remove", "path": "/a"},
+            {"op": "remove", "path": "/l/3"},
+        ]
+
+        self.assertEqual(json_patch.apply({"l": []}, patch), {"l": []})
+
+    def test_list_items(self):
+        """The items are inserted, replaced and appended by their index"""
+        patch = [
+            {"op": "add", "path": "/l/0", "value": 0},
+            {"op": "replace", "path": "/l/1", "value": 3},
+            {"op": "add", "path": "/l/-", "value": 4},
+            {"op": "remove", "path": "/l/2"},
+        ]
+
+        self.assertEqual(
+            json_patch.apply({"l": [1, 2]}, patch), {"l": [0, 3, 4]}
+        )
+
+    def test_last_wins(self):
+        """The patches of concurrent runs on the same path keep the last"""
+        patch = [
+            {"op": "replace", "path": "/a", "value": 1},
+            {"op": "replace", "path": "/a", "value": 2},
+        ]
+
+        self.assertEqual(json_patch.apply({"a": 0}, patch), {"a": 2})
+
+    def test_conflicting_patches(self):
+        """The patches conflicting with the document raise ValueError"""
+        patches = [
+            [
+                {"op": "replace", "path": "/x", "value": 5},
+                {"op": "add", "path": "/x/y", "value": 1},
+            ],
+            [{"op": "replace", "path": "/l/3", "value": 1}],
+            [{"op": "add", "path": "/l/a", "value": 1}],
+        ]
+
+        for patch in patches:
+            with self.subTest(patch=patch):
+                with self.assertRaises(ValueError):
+                    json_patch.apply({"l": []}, patch)
+
+    def test_malformed_patches(self):
+        """The malformed operations raise ValueError"""
+        patches = [
+            [{"path": "/a", "value": 1}],
+            [{"op": "move", "path": "/a", "value": 1}],
+            [{"op": "add", "value": 1}],
+            [{"op": "add", "path": "a", "value": 1}],
+            [{"op": "add", "path": "/a"}],
+        ]
+
+        for patch in patches:
+            with self.subTest(patch=patch):
+                with self.assertRaises(ValueError):
+                    json_patch.apply({}, patch)